@@ -3,7 +3,9 @@ Entry point to starting the server
 """
 import optparse
 import importlib
-from kvault.queue_server import QueueServer
+from kvault.append_only_log import FSYNC_POLICIES
+from kvault.eviction import EVICTION_POLICIES, parse_memory
+from kvault.queue_server import QueueServer, ServerConfig, ENGINES
 from kvault.infra.logger import logger
 
 
@@ -22,12 +24,45 @@ def get_option_parser():
                       help='Maximum number of clients.', type=int)
     parser.add_option('-p', '--port', default=31337, dest='port',
                       help='Port to listen on.', type=int)
+    parser.add_option('-b', '--max-batch-size', default=256, dest='max_batch_size',
+                      help='Maximum number of pipelined requests of a connection handled per write.', type=int)
+    parser.add_option('-E', '--engine', type='choice', choices=ENGINES, default='gevent', dest='engine',
+                      help='Engine serving client connections, one of %s.' % ', '.join(ENGINES))
+    parser.add_option('-a', '--append-only-file', dest='append_only_file',
+                      help='Append only log of write requests, replayed on startup.')
+    parser.add_option('--fsync', type='choice', choices=FSYNC_POLICIES, default='everysec', dest='fsync',
+                      help='When the append only log is synced to disk, one of %s.' % ', '.join(FSYNC_POLICIES))
+    parser.add_option('--rewrite-min-size', default=64 * 1024 * 1024, dest='rewrite_min_size',
+                      help='Minimum size in bytes of the append only log before it is rewritten.', type=int)
+    parser.add_option('--maxmemory', default='0', dest='maxmemory',
+                      help='Maximum memory used by keys before keys are evicted, e.g. 100mb. 0 for no limit.')
+    parser.add_option('--maxmemory-policy', type='choice', choices=EVICTION_POLICIES, default='allkeys-lru',
+                      dest='maxmemory_policy',
+                      help='Keys evicted once the maximum memory is reached, one of %s.' % ', '.join(EVICTION_POLICIES))
+    parser.add_option('--maxmemory-samples', default=5, dest='maxmemory_samples',
+                      help='Number of keys sampled to pick a key to evict.', type=int)
+    parser.add_option('--response-cache-size', default='16mb', dest='response_cache_size',
+                      help='Maximum memory used by the serialized GET replies of hot keys, e.g. 16mb. 0 to disable.')
+    parser.add_option('--replicaof', dest='replicaof', metavar='HOST:PORT',
+                      help='Primary to replicate, the server then only serves reads.')
+    parser.add_option('--repl-backlog-size', default='1mb', dest='repl_backlog_size',
+                      help='Memory used by the writes kept for replicas to resume from after a disconnect, e.g. 1mb.')
     parser.add_option('-l', '--log-file', dest='log_file', help='Log file.')
     parser.add_option('-x', '--extension', action='append', dest='extensions',
                       help='Import path for Python extension module(s).')
     return parser
 
 
+def parse_address(address):
+    """
+    Parses the address of a server
+    :param address: address formatted host:port
+    :return: tuple of the host and port
+    """
+    host, _, port = address.rpartition(':')
+    return host, int(port)
+
+
 def load_extensions(server, extensions):
     """
     Load provided extensions and include them as modules for the server to use
@@ -52,13 +87,24 @@ def load_extensions(server, extensions):
 if __name__ == '__main__':
     options, args = get_option_parser().parse_args()
 
-    from gevent import monkey
+    if options.engine == 'gevent':
+        from gevent import monkey
 
-    monkey.patch_all()
+        monkey.patch_all()
 
     # configure_logger(options)
-    server = QueueServer(host=options.host, port=options.port,
-                         max_clients=options.max_clients)
+    config = ServerConfig(max_batch_size=options.max_batch_size,
+                          engine=options.engine,
+                          append_only_file=options.append_only_file,
+                          fsync=options.fsync,
+                          rewrite_min_size=options.rewrite_min_size,
+                          maxmemory=parse_memory(options.maxmemory),
+                          maxmemory_policy=options.maxmemory_policy,
+                          maxmemory_samples=options.maxmemory_samples,
+                          response_cache_size=parse_memory(options.response_cache_size),
+                          replica_of=parse_address(options.replicaof) if options.replicaof else None,
+                          repl_backlog_size=parse_memory(options.repl_backlog_size))
+    server = QueueServer(host=options.host, port=options.port, max_clients=options.max_clients, config=config)
     load_extensions(server, options.extensions or ())
     print('\x1b[32m  .--.')
     print(' /( \x1b[34m@\x1b[33m >\x1b[32m    ,-.  '
@@ -1,57 +1,119 @@
 """
 Kvault client that communicates via protocol handler to the server
 """
+import asyncio
+import datetime
+from abc import ABC, abstractmethod
 import logging
+from collections import OrderedDict, deque
+from io import BytesIO
+from typing import Any, Deque, Dict, List, Optional, Tuple
+import gevent
+from gevent import socket
+from kvault.cluster import ClusterNode, key_slot, slot_table
+from kvault.hash_ring import HashRing, VIRTUAL_NODES
+from kvault.commands.spec import command_keys, is_write_command
 from kvault.protocol_handler import ProtocolHandler
-from kvault.socket_pool import SocketPool
-from kvault.exceptions import ServerDisconnect, ServerInternalError, CommandError, Error
+from kvault.resp_parser import RespParser, INCOMPLETE
+from kvault.socket_pool import PoolStats, SocketPool, POOL_MAX_SIZE
+from kvault.tracking import INVALIDATE_CHANNEL
+from kvault.utils import decode
+from kvault.exceptions import ServerDisconnect, ServerInternalError, CommandError, Error, WatchError
 
 logger = logging.getLogger(__name__)
 
+# single key reads whose replies may be kept in the near cache
+CACHED_COMMANDS = frozenset((
+    b'GET', b'EXISTS', b'HGET', b'HGETALL', b'HMGET', b'HEXISTS', b'HKEYS', b'HVALS', b'HLEN', b'LLEN', b'LINDEX',
+    b'LRANGE', b'SCARD', b'SISMEMBER', b'SMEMBERS',
+))
+# returned by NearCache.get for replies that are not cached
+MISS = object()
+# multi-key commands split per server when their keys are spread over several
+FAN_OUT_COMMANDS = frozenset((b'MGET', b'MPOP', b'MDELETE', b'MSET', b'MSETEX'))
 
-class Client:
+
+class NearCache:
     """
-    KCault Client
+    Least recently used replies to reads, kept per key so that all the replies about a key are dropped together when
+    the server invalidates it
     """
 
-    def __init__(self, host='127.0.0.1', port=31337, pool_max_age=60):
-        self._host = host
-        self._port = port
-        self._socket_pool = SocketPool(host, port, pool_max_age)
-        self._protocol = ProtocolHandler()
+    def __init__(self, max_keys: int):
+        self.max_keys = max_keys
+        self._entries: 'OrderedDict[Any, Dict[Tuple[Any, ...], Any]]' = OrderedDict()
+        # bumped by every invalidation, so that a reply read before an invalidation is not cached after it
+        self.generation = 0
+        self.hits = 0
+        self.misses = 0
 
-    def execute(self, *args):
+    def __len__(self):
+        return len(self._entries)
+
+    def get(self, key, args: Tuple[Any, ...]) -> Any:
         """
-        Executes a give command
+        Returns the cached reply of a read
+        :param key: key read
         :param args: Arguments for command
-        :return: response from executed command
+        :return: the reply or MISS
         """
-        conn = self._socket_pool.checkout()
-        close_conn = args[0] in (b'QUIT', b'SHUTDOWN')
-        self._protocol.write_response(conn, args)
-        try:
-            resp = self._protocol.handle_request(conn)
-        except EOFError as exc:
-            self._socket_pool.close()
-            raise ServerDisconnect('server went away') from exc
-        except Exception as exc:
-            self._socket_pool.close()
-            raise ServerInternalError('internal server error') from exc
+        replies = self._entries.get(key)
+        reply = MISS if replies is None else replies.get(args, MISS)
+        if reply is MISS:
+            self.misses += 1
         else:
-            if close_conn:
-                self._socket_pool.close()
-            else:
-                self._socket_pool.checkin()
-        if isinstance(resp, Error):
-            logger.error(f"Received an error {resp.message}")
-            raise CommandError(resp.message)
-        return resp
+            self.hits += 1
+            self._entries.move_to_end(key)
+        return reply
 
-    def close(self):
+    def put(self, key, args: Tuple[Any, ...], reply: Any, generation: int):
         """
-        Closes client connection
+        Caches the reply of a read, unless an invalidation was received since the read was sent
+        :param key: key read
+        :param args: Arguments for command
+        :param reply: reply of the server
+        :param generation: generation of the cache when the read was sent
+        """
+        if generation != self.generation:
+            return
+        replies = self._entries.get(key)
+        if replies is None:
+            replies = self._entries[key] = {}
+            if len(self._entries) > self.max_keys:
+                self._entries.popitem(last=False)
+        else:
+            self._entries.move_to_end(key)
+        replies[args] = reply
+
+    def invalidate(self, key):
+        """
+        Drops the replies about a key
+        :param key: Key
+        """
+        self.generation += 1
+        self._entries.pop(key, None)
+
+    def clear(self):
+        """
+        Drops every reply
+        """
+        self.generation += 1
+        self._entries.clear()
+
+
+class ClientCommands(ABC):
+    """
+    Command surface shared by the clients. Every command calls execute with the encoded command name followed by its
+    arguments, which the clients implement synchronously or as a coroutine
+    """
+
+    @abstractmethod
+    def execute(self, *args):
+        """
+        Executes a given command
+        :param args: Arguments for command
+        :return: response from executed command, or an awaitable of it for the asyncio client
         """
-        self.execute(b'QUIT')
 
     @staticmethod
     def command(cmd):
@@ -74,11 +136,41 @@ class Client:
     llen = command(cmd='LLEN')
     lindex = command(cmd='LINDEX')
     lrange = command(cmd='LRANGE')
+    lscan = command(cmd='LSCAN')
     lset = command(cmd='LSET')
     ltrim = command(cmd='LTRIM')
     rpoplpush = command(cmd='RPOPLPUSH')
     lflush = command(cmd='LFLUSH')
 
+    # timeouts are sent as strings, as floats would be truncated to integers by the protocol
+    def blpop(self, *keys_and_timeout):
+        """
+        Pops the value at the head of the first non-empty queue out of the given keys, blocking while they are all empty
+        :param keys_and_timeout: keys followed by the timeout in seconds, 0 to block forever
+        :return: key and value, or None on timeout
+        """
+        *keys, timeout = keys_and_timeout
+        return self.execute(b'BLPOP', *keys, str(timeout))
+
+    def brpop(self, *keys_and_timeout):
+        """
+        Pops the value at the tail of the first non-empty queue out of the given keys, blocking while they are all empty
+        :param keys_and_timeout: keys followed by the timeout in seconds, 0 to block forever
+        :return: key and value, or None on timeout
+        """
+        *keys, timeout = keys_and_timeout
+        return self.execute(b'BRPOP', *keys, str(timeout))
+
+    def brpoplpush(self, src, dest, timeout):
+        """
+        Pops the value at the tail of src and pushes it to the head of dest, blocking while src is empty
+        :param src: Key to pop from
+        :param dest: Key to push to
+        :param timeout: number of seconds to block for, 0 to block forever
+        :return: the value, or None on timeout
+        """
+        return self.execute(b'BRPOPLPUSH', src, dest, str(timeout))
+
     append = command(cmd='APPEND')
     decr = command(cmd='DECR')
     decrby = command(cmd='DECRBY')
@@ -97,6 +189,7 @@ class Client:
     set = command(cmd='SET')
     setex = command(cmd='SETEX')
     setnx = command(cmd='SETNX')
+    scan = command(cmd='SCAN')
     length = command(cmd='LEN')
     flush = command(cmd='FLUSH')
 
@@ -112,6 +205,7 @@ class Client:
     hset = command(cmd='HSET')
     hsetnx = command(cmd='HSETNX')
     hvals = command(cmd='HVALS')
+    hscan = command(cmd='HSCAN')
 
     sadd = command(cmd='SADD')
     scard = command(cmd='SCARD')
@@ -121,24 +215,191 @@ class Client:
     sinterstore = command(cmd='SINTERSTORE')
     sismember = command(cmd='SISMEMBER')
     smembers = command(cmd='SMEMBERS')
+    sscan = command(cmd='SSCAN')
     spop = command(cmd='SPOP')
     srem = command(cmd='SREM')
     sunion = command(cmd='SUNION')
     sunionstore = command(cmd='SUNIONSTORE')
 
-    add = command(cmd='ADD')
-    read = command(cmd='READ')
+    # timestamps are epoch seconds, datetimes or strings formatted Y-m-d H:M:S, and are sent as strings like timeouts
+    @staticmethod
+    def _timestamp(timestamp) -> str:
+        if isinstance(timestamp, datetime.datetime):
+            timestamp = timestamp.timestamp()
+        return str(timestamp)
+
+    def add(self, timestamp, data):
+        """
+        Schedules data to be read once it is due
+        :param timestamp: time the data is due at, epoch seconds, datetime or string formatted Y-m-d H:M:S
+        :param data: data to schedule
+        :return: 1 once added
+        """
+        return self.execute(b'ADD', self._timestamp(timestamp), data)
+
+    def read(self, timestamp=None, limit=None, block=None):
+        """
+        Removes and returns the scheduled data that is due, earliest first
+        :param timestamp: reads the data due at this time instead of now, can not be combined with block
+        :param limit: returns at most this many items, defaulted to None which returns all the due data
+        :param block: when no data is due, number of seconds to wait for the next item to be due, 0 to wait forever.
+        Defaulted to None which returns right away
+        :return: list of data, None if a blocking read timed out
+        """
+        args = [] if timestamp is None else [self._timestamp(timestamp)]
+        if limit is not None:
+            args.extend((b'LIMIT', limit))
+        if block is not None:
+            args.extend((b'BLOCK', str(block)))
+        return self.execute(b'READ', *args)
+
     flush_schedule = command(cmd='FLUSH_SCHEDULE')
     length_schedule = command(cmd='LENGTH_SCHEDULE')
 
     expire = command(cmd='EXPIRE')
+    expireat = command(cmd='EXPIREAT')
+    pexpireat = command(cmd='PEXPIREAT')
     info = command(cmd='INFO')
+    latency = command(cmd='LATENCY')
+    config = command(cmd='CONFIG')
     flushall = command(cmd='FLUSHALL')
     save = command(cmd='SAVE')
+    bgsave = command(cmd='BGSAVE')
+    bgrewriteaof = command(cmd='BGREWRITEAOF')
     restore = command(cmd='RESTORE')
     merge = command(cmd='MERGE')
     quit = command(cmd='QUIT')
     shutdown = command(cmd='SHUTDOWN')
+    slots = command(cmd='SLOTS')
+    publish = command(cmd='PUBLISH')
+
+
+class PooledClient(ClientCommands):
+    """
+    Client sending commands over pools of connections, one per server
+    """
+
+    def __init__(self, serializer='resp'):
+        if serializer not in ('resp', 'msgpack'):
+            raise ValueError(f'unsupported serializer {serializer}, expected resp or msgpack')
+        self._packed = serializer == 'msgpack'
+        self._protocol = ProtocolHandler()
+
+    @abstractmethod
+    def execute(self, *args):
+        """
+        Executes a given command over the pool of the server it is sent to
+        :param args: Arguments for command
+        :return: response from executed command
+        """
+
+    def _hello(self, conn):
+        """
+        Switches a new connection to packed replies
+        :param conn: socket connection
+        :raises CommandError if the server refused to switch
+        """
+        self._protocol.write_response(conn, (b'HELLO', b'MSGPACK'))
+        resp = self._protocol.handle_request(conn)
+        if isinstance(resp, Error):
+            raise CommandError(resp.message)
+
+    def _execute(self, socket_pool: SocketPool, args):
+        """
+        Executes a command on the server of a socket pool
+        :param socket_pool: pool of connections to the server
+        :param args: Arguments for command
+        :return: response from executed command
+        """
+        conn = socket_pool.checkout()
+        close_conn = args[0] in (b'QUIT', b'SHUTDOWN')
+        conn.write(self._protocol.encode_request(args, self._packed))
+        conn.flush()
+        try:
+            resp = self._protocol.handle_request(conn)
+        except EOFError as exc:
+            socket_pool.close()
+            raise ServerDisconnect('server went away') from exc
+        except Exception as exc:
+            socket_pool.close()
+            raise ServerInternalError('internal server error') from exc
+        else:
+            if close_conn:
+                socket_pool.close()
+            else:
+                socket_pool.checkin()
+        if isinstance(resp, Error):
+            logger.error(f"Received an error {resp.message}")
+            raise CommandError(resp.message)
+        return resp
+
+    def _gather(self, requests: List[Tuple[SocketPool, Tuple[Any, ...]]]) -> List[Any]:
+        """
+        Executes commands on several servers in parallel
+        :param requests: list of socket pools and the command to execute on them
+        :return: list of responses in the order of the requests
+        """
+        greenlets = [gevent.spawn(self._execute, pool, args) for pool, args in requests]
+        gevent.joinall(greenlets, raise_error=True)
+        return [greenlet.value for greenlet in greenlets]
+
+    def _fan_out(self, args, keys: List[Any], groups: Dict[SocketPool, List[int]]):
+        """
+        Splits a multi-key command per server, sends the parts in parallel and merges their replies
+        :param args: Arguments for command, starting with one of FAN_OUT_COMMANDS
+        :param keys: keys of the command
+        :param groups: mapping of socket pools to the positions of their keys
+        :return: replies merged in the order of the keys
+        """
+        command = args[0]
+        if command in (b'MSET', b'MSETEX'):
+            data = args[1]
+            requests = [(pool, (command, {keys[i]: data[keys[i]] for i in group}, *args[2:]))
+                        for pool, group in groups.items()]
+            replies = self._gather(requests)
+            return sum(replies) if command == b'MSET' else None
+        replies = self._gather([(pool, (command, *[keys[i] for i in group])) for pool, group in groups.items()])
+        if command == b'MDELETE':
+            return sum(replies)
+        accum: List[Any] = [None] * len(keys)
+        for group, values in zip(groups.values(), replies):
+            for position, value in zip(group, values):
+                accum[position] = value
+        return accum
+
+    def _send_batch(self, socket_pool: SocketPool, commands: List[Tuple[Any, ...]]) -> List[Any]:
+        """
+        Sends a batch of commands with a single write and reads all the replies in order
+        :param socket_pool: pool of connections to the server
+        :param commands: list of command arguments, each starting with the encoded command name
+        :return: list of replies, one per command
+        """
+        conn = socket_pool.checkout()
+        try:
+            replies = self._exchange(conn, commands)
+        except EOFError as exc:
+            socket_pool.close()
+            raise ServerDisconnect('server went away') from exc
+        except Exception as exc:
+            socket_pool.close()
+            raise ServerInternalError('internal server error') from exc
+        else:
+            socket_pool.checkin()
+        return replies
+
+    def _exchange(self, conn, commands: List[Tuple[Any, ...]]) -> List[Any]:
+        """
+        Writes a batch of commands on a connection with a single write and reads all the replies in order
+        :param conn: socket connection
+        :param commands: list of command arguments, each starting with the encoded command name
+        :return: list of replies, one per command
+        """
+        buf = BytesIO()
+        for args in commands:
+            self._protocol.write_request(buf, args, self._packed)
+        conn.write(buf.getvalue())
+        conn.flush()
+        return [self._protocol.handle_request(conn) for _ in commands]
 
     def __getitem__(self, key):
         if isinstance(key, (list, tuple)):
@@ -157,3 +418,955 @@ class Client:
 
     def __len__(self):
         return self.length()
+
+
+class Client(PooledClient):
+    """
+    KCault Client. With cluster set, the client fetches the hash slots of the workers sharing the keyspace from the
+    server it is pointed at and sends every command to the worker owning its keys. Multi-key commands are split per
+    worker and sent in parallel.
+
+    With near_cache_size set, the replies to single key reads of up to that many keys are cached by the client and
+    served without a round trip. The server tracks the keys read by the connections of the client and pushes an
+    invalidation once they change, on a connection of its own.
+
+    With serializer set to 'msgpack', every connection switches to packed replies with HELLO MSGPACK and the lists,
+    dictionaries and sets sent and received are serialized in one piece with MessagePack instead of element by element.
+
+    Every thread or greenlet running a command holds a connection of the pool for its duration. At most pool_max_size
+    connections are opened per server, callers beyond that wait for a connection to be checked in, for up to
+    pool_timeout seconds, and connections left idle for pool_max_age seconds are closed.
+    """
+
+    # pylint: disable-next=too-many-arguments
+    def __init__(self, host='127.0.0.1', port=31337, pool_max_age=60, cluster=False, near_cache_size=0,
+                 serializer='resp', pool_max_size=POOL_MAX_SIZE, pool_timeout=None):
+        super().__init__(serializer)
+        self._host = host
+        self._port = port
+        self._pool_max_age = pool_max_age
+        self._pool_max_size = pool_max_size
+        self._pool_timeout = pool_timeout
+        self._socket_pool = SocketPool(host, port, pool_max_age, pool_max_size, pool_timeout)
+        self._cluster = cluster
+        self._nodes: List[ClusterNode] = []
+        self._node_pools: Dict[Tuple[str, int], SocketPool] = {}
+        self._slot_table: Optional[List[Optional[int]]] = None
+        self._near_cache: Optional[NearCache] = None
+        self._invalidations: Optional['PubSub'] = None
+        self._tracking_id: Optional[int] = None
+        if near_cache_size:
+            if cluster:
+                raise ValueError('near cache is not supported in cluster mode')
+            self._near_cache = NearCache(near_cache_size)
+        if self._packed or self._near_cache is not None:
+            self._socket_pool.on_connect = self._setup_connection
+
+    def execute(self, *args):
+        """
+        Executes a give command
+        :param args: Arguments for command
+        :return: response from executed command
+        """
+        if self._cluster:
+            return self._execute_cluster(args)
+        if self._near_cache is not None:
+            return self._execute_cached(self._near_cache, args)
+        return self._execute(self._socket_pool, args)
+
+    def _execute_cached(self, cache: NearCache, args):
+        """
+        Serves reads from the near cache and drops the replies about the keys written by the client right away, so the
+        client reads its own writes without waiting for their invalidation
+        :param cache: the near cache
+        :param args: Arguments for command
+        :return: response from executed command
+        """
+        command = args[0]
+        if command in CACHED_COMMANDS and len(args) > 1:
+            key = args[1]
+            try:
+                reply = cache.get(key, args)
+            except TypeError:
+                # arguments that can not be hashed are not cached
+                return self._execute(self._socket_pool, args)
+            if reply is MISS:
+                generation = cache.generation
+                reply = self._execute(self._socket_pool, args)
+                cache.put(key, args, reply, generation)
+            return reply
+        self._invalidate_locally(cache, [args])
+        return self._execute(self._socket_pool, args)
+
+    @staticmethod
+    def _invalidate_locally(cache: NearCache, commands: List[Tuple[Any, ...]]):
+        """
+        Drops the replies about the keys written by commands
+        :param cache: the near cache
+        :param commands: list of command arguments, each starting with the encoded command name
+        """
+        for args in commands:
+            if is_write_command(args[0]):
+                keys = command_keys(args[0], args[1:])
+                if keys:
+                    for key in keys:
+                        cache.invalidate(key)
+                elif args[0] in (b'FLUSH', b'FLUSHALL', b'RESTORE', b'MERGE'):
+                    cache.clear()
+
+    def _setup_connection(self, conn):
+        """
+        Sets up the state of a new connection on the server before it is used
+        :param conn: socket connection
+        """
+        if self._packed:
+            self._hello(conn)
+        if self._near_cache is not None:
+            self._enable_tracking(conn)
+
+    def _enable_tracking(self, conn):
+        """
+        Turns tracking on for a new connection of the pool, redirecting its invalidations to the connection the client
+        listens to them on, which is opened with the first connection
+        :param conn: socket connection
+        :raises CommandError if the server refused to track the connection
+        """
+        if self._invalidations is None:
+            invalidations = self.pubsub()
+            self._tracking_id = invalidations.client_id()
+            invalidations.subscribe(INVALIDATE_CHANNEL)
+            # the server only pushes invalidations once the subscription is in place
+            invalidations.get_message(timeout=None)
+            self._invalidations = invalidations
+            gevent.spawn(self._listen_invalidations, invalidations)
+        self._protocol.write_response(conn, (b'CLIENT', b'TRACKING', b'ON', b'REDIRECT', self._tracking_id))
+        resp = self._protocol.handle_request(conn)
+        if isinstance(resp, Error):
+            raise CommandError(resp.message)
+
+    def _listen_invalidations(self, invalidations: 'PubSub'):
+        """
+        Drops the replies about the keys invalidated by the server, an invalidation without keys drops them all. The
+        near cache is disabled if the connection is lost, as invalidations could be missed from then on
+        :param invalidations: connection subscribed to the invalidations
+        """
+        cache = self._near_cache
+        try:
+            for message in invalidations.listen():
+                if message['type'] != 'message':
+                    continue
+                if message['data'] is None:
+                    cache.clear()
+                else:
+                    for key in message['data']:
+                        cache.invalidate(key)
+        except (ServerDisconnect, OSError):
+            logger.warning('Lost the invalidations of the near cache, disabling it')
+        cache.clear()
+        self._near_cache = None
+
+    @property
+    def near_cache(self) -> Optional[NearCache]:
+        """Returns the near cache, None if it is disabled"""
+        return self._near_cache
+
+    def refresh_slots(self):
+        """
+        Fetches the hash slots of the workers from the server the client is pointed at
+        """
+        self._nodes = [ClusterNode(*entry) for entry in self._execute(self._socket_pool, (b'SLOTS',))]
+        self._slot_table = slot_table(self._nodes)
+        for node in self._nodes:
+            if (node.host, node.port) not in self._node_pools:
+                socket_pool = SocketPool(node.host, node.port, self._pool_max_age, self._pool_max_size,
+                                         self._pool_timeout)
+                if self._packed:
+                    socket_pool.on_connect = self._hello
+                self._node_pools[(node.host, node.port)] = socket_pool
+
+    def _node_pool(self, key) -> SocketPool:
+        """
+        Returns the pool of connections to the worker owning a key
+        :param key: Key
+        :return: socket pool
+        """
+        node = self._nodes[self._slot_table[key_slot(key)]]
+        return self._node_pools[(node.host, node.port)]
+
+    def _group_by_node(self, keys) -> Dict[SocketPool, List[int]]:
+        """
+        Groups the positions of keys by the worker owning them
+        :param keys: list of keys
+        :return: mapping of socket pools to the positions of their keys
+        """
+        groups: Dict[SocketPool, List[int]] = {}
+        for position, key in enumerate(keys):
+            groups.setdefault(self._node_pool(key), []).append(position)
+        return groups
+
+    def _execute_cluster(self, args):
+        """
+        Routes a command to the workers owning its keys
+        :param args: Arguments for command
+        :return: response from executed command
+        """
+        if self._slot_table is None:
+            self.refresh_slots()
+        command = args[0]
+        if command in (b'LEN', b'FLUSH', b'FLUSHALL'):
+            replies = self._gather([(pool, args) for pool in self._node_pools.values()])
+            return sum(replies)
+
+        keys = command_keys(command, args[1:])
+        if not keys:
+            return self._execute(self._socket_pool, args)
+        groups = self._group_by_node(keys)
+        if len(groups) == 1:
+            try:
+                return self._execute(next(iter(groups)), args)
+            except CommandError as error:
+                if not decode(error.message).startswith('MOVED'):
+                    raise
+                # the slots moved since they were fetched
+                self.refresh_slots()
+                return self._execute(self._node_pool(keys[0]), args)
+
+        if command in FAN_OUT_COMMANDS:
+            return self._fan_out(args, keys, groups)
+        raise CommandError(f'CROSSSLOT keys of {command} do not hash to the same worker')
+
+    def connect(self, key=None):
+        """
+        Opens a connection of its own, outside of the socket pool, e.g. to keep the keys watched by a transaction
+        :param key: key the connection is for, which picks the worker owning it in cluster mode
+        :return: socket connection
+        """
+        if self._cluster and key is not None:
+            if self._slot_table is None:
+                self.refresh_slots()
+            return self._node_pool(key).create_socket_file()
+        return self._socket_pool.create_socket_file()
+
+    # pylint: disable-next=too-many-arguments
+    def execute_pipeline(self, commands: List[Tuple[Any, ...]], transaction: bool = False,
+                         raise_on_error: bool = True, conn=None) -> List[Any]:
+        """
+        Executes a batch of commands with a single write and reads all the replies in order. In cluster mode the
+        commands are grouped by the worker owning their first key and every group is sent in parallel.
+        :param commands: list of command arguments, each starting with the encoded command name
+        :param transaction: whether to wrap the commands in MULTI/EXEC so that the server runs them atomically
+        :param raise_on_error: whether to raise a CommandError for the first command that failed
+        :param conn: connection to send every command on, instead of the socket pools
+        :return: list of replies, one per command
+        :raises WatchError if the transaction did not run because a key it watched was modified
+        """
+        if self._near_cache is not None:
+            self._invalidate_locally(self._near_cache, commands)
+        groups = {self._socket_pool: list(range(len(commands)))}
+        if self._cluster and conn is None:
+            if self._slot_table is None:
+                self.refresh_slots()
+            groups = {}
+            for position, args in enumerate(commands):
+                keys = command_keys(args[0], args[1:])
+                pool = self._node_pool(keys[0]) if keys else self._socket_pool
+                groups.setdefault(pool, []).append(position)
+            if transaction and len(groups) > 1:
+                raise CommandError('CROSSSLOT keys of a transaction do not hash to the same worker')
+
+        requests = []
+        for pool, group in groups.items():
+            batch = [commands[i] for i in group]
+            if transaction:
+                batch = [(b'MULTI',), *batch, (b'EXEC',)]
+            requests.append((pool, batch))
+        if conn is not None:
+            batches = [self._exchange(conn, requests[0][1])]
+        elif len(requests) == 1:
+            batches = [self._send_batch(*requests[0])]
+        else:
+            greenlets = [gevent.spawn(self._send_batch, pool, batch) for pool, batch in requests]
+            gevent.joinall(greenlets, raise_error=True)
+            batches = [greenlet.value for greenlet in greenlets]
+
+        if transaction:
+            replies = batches[0][-1]
+            if replies is None:
+                raise WatchError('transaction aborted, a watched key was modified')
+            if isinstance(replies, Error):
+                logger.error(f"Transaction failed {replies.message}")
+                raise CommandError(replies.message)
+        else:
+            replies = [None] * len(commands)
+            for group, batch in zip(groups.values(), batches):
+                for position, reply in zip(group, batch):
+                    replies[position] = reply
+        if raise_on_error:
+            for resp in replies:
+                if isinstance(resp, Error):
+                    logger.error(f"Received an error {resp.message}")
+                    raise CommandError(resp.message)
+        return replies
+
+    def pipeline(self, transaction: bool = False, raise_on_error: bool = True) -> 'Pipeline':
+        """
+        Creates a pipeline that buffers commands and sends them to the server in one batch
+        :param transaction: whether the server should run the buffered commands atomically
+        :param raise_on_error: whether to raise a CommandError for the first command that failed
+        :return: Pipeline
+        """
+        return Pipeline(self, transaction=transaction, raise_on_error=raise_on_error)
+
+    @staticmethod
+    def _scan_options(match: Optional[str], count: Optional[int]) -> List[Any]:
+        """
+        Builds the MATCH and COUNT options of a scan command
+        :param match: glob pattern or None
+        :param count: number of elements or None
+        :return: list of options
+        """
+        options: List[Any] = []
+        if match is not None:
+            options.extend(('MATCH', match))
+        if count is not None:
+            options.extend(('COUNT', count))
+        return options
+
+    def _scan(self, execute, command: bytes, key: Optional[Any], match: Optional[str], count: Optional[int]):
+        """
+        Runs an iteration to completion, yielding the batches of every call
+        :param execute: executes a command on the server being iterated
+        :param command: scan command
+        :param key: key of the collection to iterate or None to iterate the keys
+        :param match: glob pattern to filter elements with
+        :param count: number of elements the server walks per call
+        """
+        options = self._scan_options(match, count)
+        args = (command,) if key is None else (command, key)
+        cursor = 0
+        while True:
+            cursor, batch = execute(*args, cursor, *options)
+            yield batch
+            if not cursor:
+                break
+
+    def scan_iter(self, match: Optional[str] = None, count: Optional[int] = None):
+        """
+        Lazily iterates over the keys, fetching them from the server a batch at a time. With cluster set, the keys of
+        every worker are iterated one worker after the other
+        :param match: glob pattern to filter the keys with
+        :param count: number of keys the server walks per call
+        :return: generator of keys
+        """
+        if self._cluster:
+            if self._slot_table is None:
+                self.refresh_slots()
+            executors = [lambda *args, pool=pool: self._execute(pool, args) for pool in self._node_pools.values()]
+        else:
+            executors = [self.execute]
+        for execute in executors:
+            for batch in self._scan(execute, b'SCAN', None, match, count):
+                yield from batch
+
+    def hscan_iter(self, key, match: Optional[str] = None, count: Optional[int] = None):
+        """
+        Lazily iterates over the fields of a hash
+        :param key: Key
+        :param match: glob pattern to filter the fields with
+        :param count: number of fields the server walks per call
+        :return: generator of field and value tuples
+        """
+        for batch in self._scan(self.execute, b'HSCAN', key, match, count):
+            yield from batch.items()
+
+    def sscan_iter(self, key, match: Optional[str] = None, count: Optional[int] = None):
+        """
+        Lazily iterates over the members of a set
+        :param key: Key
+        :param match: glob pattern to filter the members with
+        :param count: number of members the server walks per call
+        :return: generator of members
+        """
+        for batch in self._scan(self.execute, b'SSCAN', key, match, count):
+            yield from batch
+
+    def lscan_iter(self, key, match: Optional[str] = None, count: Optional[int] = None):
+        """
+        Lazily iterates over the values of a queue
+        :param key: Key
+        :param match: glob pattern to filter the values with
+        :param count: number of values the server walks per call
+        :return: generator of values
+        """
+        for batch in self._scan(self.execute, b'LSCAN', key, match, count):
+            yield from batch
+
+    def pubsub(self) -> 'PubSub':
+        """
+        Opens a connection of its own to subscribe to channels on
+        :return: PubSub
+        """
+        return PubSub(self._host, self._port)
+
+    def close(self):
+        """
+        Closes client connection
+        """
+        self.execute(b'QUIT')
+        self._socket_pool.close_all()
+        for socket_pool in self._node_pools.values():
+            socket_pool.close_all()
+        if self._invalidations is not None:
+            self._invalidations.close()
+
+    @property
+    def pool_stats(self) -> PoolStats:
+        """Returns the statistics of the pool of connections to the server the client is pointed at"""
+        return self._socket_pool.stats
+
+
+class ShardedClient(PooledClient):
+    """
+    Client spreading the keys over independent KVault servers with a consistent hash ring:
+
+        client = ShardedClient([('10.0.0.1', 31337), ('10.0.0.2', 31337), ('10.0.0.3', 31337)])
+        client.set('k1', 'v1')
+        client.mget('k1', 'k2', 'k3')
+
+    Every server is placed on the ring at virtual_nodes points and every command is sent to the server owning its keys.
+    Adding a server with add_node only moves the keys falling just before its points, about 1/N of them, which are not
+    copied over. Keys sharing a hash tag, e.g. {user1}.name and {user1}.email, are owned by the same server.
+
+    MGET, MPOP, MDELETE, MSET and MSETEX are split per server, the parts are sent in parallel and their replies merged
+    in the order of the keys. Other commands whose keys are owned by several servers are refused, LEN, FLUSH and
+    FLUSHALL run on every server and commands without keys are run on every server with execute_all.
+    """
+
+    # pylint: disable-next=too-many-arguments
+    def __init__(self, nodes: List[Tuple[str, int]], virtual_nodes=VIRTUAL_NODES, pool_max_age=60, serializer='resp',
+                 pool_max_size=POOL_MAX_SIZE, pool_timeout=None):
+        super().__init__(serializer)
+        self._pool_max_age = pool_max_age
+        self._pool_max_size = pool_max_size
+        self._pool_timeout = pool_timeout
+        self._ring = HashRing(virtual_nodes=virtual_nodes)
+        self._pools: Dict[str, SocketPool] = {}
+        for host, port in nodes:
+            self.add_node(host, port)
+
+    def add_node(self, host: str, port: int):
+        """
+        Adds a server, which takes over about 1/N of the keys
+        :param host: host of the server
+        :param port: port of the server
+        """
+        name = f'{host}:{port}'
+        if name in self._pools:
+            return
+        socket_pool = SocketPool(host, port, self._pool_max_age, self._pool_max_size, self._pool_timeout)
+        if self._packed:
+            socket_pool.on_connect = self._hello
+        self._pools[name] = socket_pool
+        self._ring.add(name)
+
+    def remove_node(self, host: str, port: int):
+        """
+        Removes a server, its keys are owned by the servers following its points from then on
+        :param host: host of the server
+        :param port: port of the server
+        """
+        name = f'{host}:{port}'
+        self._ring.remove(name)
+        self._pools.pop(name).close_all()
+
+    @property
+    def nodes(self) -> List[Tuple[str, int]]:
+        """Returns the hosts and ports of the servers"""
+        return [(pool.host, pool.port) for pool in self._pools.values()]
+
+    def node_for(self, key) -> Tuple[str, int]:
+        """
+        Returns the server owning a key
+        :param key: Key
+        :return: host and port of the server
+        """
+        pool = self._node_pool(key)
+        return pool.host, pool.port
+
+    def _node_pool(self, key) -> SocketPool:
+        """
+        Returns the pool of connections to the server owning a key
+        :param key: Key
+        :return: socket pool
+        """
+        return self._pools[self._ring.get(key)]
+
+    def execute(self, *args):
+        """
+        Executes a given command on the server owning its keys
+        :param args: Arguments for command
+        :return: response from executed command
+        :raises CommandError if the command has no key or its keys are owned by several servers
+        """
+        command = args[0]
+        if command in (b'LEN', b'FLUSH', b'FLUSHALL'):
+            return sum(self._gather([(pool, args) for pool in self._pools.values()]))
+        keys = command_keys(command, args[1:])
+        if not keys:
+            raise CommandError(f'{command} has no key to pick a server with, run it with execute_all')
+        groups: Dict[SocketPool, List[int]] = {}
+        for position, key in enumerate(keys):
+            groups.setdefault(self._node_pool(key), []).append(position)
+        if len(groups) == 1:
+            return self._execute(next(iter(groups)), args)
+        if command in FAN_OUT_COMMANDS:
+            return self._fan_out(args, keys, groups)
+        raise CommandError(f'CROSSSLOT keys of {command} do not hash to the same server')
+
+    def execute_all(self, *args) -> Dict[Tuple[str, int], Any]:
+        """
+        Executes a command on every server in parallel
+        :param args: Arguments for command
+        :return: mapping of the host and port of every server to its response
+        """
+        pools = list(self._pools.values())
+        replies = self._gather([(pool, args) for pool in pools])
+        return {(pool.host, pool.port): reply for pool, reply in zip(pools, replies)}
+
+    def close(self):
+        """
+        Closes the connections to every server
+        """
+        for socket_pool in self._pools.values():
+            socket_pool.close_all()
+
+    @property
+    def pool_stats(self) -> Dict[Tuple[str, int], PoolStats]:
+        """Returns the statistics of the pools of connections to every server"""
+        return {(pool.host, pool.port): pool.stats for pool in self._pools.values()}
+
+
+class Pipeline(ClientCommands):
+    """
+    Buffers commands issued on it and sends them to the server in one batch when committed. Can be used as a context
+    manager, in which case the buffered commands are committed on exit:
+
+        with client.pipeline() as pipe:
+            pipe.set('k1', 'v1')
+            pipe.get('k1')
+        pipe.results  # [1, 'v1']
+
+    Keys can be watched for check-and-set. Once watch is called the pipeline holds a connection of its own and runs
+    commands right away, so that the watched values can be read, until multi starts buffering the transaction. The
+    transaction then only runs if none of the watched keys was modified meanwhile, otherwise commit raises WatchError:
+
+        pipe = client.pipeline()
+        pipe.watch('balance')
+        balance = pipe.get('balance')
+        pipe.multi()
+        pipe.set('balance', balance - 10)
+        pipe.commit()
+    """
+
+    def __init__(self, client: Client, transaction: bool = False, raise_on_error: bool = True):
+        self._client = client
+        self._transaction = transaction
+        self._raise_on_error = raise_on_error
+        self._commands: List[Tuple[Any, ...]] = []
+        self.results: Optional[List[Any]] = None
+        # connection holding the watched keys, commands run right away on it until multi is called
+        self._conn = None
+        self._immediate = False
+
+    def execute(self, *args):
+        """
+        Buffers a command, or runs it right away after watch
+        :param args: Arguments for command
+        :return: the pipeline, so that commands can be chained, or the response of the command after watch
+        """
+        if self._immediate:
+            return self._run(args)
+        self._commands.append(args)
+        return self
+
+    def _run(self, args):
+        """
+        Runs a command on the connection of the pipeline
+        :param args: Arguments for command
+        :return: response from executed command
+        """
+        try:
+            # pylint: disable-next=protected-access
+            (resp,) = self._client._exchange(self._conn, [args])
+        except Exception as exc:
+            self.reset()
+            raise ServerDisconnect('server went away') from exc
+        if isinstance(resp, Error):
+            raise CommandError(resp.message)
+        return resp
+
+    def watch(self, *keys):
+        """
+        Watches keys for the transaction of the pipeline
+        :param keys: keys to watch
+        :return: 1 once the keys are watched
+        """
+        if self._conn is None:
+            self._conn = self._client.connect(keys[0] if keys else None)
+        self._immediate = True
+        return self._run((b'WATCH', *keys))
+
+    def unwatch(self):
+        """
+        Unwatches the keys watched by the pipeline
+        :return: 1 once the keys are unwatched
+        """
+        if self._conn is None:
+            return 1
+        return self._run((b'UNWATCH',))
+
+    def multi(self):
+        """
+        Starts buffering the transaction after watch
+        """
+        self._immediate = False
+        self._transaction = True
+
+    def reset(self):
+        """
+        Drops the buffered commands and closes the connection holding the watched keys, which unwatches them
+        """
+        self._commands = []
+        self._immediate = False
+        if self._conn is not None:
+            conn, self._conn = self._conn, None
+            try:
+                conn.close()
+            except OSError:
+                pass
+
+    def commit(self) -> List[Any]:
+        """
+        Sends the buffered commands to the server and reads their replies
+        :return: list of replies in the order the commands were buffered
+        :raises WatchError if the transaction did not run because a watched key was modified
+        """
+        commands, self._commands = self._commands, []
+        try:
+            if not commands:
+                self.results = []
+            else:
+                self.results = self._client.execute_pipeline(
+                    commands, transaction=self._transaction, raise_on_error=self._raise_on_error, conn=self._conn
+                )
+        finally:
+            self.reset()
+        return self.results
+
+    def __len__(self):
+        return len(self._commands)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        if exc_type is None:
+            self.commit()
+        else:
+            self.reset()
+
+
+class PubSub:
+    """
+    Subscriptions to channels and channel patterns. Once subscribed, the connection only receives messages, so it is
+    not shared with the socket pool of the client:
+
+        pubsub = client.pubsub()
+        pubsub.subscribe('news')
+        for message in pubsub.listen():
+            message  # {'type': 'message', 'pattern': None, 'channel': 'news', 'data': 'hello'}
+
+    Confirmations of (un)subscribing are received as messages too, with the number of subscriptions left as data.
+    """
+
+    def __init__(self, host='127.0.0.1', port=31337, read_size: int = 65536):
+        self._conn = socket.create_connection((host, port))
+        self._conn.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+        self._protocol = ProtocolHandler()
+        self._parser = RespParser()
+        self._read_size = read_size
+        self._pending: Deque[Dict[str, Any]] = deque()
+
+    def execute(self, *args):
+        """
+        Sends a command, its confirmations are received with the messages
+        :param args: Arguments for command
+        """
+        self._conn.sendall(self._protocol.encode(args))
+
+    def subscribe(self, *channels):
+        """
+        Subscribes to channels
+        :param channels: channels to subscribe to
+        """
+        self.execute(b'SUBSCRIBE', *channels)
+
+    def psubscribe(self, *patterns):
+        """
+        Subscribes to channel patterns
+        :param patterns: glob patterns to subscribe to
+        """
+        self.execute(b'PSUBSCRIBE', *patterns)
+
+    def unsubscribe(self, *channels):
+        """
+        Unsubscribes from channels
+        :param channels: channels to unsubscribe from, all of them if none is given
+        """
+        self.execute(b'UNSUBSCRIBE', *channels)
+
+    def punsubscribe(self, *patterns):
+        """
+        Unsubscribes from channel patterns
+        :param patterns: patterns to unsubscribe from, all of them if none is given
+        """
+        self.execute(b'PUNSUBSCRIBE', *patterns)
+
+    def client_id(self) -> int:
+        """
+        Returns the id of the connection, which other connections redirect their invalidations to. Only available
+        before subscribing
+        :return: id of the connection
+        """
+        self.execute(b'CLIENT', b'ID')
+        return self._read(None)
+
+    def _read(self, timeout: Optional[float]) -> Any:
+        """
+        Reads the next reply
+        :param timeout: seconds to wait for a reply, None to wait until one is received
+        :return: the reply, INCOMPLETE if none was received in time
+        :raises ServerDisconnect if the server closed the connection
+        :raises CommandError if the reply is an error
+        """
+        reply = self._parser.gets()
+        while reply is INCOMPLETE:
+            self._conn.settimeout(timeout)
+            try:
+                data = self._conn.recv(self._read_size)
+            except socket.timeout:
+                return INCOMPLETE
+            if not data:
+                raise ServerDisconnect('server went away')
+            self._parser.feed(data)
+            reply = self._parser.gets()
+        if isinstance(reply, Error):
+            raise CommandError(reply.message)
+        return reply
+
+    def get_message(self, timeout: Optional[float] = 0.0) -> Optional[Dict[str, Any]]:
+        """
+        Returns the next message
+        :param timeout: seconds to wait for a message, None to wait until one is received
+        :return: the message, None if none was received in time
+        :raises ServerDisconnect if the server closed the connection
+        :raises CommandError if the server rejected a command
+        """
+        while not self._pending:
+            reply = self._read(timeout)
+            if reply is INCOMPLETE:
+                return None
+            # confirmations of a command come as one list, with an entry per channel or pattern
+            for message in (reply if not reply or isinstance(reply[0], list) else [reply]):
+                self._pending.append(self._message(message))
+        return self._pending.popleft()
+
+    @staticmethod
+    def _message(reply: List[Any]) -> Dict[str, Any]:
+        """
+        Turns a pushed reply into a message
+        :param reply: message, pmessage or a confirmation, followed by its fields
+        :return: the message
+        """
+        kind = decode(reply[0])
+        if kind == 'pmessage':
+            return {'type': kind, 'pattern': reply[1], 'channel': reply[2], 'data': reply[3]}
+        return {'type': kind, 'pattern': None, 'channel': reply[1], 'data': reply[2]}
+
+    def listen(self):
+        """
+        Yields the messages as they are received
+        """
+        while True:
+            yield self.get_message(timeout=None)
+
+    def close(self):
+        """
+        Closes the connection, which removes all its subscriptions
+        """
+        self._conn.close()
+
+
+
+class AsyncClientProtocol(asyncio.Protocol):
+    """
+    Connection of an AsyncClient. Requests queued during an iteration of the event loop are written with a single write
+    once it ends. Replies are parsed as they are received and handed to the callers waiting for them, in the order the
+    requests were sent
+    """
+
+    def __init__(self):
+        self.transport: Optional[asyncio.Transport] = None
+        # requests queued during the current iteration of the event loop
+        self.buffer = BytesIO()
+        self._parser = RespParser()
+        self._pending: Deque[asyncio.Future] = deque()
+        self._flush_handle: Optional[asyncio.Handle] = None
+
+    def connection_made(self, transport):
+        """
+        Keeps the transport to write the requests with
+        :param transport: transport of the connection
+        """
+        self.transport = transport
+
+    def queue(self) -> asyncio.Future:
+        """
+        Queues the request written last to the buffer
+        :return: future of its reply
+        """
+        loop = asyncio.get_running_loop()
+        future = loop.create_future()
+        if self.transport is None:
+            future.set_exception(ServerDisconnect('server went away'))
+            return future
+        self._pending.append(future)
+        if self._flush_handle is None:
+            self._flush_handle = loop.call_soon(self._flush)
+        return future
+
+    def _flush(self):
+        """
+        Writes the queued requests
+        """
+        self._flush_handle = None
+        data, self.buffer = self.buffer.getvalue(), BytesIO()
+        if self.transport is not None:
+            self.transport.write(data)
+
+    def data_received(self, data: bytes):
+        """
+        Hands the complete replies in the receive buffer to the callers waiting for them. Callers that stopped waiting
+        have their reply dropped
+        :param data: bytes received from the server
+        """
+        self._parser.feed(data)
+        reply = self._parser.gets()
+        while reply is not INCOMPLETE:
+            future = self._pending.popleft()
+            if not future.done():
+                future.set_result(reply)
+            reply = self._parser.gets()
+
+    def connection_lost(self, exc):
+        """
+        Fails the callers still waiting for a reply
+        :param exc: error that closed the connection, None if it was closed normally
+        """
+        self.transport = None
+        while self._pending:
+            future = self._pending.popleft()
+            if not future.done():
+                future.set_exception(ServerDisconnect('server went away'))
+
+
+class AsyncClient(ClientCommands):
+    """
+    KVault client for asyncio. Commands are coroutines with the same names and arguments as the ones of Client:
+
+        client = AsyncClient()
+        await client.set('k1', 'v1')
+        values = await asyncio.gather(*(client.get('k%d' % i) for i in range(100)))
+
+    Every caller shares a single connection, opened on the first command. The requests issued during an iteration of
+    the event loop are written with a single write once it ends, and the replies are handed to the callers in the order
+    their requests were sent. A blocking command holds up the commands sent after it until it returns, and commands
+    acting on the connection itself, such as MULTI, WATCH or SUBSCRIBE, are not supported as every caller shares it.
+    """
+
+    def __init__(self, host='127.0.0.1', port=31337, serializer='resp'):
+        if serializer not in ('resp', 'msgpack'):
+            raise ValueError(f'unsupported serializer {serializer}, expected resp or msgpack')
+        self._host = host
+        self._port = port
+        self._packed = serializer == 'msgpack'
+        self._protocol = ProtocolHandler()
+        self._connection: Optional[AsyncClientProtocol] = None
+        self._connecting: Optional[asyncio.Future] = None
+
+    # the commands of ClientCommands return coroutines on the asyncio client
+    # pylint: disable-next=invalid-overridden-method
+    async def execute(self, *args):
+        """
+        Executes a given command
+        :param args: Arguments for command
+        :return: response from executed command
+        :raises CommandError if the server replied with an error
+        :raises ServerDisconnect if the connection was lost before the reply was received
+        """
+        if self._connection is None or self._connection.transport is None:
+            await self._connect()
+        resp = await self._send(self._connection, args)
+        if isinstance(resp, Error):
+            raise CommandError(resp.message)
+        return resp
+
+    def _send(self, connection: AsyncClientProtocol, args) -> asyncio.Future:
+        """
+        Queues a request on a connection
+        :param connection: the connection
+        :param args: Arguments for command
+        :return: future of the reply
+        """
+        self._protocol.write_request(connection.buffer, args, self._packed)
+        return connection.queue()
+
+    async def _connect(self):
+        """
+        Opens the connection, callers arriving while it is being opened wait for it
+        """
+        if self._connecting is not None:
+            await asyncio.shield(self._connecting)
+            return
+        loop = asyncio.get_running_loop()
+        self._connecting = connecting = loop.create_future()
+        try:
+            _, connection = await loop.create_connection(AsyncClientProtocol, self._host, self._port)
+            if self._packed:
+                resp = await self._send(connection, (b'HELLO', b'MSGPACK'))
+                if isinstance(resp, Error):
+                    connection.transport.close()
+                    raise CommandError(resp.message)
+            self._connection = connection
+            connecting.set_result(None)
+        except BaseException as exc:
+            connecting.set_exception(exc)
+            # retrieved, so that the loop does not report it when no other caller waited for the connection
+            connecting.exception()
+            raise
+        finally:
+            self._connecting = None
+
+    async def close(self):
+        """
+        Closes the connection, the callers still waiting for a reply fail with ServerDisconnect
+        """
+        if self._connection is not None and self._connection.transport is not None:
+            self._connection.transport.close()
+        self._connection = None
+
+    async def __aenter__(self) -> 'AsyncClient':
+        return self
+
+    async def __aexit__(self, exc_type, exc_val, exc_tb):
+        await self.close()
@@ -3,7 +3,13 @@ Entry point to server
 """
 import argparse
 import importlib
-from .queue_server import QueueServer
+import os
+from typing import Tuple
+from .cluster import cluster_nodes
+from .append_only_log import FSYNC_POLICIES
+from .eviction import EVICTION_POLICIES, parse_memory
+from .queue_server import QueueServer, ServerConfig, ENGINES
+from .replication import REPL_BACKLOG_SIZE
 from .infra.logger import logger
 
 
@@ -37,6 +43,92 @@ def get_args_parser():
     parser.add_argument(
         "-p", "--port", default=31337, dest="port", help="Port to listen on.", type=int
     )
+    parser.add_argument(
+        "-b",
+        "--max-batch-size",
+        default=256,
+        dest="max_batch_size",
+        help="Maximum number of pipelined requests of a connection handled per write.",
+        type=int,
+    )
+    parser.add_argument(
+        "-E",
+        "--engine",
+        choices=ENGINES,
+        default="gevent",
+        dest="engine",
+        help="Engine serving client connections.",
+    )
+    parser.add_argument(
+        "-w",
+        "--workers",
+        default=1,
+        dest="workers",
+        help="Number of worker processes, each owning a range of hash slots and listening on consecutive ports.",
+        type=int,
+    )
+    parser.add_argument(
+        "-a",
+        "--append-only-file",
+        dest="append_only_file",
+        help="Append only log of write requests, replayed on startup. Workers append their port to the file name.",
+    )
+    parser.add_argument(
+        "--fsync",
+        choices=FSYNC_POLICIES,
+        default="everysec",
+        dest="fsync",
+        help="When the append only log is synced to disk.",
+    )
+    parser.add_argument(
+        "--rewrite-min-size",
+        default=64 * 1024 * 1024,
+        dest="rewrite_min_size",
+        help="Minimum size in bytes of the append only log before it is rewritten.",
+        type=int,
+    )
+    parser.add_argument(
+        "--maxmemory",
+        default=0,
+        dest="maxmemory",
+        help="Maximum memory used by keys before keys are evicted, e.g. 100mb. 0 for no limit.",
+        type=parse_memory,
+    )
+    parser.add_argument(
+        "--maxmemory-policy",
+        choices=EVICTION_POLICIES,
+        default="allkeys-lru",
+        dest="maxmemory_policy",
+        help="Keys evicted once the maximum memory is reached.",
+    )
+    parser.add_argument(
+        "--maxmemory-samples",
+        default=5,
+        dest="maxmemory_samples",
+        help="Number of keys sampled to pick a key to evict.",
+        type=int,
+    )
+    parser.add_argument(
+        "--response-cache-size",
+        default="16mb",
+        dest="response_cache_size",
+        help="Maximum memory used by the serialized GET replies of hot keys, e.g. 16mb. 0 to disable.",
+        type=parse_memory,
+    )
+    parser.add_argument(
+        "--replicaof",
+        dest="replica_of",
+        metavar="HOST:PORT",
+        help="Primary to replicate, the server then only serves reads.",
+        type=parse_address,
+    )
+    parser.add_argument(
+        "--repl-backlog-size",
+        default=REPL_BACKLOG_SIZE,
+        dest="repl_backlog_size",
+        help="Memory used by the writes kept for replicas to resume from after a disconnect, e.g. 1mb.",
+        type=parse_memory,
+    )
     parser.add_argument("-l", "--log-file", dest="log_file", help="Log file.")
     parser.add_argument(
         "-x",
@@ -48,6 +140,17 @@ def get_args_parser():
     return parser
 
 
+def parse_address(address: str) -> Tuple[str, int]:
+    """
+    Parses the address of a server
+    :param address: address formatted host:port
+    :return: tuple of the host and port
+    :raises ValueError if the port is not a number
+    """
+    host, _, port = address.rpartition(":")
+    return host, int(port)
+
+
 def load_extensions(server, extensions):
     """
     Loads extensions that will be added and initialized with the server.
@@ -73,30 +176,95 @@ def load_extensions(server, extensions):
             logger.info(f"Loaded {extension} extension")
 
 
-if __name__ == "__main__":
-    args = get_args_parser().parse_args()
+def create_server(options, port, cluster=None) -> QueueServer:
+    """
+    Creates a server from the parsed command line arguments
+    :param options: parsed arguments
+    :param port: port the server listens on
+    :param cluster: nodes sharing the keyspace when running several workers
+    :return: Server instance
+    """
+    if options.engine == "gevent":
+        from gevent import monkey  # pylint: disable=import-outside-toplevel
 
-    from gevent import monkey
+        monkey.patch_all()
 
-    monkey.patch_all()
+    append_only_file = options.append_only_file
+    if append_only_file and cluster:
+        append_only_file = f"{append_only_file}.{port}"
 
     # configure_logger(options)
-    queue_server = QueueServer(
-        host=args.host, port=args.port, max_clients=args.max_clients
+    config = ServerConfig(
+        max_batch_size=options.max_batch_size,
+        engine=options.engine,
+        cluster=cluster,
+        append_only_file=append_only_file,
+        fsync=options.fsync,
+        rewrite_min_size=options.rewrite_min_size,
+        maxmemory=options.maxmemory,
+        maxmemory_policy=options.maxmemory_policy,
+        maxmemory_samples=options.maxmemory_samples,
+        response_cache_size=options.response_cache_size,
+        replica_of=options.replica_of,
+        repl_backlog_size=options.repl_backlog_size,
     )
-    load_extensions(queue_server, args.extensions or ())
+    queue_server = QueueServer(host=options.host, port=port, max_clients=options.max_clients, config=config)
+    load_extensions(queue_server, options.extensions or ())
+    return queue_server
+
+
+def run_workers(options):
+    """
+    Forks a worker process for every range of hash slots and waits for the workers to exit. Each worker listens on its
+    own port, starting from the port in the arguments.
+    :param options: parsed arguments
+    """
+    nodes = cluster_nodes(options.host, options.port, options.workers)
+    pids = []
+    for node in nodes:
+        pid = os.fork()
+        if pid == 0:
+            try:
+                create_server(options, node.port, nodes).run()
+            except KeyboardInterrupt:
+                pass
+            finally:
+                # pylint: disable-next=protected-access
+                os._exit(0)
+        logger.info(f"Started worker {pid} for slots {node.start}-{node.end} on port {node.port}")
+        pids.append(pid)
+
+    for pid in pids:
+        try:
+            os.waitpid(pid, 0)
+        except KeyboardInterrupt:
+            # the workers receive the interrupt as well, keep waiting for them to exit
+            os.waitpid(pid, 0)
+
+
+if __name__ == "__main__":
+    args = get_args_parser().parse_args()
+    ports = (
+        f"{args.port}-{args.port + args.workers - 1}"
+        if args.workers > 1
+        else str(args.port)
+    )
+
     print("\x1b[32m  .--.")
     print(
         # pylint: disable-next=consider-using-f-string
         " /( \x1b[34m@\x1b[33m >\x1b[32m    ,-.  "
         "\x1b[1;32mKVault "
-        "\x1b[1;33m%s:%s\x1b[32m" % (args.host, args.port)
+        "\x1b[1;33m%s:%s\x1b[32m" % (args.host, ports)
     )
     print("/ ' .'--._/  /")
     print(":   ,    , .'")
     print("'. (___.'_/")
     print(" \x1b[33m((\x1b[32m-\x1b[33m((\x1b[32m-''\x1b[0m")
     try:
-        queue_server.run()
+        if args.workers > 1:
+            run_workers(args)
+        else:
+            create_server(args, args.port).run()
     except KeyboardInterrupt:
         print("\x1b[1;31mshutting down\x1b[0m")
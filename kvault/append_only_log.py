@@ -0,0 +1,241 @@
+"""
+Append only log of the requests that modified the store. Requests are serialized with the protocol of the server and
+buffered while a batch of requests is handled, then written with a single write once the batch completes. How often
+the log is synced to disk is set by the fsync policy:
+
+    always   - after every batch, before the responses are sent
+    everysec - at most once per second from a timer, a crash loses up to a second of writes
+    no       - never, the operating system decides when the data reaches the disk
+
+Once the log has grown past a size threshold it is rewritten in the background: a forked child writes a snapshot of
+the store (see persistence) to a new file, while the parent keeps appending to the current log and buffers the requests
+received since the fork. When the child is done the buffered requests are appended to the new file, which then
+replaces the log. A log therefore starts with an optional snapshot followed by requests.
+"""
+from typing import Any, Callable, Dict, Optional
+from dataclasses import dataclass
+import os
+import time
+from .infra.logger import logger
+from .persistence import MAGIC, BackgroundSaver, SnapshotError, load_snapshot
+from .protocol_handler import ProtocolHandler
+from .resp_parser import RespParser, INCOMPLETE
+
+FSYNC_POLICIES = ("always", "everysec", "no")
+
+
+@dataclass
+class LogStats:
+    """
+    Contains the statistics of the append only log
+    :cvar size is the current size of the log in bytes
+    :cvar base_size is the size of the log after the last rewrite or when it was loaded
+    :cvar rewrites is the number of completed rewrites
+    :cvar last_rewrite_status is the status of the last rewrite, ok or err
+    :cvar last_fsync is the timestamp of the last sync of the log to disk
+    """
+
+    size: int = 0
+    base_size: int = 0
+    rewrites: int = 0
+    last_rewrite_status: str = "ok"
+    last_fsync: float = 0.0
+
+
+# pylint: disable-next=too-many-instance-attributes
+class AppendOnlyLog:
+    """
+    Append only log of write requests
+    """
+
+    def __init__(
+        self,
+        filename: str,
+        fsync: str = "everysec",
+        rewrite_min_size: int = 64 * 1024 * 1024,
+        rewrite_percentage: int = 100,
+    ):
+        """
+        Creates an append only log
+        :param filename: file name of the log
+        :param fsync: fsync policy, one of always, everysec or no
+        :param rewrite_min_size: minimum size in bytes of the log before it is rewritten
+        :param rewrite_percentage: growth in percent of the log since the last rewrite that triggers a new rewrite
+        :raises ValueError if the fsync policy is not supported
+        """
+        if fsync not in FSYNC_POLICIES:
+            raise ValueError(f"Unsupported fsync policy {fsync}. Supported policies: {', '.join(FSYNC_POLICIES)}")
+        self.filename = filename
+        self.fsync = fsync
+        self.rewrite_min_size = rewrite_min_size
+        self.rewrite_percentage = rewrite_percentage
+        self.stats = LogStats()
+        self._protocol = ProtocolHandler()
+        self._file = None
+        self._buffer = bytearray()
+        self._dirty = False
+        self._rewriter = BackgroundSaver()
+        self._rewrite_buffer: Optional[bytearray] = None
+
+    @property
+    def rewrite_in_progress(self) -> bool:
+        """Returns True while the log is being rewritten"""
+        return self._rewriter.in_progress
+
+    def load(self, set_state: Callable[[Dict[str, Any]], None], replay: Callable[[Any], Any]) -> int:
+        """
+        Loads the log, restoring the snapshot it starts with and replaying the requests after it. A request that was
+        only partly written when the server stopped is cut off the log.
+        :param set_state: called with the state of the snapshot the log starts with
+        :param replay: called with every request of the log
+        :return: number of requests replayed
+        """
+        if not os.path.exists(self.filename):
+            return 0
+
+        replayed = 0
+        with open(self.filename, "rb") as file_handle:
+            if file_handle.read(len(MAGIC)) == MAGIC:
+                file_handle.seek(0)
+                try:
+                    set_state(load_snapshot(file_handle))
+                except SnapshotError as error:
+                    raise SnapshotError(f"Could not load {self.filename}: {error}") from error
+            else:
+                file_handle.seek(0)
+            offset = file_handle.tell()
+
+            parser = RespParser()
+            for chunk in iter(lambda: file_handle.read(65536), b""):
+                parser.feed(chunk)
+                offset += len(chunk)
+                request = parser.gets()
+                while request is not INCOMPLETE:
+                    replay(request)
+                    replayed += 1
+                    request = parser.gets()
+
+        if parser:
+            valid_size = offset - len(parser)
+            logger.warning(f"Truncating incomplete request at the end of {self.filename} at {valid_size} bytes")
+            os.truncate(self.filename, valid_size)
+        return replayed
+
+    def open(self):
+        """
+        Opens the log for appending
+        """
+        # pylint: disable-next=consider-using-with
+        self._file = open(self.filename, "ab")
+        self.stats.size = self.stats.base_size = self._file.tell()
+
+    def append(self, request: Any):
+        """
+        Buffers a request until the batch it is part of completes
+        :param request: request as a list of the command and its arguments
+        """
+        data = self._protocol.encode(request)
+        self._buffer += data
+        if self._rewrite_buffer is not None:
+            self._rewrite_buffer += data
+
+    def flush(self):
+        """
+        Writes the buffered requests to the log, syncing it to disk if the fsync policy is always
+        """
+        if not self._buffer:
+            return
+        self._file.write(self._buffer)
+        self._file.flush()
+        self.stats.size += len(self._buffer)
+        self._buffer.clear()
+        if self.fsync == "always":
+            self.sync()
+        else:
+            self._dirty = True
+
+    def sync(self):
+        """
+        Syncs the log to disk
+        """
+        os.fsync(self._file.fileno())
+        self._dirty = False
+        self.stats.last_fsync = time.time()
+
+    def tick(self, get_state: Callable[[], Dict[str, Any]]):
+        """
+        Runs the periodic work of the log: syncs it once a second for the everysec policy, completes a finished
+        rewrite and starts a new one once the log has grown enough
+        :param get_state: returns the state of the store, used to start a rewrite
+        """
+        self.flush()
+        if self.fsync == "everysec" and self._dirty and time.time() - self.stats.last_fsync >= 1:
+            self.sync()
+        self._rewriter.poll()
+        if self.needs_rewrite():
+            self.rewrite(get_state())
+
+    def needs_rewrite(self) -> bool:
+        """
+        Checks whether the log has grown past the rewrite thresholds
+        :return: True if the log should be rewritten
+        """
+        if self.rewrite_in_progress or self.stats.size < self.rewrite_min_size:
+            return False
+        growth = (self.stats.size - self.stats.base_size) * 100 / max(self.stats.base_size, 1)
+        return growth >= self.rewrite_percentage
+
+    def rewrite(self, state: Dict[str, Any]) -> bool:
+        """
+        Starts rewriting the log in the background
+        :param state: state of the store as returned by Commands._get_state
+        :return: False if a rewrite is already in progress
+        """
+        if self.rewrite_in_progress:
+            return False
+        self.flush()
+        self._rewrite_buffer = bytearray()
+        if not self._rewriter.start(self._rewrite_filename, state, on_done=self._finish_rewrite):
+            self._rewrite_buffer = None
+            return False
+        logger.info(f"Rewriting append only log {self.filename}")
+        return True
+
+    @property
+    def _rewrite_filename(self) -> str:
+        return f"{self.filename}.rewrite"
+
+    def _finish_rewrite(self, succeeded: bool):
+        """
+        Appends the requests received during a rewrite to the new log and replaces the current log with it
+        :param succeeded: whether the snapshot of the rewrite was written
+        """
+        rewrite_buffer, self._rewrite_buffer = self._rewrite_buffer, None
+        if not succeeded:
+            self.stats.last_rewrite_status = "err"
+            logger.error(f"Rewriting append only log {self.filename} failed")
+            return
+
+        self.flush()
+        with open(self._rewrite_filename, "ab") as file_handle:
+            file_handle.write(rewrite_buffer)
+            file_handle.flush()
+            os.fsync(file_handle.fileno())
+        self._file.close()
+        os.replace(self._rewrite_filename, self.filename)
+        self.open()
+        self.stats.rewrites += 1
+        self.stats.last_rewrite_status = "ok"
+        logger.info(f"Rewrote append only log {self.filename}, {self.stats.size} bytes")
+
+    def close(self):
+        """
+        Writes the buffered requests, syncs the log to disk and closes it
+        """
+        if self._file is None:
+            return
+        self.flush()
+        if self.fsync != "no":
+            self.sync()
+        self._file.close()
+        self._file = None
@@ -0,0 +1,196 @@
+"""
+Asyncio stream server. Connections are served by asyncio Protocols, which feed received bytes straight into the
+receive buffer of the connection and write responses with the transport. uvloop is used for the event loop when it is
+installed.
+"""
+from typing import Any, Callable, List, Optional
+from io import BytesIO
+import asyncio
+from .exceptions import ClientQuit, ProtocolError
+from .infra.logger import logger
+
+try:
+    import uvloop
+except ImportError:  # pragma: no cover
+    uvloop = None
+
+
+class StreamProtocol(asyncio.Protocol):
+    """
+    Protocol serving a single client connection. The connection state and request handling are provided by the
+    server passed in through open_connection, process_batch and close_connection.
+    """
+
+    def __init__(self, server):
+        self._server = server
+        self._transport: Optional[asyncio.Transport] = None
+        self._connection = None
+        self._scheduled = False
+
+    def connection_made(self, transport):
+        """
+        Registers the connection with the server, closing it if the server already has the maximum number of clients
+        :param transport: transport of the connection
+        """
+        self._transport = transport
+        self._connection = self._server.open_connection(transport.get_extra_info("peername"))
+        if self._connection is None:
+            transport.close()
+        else:
+            self._connection.open_push = lambda: self._push
+
+    def _push(self, data: bytes) -> bool:
+        """
+        Writes bytes pushed to a subscribed connection. The transport buffers what the client has not read yet, a
+        client whose buffer grows past the output buffer limit is disconnected
+        :param data: bytes to write
+        :return: False if the connection is being disconnected
+        """
+        if self._transport.is_closing():
+            return False
+        self._transport.write(data)
+        if self._transport.get_write_buffer_size() > self._server.output_buffer_limit:
+            logger.warning(f"Disconnecting a subscriber over the output buffer limit: {self._connection.address}")
+            self._transport.abort()
+            return False
+        return True
+
+    def data_received(self, data: bytes):
+        """
+        Feeds received data into the receive buffer of the connection and handles the complete requests in it
+        :param data: bytes received from the client
+        """
+        if self._connection is None:
+            return
+        self._connection.parser.feed(data)
+        if not self._scheduled and self._connection.waiter is None:
+            self._process()
+
+    def _process(self, handle: Optional[Callable[[BytesIO, Any], int]] = None):
+        """
+        Handles a batch of requests from the receive buffer and writes all the responses at once. When the batch limit
+        is reached the rest of the buffer is handled on a later iteration of the event loop, so that other connections
+        get a turn. When a request blocks, the rest of the buffer is handled once it is done.
+        :param handle: handles the batch, defaulted to process_batch of the server
+        """
+        self._scheduled = False
+        buf = BytesIO()
+        try:
+            processed = (handle or self._server.process_batch)(buf, self._connection)
+        except ClientQuit:
+            logger.info(f"Client exited: {self._connection.address}")
+            self._transport.write(buf.getvalue())
+            self._transport.close()
+            return
+        except KeyboardInterrupt:
+            self._transport.write(buf.getvalue())
+            asyncio.get_running_loop().stop()
+            return
+        except ProtocolError as exc:
+            self._transport.write(buf.getvalue())
+            self._transport.write(self._server.protocol_error(self._connection.address, exc))
+            self._transport.close()
+            return
+        self._transport.write(buf.getvalue())
+        waiter = self._connection.waiter
+        if waiter is not None:
+            self._scheduled = True
+            waiter.notify = lambda: asyncio.get_running_loop().call_soon(self._process, self._server.resume)
+        elif processed and self._connection.parser:
+            self._scheduled = True
+            asyncio.get_running_loop().call_soon(self._process)
+
+    def pause_writing(self):
+        """
+        Stops reading requests from a client that does not read its responses
+        """
+        self._transport.pause_reading()
+
+    def resume_writing(self):
+        """
+        Resumes reading requests once the client has caught up with its responses
+        """
+        self._transport.resume_reading()
+
+    def connection_lost(self, exc):
+        """
+        Unregisters the connection from the server
+        :param exc: exception that closed the connection, None on a regular close
+        """
+        if self._connection is not None:
+            logger.info(f"Client went away: {self._connection.address}")
+            self._server.close_connection(self._connection)
+            self._connection = None
+
+
+class AsyncioStreamServer:
+    """
+    Stream server running on an asyncio event loop
+    """
+
+    def __init__(self, address, server):
+        self.address = address
+        self.server = server
+        self.loop: Optional[asyncio.AbstractEventLoop] = None
+        self._timers: List[Callable[[], float]] = []
+
+    def add_timer(self, callback: Callable[[], float]):
+        """
+        Registers a callback that is called repeatedly on the event loop while the server is serving. The callback
+        returns the number of seconds to wait before it is called again
+        :param callback: callback to run
+        """
+        self._timers.append(callback)
+
+    @staticmethod
+    async def _run_timer(callback: Callable[[], float]):
+        """
+        Runs a timer callback forever
+        :param callback: callback to run
+        """
+        while True:
+            await asyncio.sleep(callback())
+
+    @staticmethod
+    def cooperate():
+        """
+        Connections are handed a turn by the event loop, nothing to do here
+        """
+
+    def call_later(self, delay: float, callback: Callable[[], None]) -> Callable[[], None]:
+        """
+        Calls a callback once after a delay on the event loop
+        :param delay: number of seconds to wait
+        :param callback: callback to call
+        :return: function cancelling the call
+        """
+        return self.loop.call_later(delay, callback).cancel
+
+    def serve_forever(self):
+        """
+        Serves the server forever
+        """
+        self.loop = uvloop.new_event_loop() if uvloop is not None else asyncio.new_event_loop()
+        asyncio.set_event_loop(self.loop)
+        host, port = self.address
+        stream_server = self.loop.run_until_complete(
+            self.loop.create_server(
+                lambda: StreamProtocol(self.server), host, port, reuse_address=True
+            )
+        )
+        tasks = [self.loop.create_task(self._run_timer(timer)) for timer in self._timers]
+        try:
+            self.loop.run_forever()
+        finally:
+            for task in tasks:
+                task.cancel()
+            stream_server.close()
+            self.loop.run_until_complete(stream_server.wait_closed())
+            self.loop.close()
+
+    def stop(self):
+        """
+        Stops the running server if available
+        """
+        if self.loop:
+            self.loop.call_soon_threadsafe(self.loop.stop)
@@ -0,0 +1,159 @@
+"""
+Clients blocked by BLPOP, BRPOP and BRPOPLPUSH. A blocked client is represented by a Waiter, which is queued on every
+key it waits for. Pushing to a key hands the pushed values straight to the waiters of the key, first come first served,
+and only the values that are left go into the queue. Timeouts are kept in an ExpiryIndex and handled by the active
+expiry cycle of the server, so a blocked client costs nothing until it is served or times out.
+"""
+from typing import Any, Callable, Deque, Dict, List, Optional
+from collections import deque
+from dataclasses import dataclass, field
+from .expiry import ExpiryIndex
+
+
+@dataclass(eq=False)
+# pylint: disable-next=too-many-instance-attributes
+class Waiter:
+    """
+    Contains a blocked pop
+    :cvar keys are the keys waited for, in the order they were given
+    :cvar left is set for pops from the head of the queue, BLPOP, and unset for pops from the tail
+    :cvar destination is the key the value is pushed to by BRPOPLPUSH, None for BLPOP and BRPOP
+    :cvar deadline is the timestamp the pop times out at, None to wait forever
+    :cvar alive checks that the client is still connected before a value is handed to it
+    :cvar done is set once the pop has been served or has timed out
+    :cvar result is the response of the pop once done
+    :cvar notify is called once the pop is done, to wake the connection of the client up
+    """
+
+    keys: List[Any]
+    left: bool = True
+    destination: Any = None
+    deadline: Optional[float] = None
+    alive: Callable[[], bool] = field(default=lambda: True)
+    done: bool = False
+    result: Any = None
+    notify: Optional[Callable[[], None]] = None
+
+    def finish(self, result: Any):
+        """
+        Completes the pop with a response and wakes the client up
+        :param result: response of the pop
+        """
+        self.done = True
+        self.result = result
+        if self.notify is not None:
+            self.notify()
+
+
+class WaiterQueues:
+    """
+    Waiters queued per key
+    """
+
+    def __init__(self):
+        """Creates empty waiter queues"""
+        self._queues: Dict[Any, Deque[Waiter]] = {}
+        self._timeouts = ExpiryIndex()
+        self._blocked = 0
+
+    def __len__(self) -> int:
+        """Returns the number of blocked clients"""
+        return self._blocked
+
+    def has_waiters(self, key: Any) -> bool:
+        """
+        Checks whether clients are blocked on a key
+        :param key: Key
+        :return: True if at least one client waits for the key
+        """
+        return key in self._queues
+
+    def block(self, waiter: Waiter) -> Waiter:
+        """
+        Queues a waiter on its keys
+        :param waiter: the waiter
+        :return: the waiter
+        """
+        for key in waiter.keys:
+            self._queues.setdefault(key, deque()).append(waiter)
+        if waiter.deadline is not None:
+            self._timeouts.arm(waiter, waiter.deadline)
+        self._blocked += 1
+        return waiter
+
+    def cancel(self, waiter: Waiter):
+        """
+        Removes a waiter from the queues of its keys, e.g. because its client went away
+        :param waiter: the waiter
+        """
+        if waiter.done:
+            return
+        waiter.done = True
+        self._unlink(waiter)
+
+    def claim(self, waiter: Waiter) -> bool:
+        """
+        Takes a waiter that is served by its owner rather than by a push off the queues of its keys and its timeout,
+        before its response is handed to it
+        :param waiter: the waiter
+        :return: True if the response is to be handed to the waiter, False if it is already done or its client went
+        away, in which case its connection has been woken up so that it is closed
+        """
+        if waiter.done:
+            return False
+        self.cancel(waiter)
+        if not waiter.alive():
+            waiter.finish(None)
+            return False
+        return True
+
+    def _unlink(self, waiter: Waiter):
+        """
+        Removes a waiter that is done from the queues of its keys and from the timeouts
+        :param waiter: the waiter
+        """
+        for key in waiter.keys:
+            queue = self._queues.get(key)
+            if queue is None:
+                continue
+            try:
+                queue.remove(waiter)
+            except ValueError:
+                pass
+            if not queue:
+                del self._queues[key]
+        if waiter.deadline is not None:
+            self._timeouts.cancel(waiter, waiter.deadline)
+        self._blocked -= 1
+
+    def next_waiter(self, key: Any) -> Optional[Waiter]:
+        """
+        Takes the longest waiting client off a key, dropping the clients that have gone away on the way
+        :param key: Key
+        :return: the waiter, None if no client waits for the key
+        """
+        while key in self._queues:
+            waiter = self._queues[key][0]
+            waiter.done = True
+            self._unlink(waiter)
+            if waiter.alive():
+                return waiter
+            # wakes the connection of the client up, so that it is closed
+            waiter.finish(None)
+        return None
+
+    def expire(self, timestamp: float) -> int:
+        """
+        Times out the waiters whose deadline has passed
+        :param timestamp: current timestamp
+        :return: number of waiters timed out
+        """
+        expired = 0
+        for waiter in self._timeouts.pop_due(timestamp):
+            # the waiter has already been taken off the timeouts
+            waiter.deadline = None
+            waiter.done = True
+            self._unlink(waiter)
+            waiter.finish(None)
+            expired += 1
+        return expired
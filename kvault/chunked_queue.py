@@ -0,0 +1,270 @@
+"""
+Queue stored as a list of fixed size blocks. collections.deque is a linked list of blocks, so reaching the middle of it
+walks half of the blocks, and ranges could only be read by copying the whole deque into a list first. Here every block
+but the first and the last is full, so the block and slot of any index are found with arithmetic and a range of k values
+is read in O(k):
+
+    blocks   [ ... free ... | block | block | block | ... free ... ]
+                             ^ first                ^ last
+    head     slot of the first value in the first block
+
+Free slots are kept at both ends of the list of blocks, so that pushing and popping at either end is amortised O(1).
+"""
+from typing import Any, Iterable, Iterator, List, Optional
+import sys
+
+BLOCK_SIZE = 64
+
+
+class ChunkedQueue:
+    """
+    Double ended queue with O(1) indexed access and O(k) range reads
+    """
+
+    __slots__ = ("_blocks", "_first", "_last", "_head", "_length")
+
+    def __init__(self, values: Iterable[Any] = ()):
+        """
+        Creates a queue
+        :param values: initial values of the queue, from the head to the tail
+        """
+        # blocks of the queue are _blocks[_first:_last], other entries are free slots
+        self._blocks: List[Optional[List[Any]]] = []
+        self._first = 0
+        self._last = 0
+        self._head = 0
+        self._length = 0
+        self.extend(values)
+
+    def __len__(self) -> int:
+        return self._length
+
+    def __reduce__(self):
+        return ChunkedQueue, (list(self),)
+
+    def __sizeof__(self) -> int:
+        size = object.__sizeof__(self) + sys.getsizeof(self._blocks)
+        if self._last > self._first:
+            size += (self._last - self._first) * sys.getsizeof(self._blocks[self._first])
+        return size
+
+    def __repr__(self):
+        return f"ChunkedQueue({list(self)!r})"
+
+    def __eq__(self, other):
+        if not isinstance(other, ChunkedQueue):
+            return NotImplemented
+        return len(self) == len(other) and all(a == b for a, b in zip(self, other))
+
+    __hash__ = None
+
+    def _index(self, index: int) -> int:
+        """
+        Returns the position of a value counted from the first slot of the first block
+        :param index: index of the value, negative indexes count from the tail
+        :return: position
+        :raises IndexError if the index is out of range
+        """
+        if index < 0:
+            index += self._length
+        if not 0 <= index < self._length:
+            raise IndexError("queue index out of range")
+        return self._head + index
+
+    def __getitem__(self, index):
+        if isinstance(index, slice):
+            start, stop, step = index.indices(self._length)
+            if step != 1:
+                return list(self)[index]
+            return self.range(start, stop)
+        position = self._index(index)
+        return self._blocks[self._first + position // BLOCK_SIZE][position % BLOCK_SIZE]
+
+    def __setitem__(self, index: int, value: Any):
+        position = self._index(index)
+        self._blocks[self._first + position // BLOCK_SIZE][position % BLOCK_SIZE] = value
+
+    def __iter__(self) -> Iterator[Any]:
+        position, end = self._head, self._head + self._length
+        block = self._first
+        while position < end:
+            offset = position % BLOCK_SIZE
+            take = min(BLOCK_SIZE - offset, end - position)
+            yield from self._blocks[block][offset : offset + take]
+            position += take
+            block += 1
+
+    def range(self, start: int, stop: int) -> List[Any]:
+        """
+        Returns the values from start to stop, copying only the blocks holding them
+        :param start: index of the first value, 0 <= start
+        :param stop: index past the last value, stop <= length
+        :return: list of values
+        """
+        if stop <= start:
+            return []
+        position, end = self._head + start, self._head + stop
+        values: List[Any] = []
+        block = self._first + position // BLOCK_SIZE
+        offset = position % BLOCK_SIZE
+        while position < end:
+            take = min(BLOCK_SIZE - offset, end - position)
+            values.extend(self._blocks[block][offset : offset + take])
+            position += take
+            block += 1
+            offset = 0
+        return values
+
+    def _tail_block(self) -> List[Any]:
+        """
+        Returns the block the next value added to the tail goes in, adding a block if the last one is full
+        :return: block
+        """
+        block = self._first + (self._head + self._length) // BLOCK_SIZE
+        if block == self._last:
+            if self._last == len(self._blocks):
+                self._blocks.append([None] * BLOCK_SIZE)
+            else:
+                self._blocks[self._last] = [None] * BLOCK_SIZE
+            self._last += 1
+        return self._blocks[block]
+
+    def append(self, value: Any):
+        """
+        Adds a value to the tail
+        :param value: value to add
+        """
+        self._tail_block()[(self._head + self._length) % BLOCK_SIZE] = value
+        self._length += 1
+
+    def appendleft(self, value: Any):
+        """
+        Adds a value to the head
+        :param value: value to add
+        """
+        if self._head == 0:
+            if self._first == 0:
+                # free as many slots in front of the blocks as there are blocks, so growing the head is amortised O(1)
+                free = max(self._last - self._first, 1)
+                self._blocks[:0] = [None] * free
+                self._first += free
+                self._last += free
+            self._first -= 1
+            self._blocks[self._first] = [None] * BLOCK_SIZE
+            self._head = BLOCK_SIZE
+        self._head -= 1
+        self._blocks[self._first][self._head] = value
+        self._length += 1
+
+    def extend(self, values: Iterable[Any]):
+        """
+        Adds values to the tail
+        :param values: values to add
+        """
+        values = values if isinstance(values, list) else list(values)
+        index = 0
+        while index < len(values):
+            block = self._tail_block()
+            offset = (self._head + self._length) % BLOCK_SIZE
+            take = min(BLOCK_SIZE - offset, len(values) - index)
+            block[offset : offset + take] = values[index : index + take]
+            index += take
+            self._length += take
+
+    def extendleft(self, values: Iterable[Any]):
+        """
+        Adds values to the head one after the other, so they end up in reverse order like with deque.extendleft
+        :param values: values to add
+        """
+        for value in values:
+            self.appendleft(value)
+
+    def pop(self) -> Any:
+        """
+        Removes the value at the tail
+        :return: the value
+        :raises IndexError if the queue is empty
+        """
+        if not self._length:
+            raise IndexError("pop from an empty queue")
+        position = self._head + self._length - 1
+        block = self._blocks[self._first + position // BLOCK_SIZE]
+        value = block[position % BLOCK_SIZE]
+        block[position % BLOCK_SIZE] = None
+        self._length -= 1
+        if position % BLOCK_SIZE == 0:
+            self._last -= 1
+            self._blocks[self._last] = None
+        self._release()
+        return value
+
+    def popleft(self) -> Any:
+        """
+        Removes the value at the head
+        :return: the value
+        :raises IndexError if the queue is empty
+        """
+        if not self._length:
+            raise IndexError("pop from an empty queue")
+        block = self._blocks[self._first]
+        value = block[self._head]
+        block[self._head] = None
+        self._head += 1
+        self._length -= 1
+        if self._head == BLOCK_SIZE:
+            self._blocks[self._first] = None
+            self._first += 1
+            self._head = 0
+        self._release()
+        return value
+
+    def _release(self):
+        """
+        Gives back the free slots once they outnumber the blocks, so a queue that shrank does not keep its peak size
+        """
+        if not self._length:
+            self.clear()
+        elif self._first > 2 * (self._last - self._first) + 8:
+            del self._blocks[: self._first]
+            self._last -= self._first
+            self._first = 0
+        elif len(self._blocks) - self._last > 2 * (self._last - self._first) + 8:
+            del self._blocks[self._last :]
+
+    def remove(self, value: Any):
+        """
+        Removes the first occurrence of a value, shifting the values on the shorter side of it
+        :param value: value to remove
+        :raises ValueError if the value is not in the queue
+        """
+        for index, item in enumerate(self):
+            if item == value:
+                break
+        else:
+            raise ValueError("value not in queue")
+        if index < self._length // 2:
+            for i in range(index, 0, -1):
+                self[i] = self[i - 1]
+            self.popleft()
+        else:
+            for i in range(index, self._length - 1):
+                self[i] = self[i + 1]
+            self.pop()
+
+    def trim(self, start: int, stop: int):
+        """
+        Keeps only the values from start to stop. The kept values are copied into new blocks, so the cost grows with
+        the size of the range rather than the size of the queue
+        :param start: index of the first value to keep, 0 <= start
+        :param stop: index past the last value to keep, stop <= length
+        """
+        kept = self.range(start, stop)
+        self.clear()
+        self.extend(kept)
+
+    def clear(self):
+        """
+        Removes every value
+        """
+        self._blocks = []
+        self._first = self._last = self._head = self._length = 0
@@ -0,0 +1,75 @@
+"""
+Key hash slots used to shard the keyspace over several worker processes. Like Redis Cluster, every key maps to one of
+16384 slots through CRC16 of the key and every worker owns a contiguous range of slots. When a key contains a hash tag,
+e.g. {user1}.name, only the part between the braces is hashed, so that related keys end up on the same worker.
+"""
+from typing import Any, List, NamedTuple, Optional
+import binascii
+from .utils import encode
+
+HASH_SLOTS = 16384
+
+
+class ClusterNode(NamedTuple):
+    """
+    Worker owning the slots from start to end (inclusive)
+    """
+
+    start: int
+    end: int
+    host: str
+    port: int
+
+
+def hash_tag(data: bytes) -> bytes:
+    """
+    Returns the part of an encoded key that is hashed, which is the hash tag between braces if there is one
+    :param data: encoded key
+    :return: hashed part of the key
+    """
+    start = data.find(b"{")
+    if start != -1:
+        end = data.find(b"}", start + 1)
+        if end > start + 1:
+            return data[start + 1:end]
+    return data
+
+
+def key_slot(key: Any) -> int:
+    """
+    Returns the hash slot of a key
+    :param key: Key
+    :return: slot between 0 and HASH_SLOTS - 1
+    """
+    data = hash_tag(encode(key))
+    # crc_hqx is the CRC16-CCITT (XMODEM) variant used by Redis Cluster
+    return binascii.crc_hqx(data, 0) % HASH_SLOTS
+
+
+def cluster_nodes(host: str, port: int, workers: int) -> List[ClusterNode]:
+    """
+    Splits the slots evenly over a number of workers, listening on consecutive ports
+    :param host: Host the workers listen on
+    :param port: Port of the first worker
+    :param workers: Number of workers
+    :return: list of nodes
+    """
+    nodes = []
+    for index in range(workers):
+        start = index * HASH_SLOTS // workers
+        end = (index + 1) * HASH_SLOTS // workers - 1
+        nodes.append(ClusterNode(start=start, end=end, host=host, port=port + index))
+    return nodes
+
+
+def slot_table(nodes: List[ClusterNode]) -> List[Optional[int]]:
+    """
+    Maps every slot to the index of the node owning it
+    :param nodes: list of nodes
+    :return: list with the index of the owning node for every slot, None for slots that are not owned
+    """
+    table: List[Optional[int]] = [None] * HASH_SLOTS
+    for index, node in enumerate(nodes):
+        for slot in range(node.start, node.end + 1):
+            table[slot] = index
+    return table
@@ -1,17 +1,21 @@
-# pylint: disable-next=too-many-lines
+# pylint: disable=too-many-lines
 """
 Contains all commands performed by the key store
 """
+from typing import Deque, Dict, Optional, List, Any, Tuple, Union
 from collections import deque
-from typing import Dict, Optional, List, Any, Union
-import heapq
 import time
 import os
-import pickle
 import datetime
 from ..utils.mixins import Guards
-from ..exceptions import CommandError, ClientQuit, Shutdown
-from ..types import Value, KV, HASH, QUEUE, SET
+from ..blocking import Waiter, WaiterQueues
+from ..chunked_queue import ChunkedQueue
+from ..exceptions import CommandError, ClientQuit, Shutdown, Error
+from ..persistence import save_snapshot, load_snapshot, SnapshotError
+from ..expiry import ExpiryIndex
+from ..scan import ScanCursors, scan_options, matches
+from ..schedule import Schedule, epoch
+from ..types import Entry, Value, KV, HASH, QUEUE, SET, pack, data_type_of, payload_of
 from ..utils import enforce_datatype, decode
 
 
@@ -23,44 +27,88 @@ class Commands(Guards):
 
     def __init__(
         self,
-        kv_store: Dict[Any, Value],
+        kv_store: Dict[Any, Entry],
         expiry_map: Dict,
-        expiry: List,
-        schedule: List,
+        expiry: ExpiryIndex,
+        schedule: Schedule,
     ):
         """Creates an instance of commands"""
-        self._kv: Dict[Any, Value] = kv_store
+        self._kv: Dict[Any, Entry] = kv_store
         self._expiry_map = expiry_map
         self._expiry = expiry
         self._schedule = schedule
+        self._cursors = ScanCursors()
+        self._waiters = WaiterQueues()
+        # blocked schedule reads with their LIMIT, in the order they blocked
+        self._schedule_readers: Deque[Tuple[Waiter, Optional[int]]] = deque()
 
-        super().__init__(self._kv, self._expiry_map)
+        super().__init__(self._kv, self._expiry_map, self._expiry)
 
     def expire(self, key, nseconds: Union[float, int]):
         """Sets an expiry time for a key in nano-seconds."""
-        eta = time.time() + nseconds
-        self._expiry_map[key] = eta
-        heapq.heappush(self._expiry, (eta, key))
+        self.expire_at(key, time.time() + nseconds)
 
-    def clean_expired(self, timestamp=None):
+    def expire_at(self, key, timestamp: Union[float, int]):
+        """
+        Sets the timestamp at which a key expires
+        :param key: Key
+        :param timestamp: unix timestamp in seconds
+        """
+        self._expiry.arm(key, timestamp, self._expiry_map.get(key))
+        self._expiry_map[key] = timestamp
+
+    def pexpire_at(self, key, timestamp: int):
+        """
+        Sets the timestamp in milliseconds at which a key expires
+        :param key: Key
+        :param timestamp: unix timestamp in milliseconds
+        """
+        self.expire_at(key, timestamp / 1000)
+
+    def clean_expired(self, timestamp=None, limit: Optional[int] = None):
         """
         Performs cleanup of the expired keys
         :param timestamp: timestamp to check against expired keys
+        :param limit: maximum number of keys to clean up, defaulted to None which cleans up all due keys
         :return: Number of cleanups performed
         """
         _timestamp = timestamp or time.time()
-        cleanup_count = 0
-        while self._expiry:
-            expires, key = heapq.heappop(self._expiry)
-            if expires > _timestamp:
-                heapq.heappush(self._expiry, (expires, key))
-                break
+        keys = self._expiry.pop_due(_timestamp, limit)
+        if keys:
+            self.on_keyspace_change()
+        for key in keys:
+            del self._expiry_map[key]
+            self._kv.pop(key, None)
+            self.on_key_expired(key)
+        return len(keys)
 
-            if self._expiry_map.get(key) == expires:
-                del self._expiry_map[key]
-                del self._kv[key]
-                cleanup_count += 1
-        return cleanup_count
+    def on_keyspace_change(self):
+        """
+        Marks the iterations over the keys as stale before keys are added or removed
+        """
+        self._cursors.invalidate(KV)
+
+    def before_write(self, keys: List[Any]):
+        """
+        Marks the iterations over the containers of the given keys as stale before a write command, and the
+        iterations over the keys if the command may add one. Writes that only update keys leave the order of the keys
+        as it is
+        :param keys: keys the command operates on
+        """
+        if any(key not in self._kv for key in keys):
+            self._cursors.invalidate(KV)
+        for key in keys:
+            self._cursors.invalidate((HASH, key))
+            self._cursors.invalidate((SET, key))
+
+    def has_expired_pending(self, timestamp=None) -> bool:
+        """
+        Checks if there are expired keys that are due for cleanup
+        :param timestamp: timestamp to check against, defaulted to None and will use current time
+        :return: True if at least one key is due
+        """
+        _timestamp = timestamp or time.time()
+        return self._expiry.has_due(_timestamp)
 
     ## Queue commands
     @enforce_datatype(QUEUE)
@@ -71,7 +119,10 @@ class Commands(Guards):
         :param values: Values
         :return: length of values to add
         """
-        self._kv[key].value.extendleft(values)
+        if self._waiters.has_waiters(key):
+            self._push(key, values[::-1], left=True)
+        else:
+            self._kv[key].value.extendleft(values)
         return len(values)
 
     @enforce_datatype(QUEUE)
@@ -82,7 +133,10 @@ class Commands(Guards):
         :param values: values to push
         :return: Length of values added
         """
-        self._kv[key].value.extend(values)
+        if self._waiters.has_waiters(key):
+            self._push(key, list(values), left=False)
+        else:
+            self._kv[key].value.extend(values)
         return len(values)
 
     @enforce_datatype(QUEUE)
@@ -181,9 +235,10 @@ class Commands(Guards):
         :raise CommandError if key does not exist
         """
         try:
-            trimmed = list(self._kv[key].value)[start:stop]
-            self._kv[key] = Value(QUEUE, deque(trimmed))
-            return len(trimmed)
+            queue = self._kv[key].value
+            start, stop, _ = slice(start, stop).indices(len(queue))
+            queue.trim(start, max(start, stop))
+            return len(queue)
         except KeyError as error:
             raise CommandError(
                 f"Failed to find key with error {error}. Key {key} does not exist"
@@ -200,11 +255,151 @@ class Commands(Guards):
         """
         self.check_datatype(QUEUE, dest, set_missing=True)
         try:
-            self._kv[dest].value.appendleft(self._kv[src].value.pop())
-        except KeyError:
+            value = self._kv[src].value.pop()
+        except (KeyError, IndexError):
             return 0
+        self._push(dest, [value], left=True)
         return 1
 
+    def _push(self, key, values: List[Any], left: bool):
+        """
+        Pushes values to a queue, handing them to the clients blocked on the queue first. Clients popping from the head
+        take values from the head of the pushed values and clients popping from the tail from their tail, as if the
+        values had been pushed and then popped
+        :param key: Key of the queue, which must exist
+        :param values: values in the order they end up in the queue
+        :param left: whether to push to the head of the queue
+        """
+        start, end = 0, len(values)
+        while start < end and self._waiters.has_waiters(key):
+            waiter = self._waiters.next_waiter(key)
+            if waiter is None:
+                break
+            if waiter.destination is not None and not self._can_push(waiter.destination):
+                waiter.finish(Error(f"Operation against wrong key type. Key {waiter.destination} is not a queue"))
+                continue
+            if waiter.left:
+                value = values[start]
+                start += 1
+            else:
+                end -= 1
+                value = values[end]
+            self._serve(waiter, key, value)
+
+        queue = self._kv[key].value
+        if left:
+            queue.extendleft(reversed(values[start:end]))
+        else:
+            queue.extend(values[start:end])
+
+    def _can_push(self, key) -> bool:
+        """
+        Checks that a value can be pushed to a key, i.e. the key is a queue or does not exist
+        :param key: Key
+        :return: True if values can be pushed to the key
+        """
+        try:
+            self.check_datatype(QUEUE, key, set_missing=True)
+        except CommandError:
+            return False
+        return True
+
+    def _serve(self, waiter: Waiter, key, value):
+        """
+        Completes a blocked pop with a value taken from a key
+        :param waiter: blocked pop
+        :param key: Key the value was taken from
+        :param value: the value
+        """
+        if waiter.destination is None:
+            self.on_handed_off([b"LPOP" if waiter.left else b"RPOP", key])
+            waiter.finish([key, value])
+        else:
+            self.on_handed_off([b"RPOPLPUSH", key, waiter.destination])
+            self._push(waiter.destination, [value], left=True)
+            waiter.finish(value)
+
+    def on_handed_off(self, request: List[Any]):
+        """
+        Called for every value handed to a blocked client, with a request that has the same effect as the pop of the
+        client when run after the push that served it. Does nothing by default
+        :param request: the request
+        """
+
+    def _blocking_pop(self, keys, timeout, left: bool, destination=None):
+        """
+        Pops a value from the first non-empty queue out of keys, or blocks the client until a value is pushed to one of
+        them
+        :param keys: Keys of the queues
+        :param timeout: number of seconds to block for, 0 to block forever
+        :param left: whether to pop from the head of the queues
+        :param destination: key to push the value to, for BRPOPLPUSH
+        :return: key and value or the value for BRPOPLPUSH, or a Waiter if the client has to block
+        :raises CommandError if a key is not a queue or the timeout is invalid
+        """
+        deadline = self._deadline(timeout)
+        for key in keys:
+            self.check_datatype(QUEUE, key, set_missing=False)
+            if key in self._kv and self._kv[key].value:
+                queue = self._kv[key].value
+                value = queue.popleft() if left else queue.pop()
+                if destination is None:
+                    return [key, value]
+                self.check_datatype(QUEUE, destination)
+                self._push(destination, [value], left=True)
+                return value
+        return self._waiters.block(Waiter(keys=list(keys), left=left, destination=destination, deadline=deadline))
+
+    @staticmethod
+    def _deadline(timeout) -> Optional[float]:
+        """
+        Returns the timestamp a blocked client times out at
+        :param timeout: number of seconds to block for, 0 to block forever
+        :return: timestamp, None to block forever
+        :raises CommandError if the timeout is invalid
+        """
+        try:
+            timeout = float(timeout)
+        except (TypeError, ValueError) as error:
+            raise CommandError(f"timeout is not a number: {timeout}") from error
+        if timeout < 0:
+            raise CommandError("timeout is negative")
+        return time.time() + timeout if timeout else None
+
+    def blpop(self, *args):
+        """
+        Pops the value at the head of the first non-empty queue out of the given keys. When all of them are empty, the
+        client is blocked until a value is pushed to one of them or the timeout runs out
+        :param args: keys followed by the timeout in seconds, 0 to block forever
+        :return: key and value, or None on timeout
+        """
+        if len(args) < 2:
+            raise CommandError("BLPOP takes at least one key and a timeout")
+        return self._blocking_pop(args[:-1], args[-1], left=True)
+
+    def brpop(self, *args):
+        """
+        Pops the value at the tail of the first non-empty queue out of the given keys. When all of them are empty, the
+        client is blocked until a value is pushed to one of them or the timeout runs out
+        :param args: keys followed by the timeout in seconds, 0 to block forever
+        :return: key and value, or None on timeout
+        """
+        if len(args) < 2:
+            raise CommandError("BRPOP takes at least one key and a timeout")
+        return self._blocking_pop(args[:-1], args[-1], left=False)
+
+    def brpoplpush(self, src, dest, timeout):
+        """
+        Pops the value at the tail of src and pushes it to the head of dest. When src is empty, the client is blocked
+        until a value is pushed to it or the timeout runs out
+        :param src: Key to pop from
+        :param dest: Key to push to
+        :param timeout: number of seconds to block for, 0 to block forever
+        :return: the value, or None on timeout
+        """
+        self.check_datatype(QUEUE, dest, set_missing=False)
+        return self._blocking_pop([src], timeout, left=False, destination=dest)
+
     @enforce_datatype(QUEUE)
     def lrange(self, key, start, end=None):
         """
@@ -216,12 +411,29 @@ class Commands(Guards):
         :raises: CommandError if key does not exist
         """
         try:
-            return list(self._kv[key].value)[start:end]
+            return self._kv[key].value[start:end]
         except KeyError as error:
             raise CommandError(
                 f"Failed to find key with error {error}. Key {key} does not exist"
             ) from error
 
+    @enforce_datatype(QUEUE)
+    def lscan(self, key, cursor, *options) -> List:
+        """
+        Iterates over the values of a queue. The cursor is the index of the next value to return, so values pushed to
+        or popped from the head of the queue during the iteration shift the values that are left
+        :param key: Key
+        :param cursor: cursor returned by the previous call, 0 to start an iteration
+        :param options: MATCH pattern to filter the values with, COUNT number of values to walk, defaulted to 10
+        :return: cursor to continue with, 0 once the iteration is complete, and the values
+        """
+        pattern, count = scan_options(options)
+        queue = self._kv[key].value
+        start = min(max(int(cursor), 0), len(queue))
+        end = min(start + count, len(queue))
+        values = [value for value in queue.range(start, end) if matches(value, pattern)]
+        return [end if end < len(queue) else 0, values]
+
     @enforce_datatype(QUEUE)
     def lflush(self, key):
         """
@@ -416,13 +628,29 @@ class Commands(Guards):
         except KeyError as error:
             raise CommandError(f"key {key} does not exist. Error: {error}") from error
 
+    @enforce_datatype(HASH)
+    def hscan(self, key, cursor, *options) -> List:
+        """
+        Iterates over the fields of a hash, see kvault.scan for the guarantees of the iteration
+        :param key: Key
+        :param cursor: cursor returned by the previous call, 0 to start an iteration
+        :param options: MATCH pattern to filter the fields with, COUNT number of fields to walk, defaulted to 10
+        :return: cursor to continue with, 0 once the iteration is complete, and a dict of the fields and their values
+        """
+        pattern, count = scan_options(options)
+        hash_ = self._kv[key].value
+        cursor, fields = self._cursors.advance(cursor, (HASH, key), hash_, hash_.__contains__, count)
+        return [cursor, {field: hash_[field] for field in fields if matches(field, pattern)}]
+
     # ==== KV Commands
     def unexpire(self, key):
         """
-        Removes an expired key from expiry map
+        Removes the expiry time of a key
         :param key: Key to remove
         """
-        self._expiry_map.pop(key, None)
+        eta = self._expiry_map.pop(key, None)
+        if eta is not None:
+            self._expiry.cancel(key, eta)
 
     def _kv_incr(self, key, delta: int) -> Union[Value, Any]:
         """
@@ -431,10 +659,10 @@ class Commands(Guards):
         :param delta: Delta to increase the value by
         """
         if key in self._kv:
-            value = self._kv[key].value + delta
+            value = payload_of(self._kv[key]) + delta
         else:
             value = delta
-        self._kv[key] = Value(KV, value)
+        self._kv[key] = pack(KV, value)
         return value
 
     def kv_append(self, key, value):
@@ -446,19 +674,21 @@ class Commands(Guards):
         if key not in self._kv:
             self.kv_set(key=key, value=value)
         else:
-            kv_val = self._kv[key]
-            if kv_val.data_type == QUEUE:
+            entry = self._kv[key]
+            if data_type_of(entry) == QUEUE:
                 if isinstance(value, list):
-                    kv_val.value.extend(value)
+                    entry.value.extend(value)
                 else:
-                    kv_val.value.append(value)
+                    entry.value.append(value)
             else:
                 try:
-                    kv_val = Value(kv_val.data_type, kv_val.value + value)
-                    self._kv[key] = kv_val
+                    if isinstance(entry, Value):
+                        entry.value = entry.value + value
+                    else:
+                        self._kv[key] = pack(KV, entry + value)
                 except Exception as error:
                     raise CommandError(f"Incompatible data-types {value}") from error
-        return self._kv[key].value
+        return payload_of(self._kv[key])
 
     def kv_set(self, key, value) -> int:
         """
@@ -470,13 +700,13 @@ class Commands(Guards):
             data_type = HASH
         elif isinstance(value, list):
             data_type = QUEUE
-            value = deque(value)
+            value = ChunkedQueue(value)
         elif isinstance(value, set):
             data_type = SET
         else:
             data_type = KV
         self.unexpire(key)
-        self._kv[key] = Value(data_type, value)
+        self._kv[key] = pack(data_type, value)
         return 1
 
     @enforce_datatype(KV, set_missing=False, subtype=(float, int))
@@ -503,6 +733,7 @@ class Commands(Guards):
         """
         if key in self._kv:
             del self._kv[key]
+            self.unexpire(key)
             return 1
         return 0
 
@@ -521,7 +752,7 @@ class Commands(Guards):
         :return: Key's value if it exists else None is returned if the key does not exist and has expired
         """
         if key in self._kv and not self.check_expired(key):
-            return self._kv[key].value
+            return payload_of(self._kv[key])
         return None
 
     def kv_getset(self, key, value) -> Optional[Value]:
@@ -534,9 +765,9 @@ class Commands(Guards):
         """
         original_value = None
         if key in self._kv and not self.check_expired(key):
-            original_value = self._kv[key].value
+            original_value = payload_of(self._kv[key])
 
-        self._kv[key] = Value(KV, value)
+        self._kv[key] = pack(KV, value)
         return original_value
 
     @enforce_datatype(KV, set_missing=False, subtype=(float, int))
@@ -569,6 +800,7 @@ class Commands(Guards):
             except KeyError:
                 pass
             else:
+                self.unexpire(key)
                 deleted_key_count += 1
         return deleted_key_count
 
@@ -584,7 +816,7 @@ class Commands(Guards):
         accum = []
         for key in keys:
             if key in self._kv and not self.check_expired(key):
-                accum.append(self._kv[key].value)
+                accum.append(payload_of(self._kv[key]))
             else:
                 accum.append(None)
         return accum
@@ -602,7 +834,8 @@ class Commands(Guards):
         accum = []
         for key in keys:
             if key in self._kv and not self.check_expired(key):
-                accum.append(self._kv.pop(key).value)
+                accum.append(payload_of(self._kv.pop(key)))
+                self.unexpire(key)
             else:
                 accum.append(None)
         return accum
@@ -623,7 +856,7 @@ class Commands(Guards):
 
         for key_, _ in data.items():
             self.unexpire(key_)
-            self._kv[key_] = Value(KV, data[key_])
+            self._kv[key_] = pack(KV, data[key_])
             update_count += 1
         return update_count
 
@@ -644,7 +877,8 @@ class Commands(Guards):
         :return: The value of the popped key
         """
         if key in self._kv and not self.check_expired(key):
-            return self._kv.pop(key).value
+            self.unexpire(key)
+            return payload_of(self._kv.pop(key))
         return None
 
     def kv_setnx(self, key, value) -> int:
@@ -657,7 +891,7 @@ class Commands(Guards):
         if key in self._kv and not self.check_expired(key):
             return 0
         self.unexpire(key)
-        self._kv[key] = Value(KV, value)
+        self._kv[key] = pack(KV, value)
         return 1
 
     def kv_setex(self, key: Any, value: Value, expires: Union[float, int]) -> int:
@@ -678,6 +912,17 @@ class Commands(Guards):
         """
         return len(self._kv)
 
+    def scan(self, cursor, *options) -> List:
+        """
+        Iterates over the keys, see kvault.scan for the guarantees of the iteration
+        :param cursor: cursor returned by the previous call, 0 to start an iteration
+        :param options: MATCH pattern to filter the keys with, COUNT number of keys to walk, defaulted to 10
+        :return: cursor to continue with, 0 once the iteration is complete, and the keys
+        """
+        pattern, count = scan_options(options)
+        cursor, keys = self._cursors.advance(cursor, KV, self._kv, self.kv_exists, count)
+        return [cursor, [key for key in keys if matches(key, pattern)]]
+
     def kv_flush(self) -> int:
         """
         Clears the keys, expiry and expiry_map and returns the original length of the keys.
@@ -685,8 +930,8 @@ class Commands(Guards):
         """
         kvlen = self.kv_len()
         self._kv.clear()
-        self._expiry = []
-        self._expiry_map = {}
+        self._expiry.clear()
+        self._expiry_map.clear()
         return kvlen
 
     # ====== Set Commands
@@ -813,6 +1058,20 @@ class Commands(Guards):
         except KeyError as error:
             raise CommandError(f"Key {key} does not exist {error}") from error
 
+    @enforce_datatype(SET)
+    def sscan(self, key, cursor, *options) -> List:
+        """
+        Iterates over the members of a set, see kvault.scan for the guarantees of the iteration
+        :param key: Key
+        :param cursor: cursor returned by the previous call, 0 to start an iteration
+        :param options: MATCH pattern to filter the members with, COUNT number of members to walk, defaulted to 10
+        :return: cursor to continue with, 0 once the iteration is complete, and the members
+        """
+        pattern, count = scan_options(options)
+        members = self._kv[key].value
+        cursor, batch = self._cursors.advance(cursor, (SET, key), members, members.__contains__, count)
+        return [cursor, [member for member in batch if matches(member, pattern)]]
+
     @enforce_datatype(SET)
     def spop(self, key, number_to_pop=1) -> List[Value]:
         """
@@ -889,7 +1148,7 @@ class Commands(Guards):
         Returns the current state of the store
         :return: dictionary mapping of state keys to mappings
         """
-        return {"kv": self._kv, "schedule": self._schedule}
+        return {"kv": self._kv, "schedule": list(self._schedule), "expiry": self._expiry_map}
 
     def _set_state(self, state: Dict[str, Any], merge=False):
         """
@@ -897,22 +1156,31 @@ class Commands(Guards):
         :param state: New state
         :param merge: whether to merge the state with the new state
         """
+        expiry_map = state.get("expiry", {})
         if not merge:
             self._kv = state["kv"]
-            self._schedule = state["schedule"]
+            self._expiry_map.clear()
+            self._expiry.clear()
         else:
 
             def merge(orig, updates):
                 orig.update(updates)
                 return orig
 
+            # keys in the current state win over the stored ones, so are their expiry times
+            expiry_map = {key: eta for key, eta in expiry_map.items() if key not in self._kv}
             self._kv = merge(state["kv"], self._kv)
-            self._schedule = state["schedule"]
+
+        self._schedule.clear()
+        for timestamp, data in state["schedule"]:
+            self._schedule.add(epoch(timestamp), data)
+
+        for key, eta in expiry_map.items():
+            self.expire_at(key, eta)
 
     def save_to_disk(self, filename) -> bool:
         """Saves the current state to disk given a filename."""
-        with open(filename, "wb") as file_handle:
-            pickle.dump(self._get_state(), file_handle, pickle.HIGHEST_PROTOCOL)
+        save_snapshot(filename, self._get_state())
         return True
 
     def restore_from_disk(self, filename: str, merge=False):
@@ -925,7 +1193,10 @@ class Commands(Guards):
         if not os.path.exists(filename):
             return False
         with open(filename, "rb") as file_handle:
-            state = pickle.load(file_handle)
+            try:
+                state = load_snapshot(file_handle)
+            except SnapshotError as error:
+                raise CommandError(f"Could not restore {filename}: {error}") from error
         self._set_state(state, merge=merge)
         return True
 
@@ -941,55 +1212,126 @@ class Commands(Guards):
         """Raises a shutdown exception"""
         raise Shutdown("shutting down")
 
-    def _decode_timestamp(self, timestamp: str):
-        """Decodes a given timestamp"""
+    @staticmethod
+    def _decode_timestamp(timestamp) -> float:
+        """
+        Decodes a timestamp of the schedule
+        :param timestamp: epoch seconds, as a number or a string, or a date formatted Y-m-d H:M:S[.f] in local time
+        :return: epoch seconds
+        :raises CommandError if the timestamp can not be decoded
+        """
+        if isinstance(timestamp, (int, float)):
+            return float(timestamp)
         timestamp_ = decode(timestamp)
+        try:
+            return float(timestamp_)
+        except ValueError:
+            pass
         fmt = "%Y-%m-%d %H:%M:%S"
         if "." in timestamp_:
             fmt = fmt + ".%f"
         try:
-            return datetime.datetime.strptime(timestamp_, fmt)
+            return datetime.datetime.strptime(timestamp_, fmt).timestamp()
         except ValueError as error:
             raise CommandError(
-                f"Timestamp {timestamp} must be formatted Y-m-d H:M:S"
+                f"Timestamp {timestamp} must be epoch seconds or formatted Y-m-d H:M:S"
             ) from error
 
     def schedule_add(self, timestamp, data) -> int:
         """
         Adds a new schedule to recorded schedules
-        :param timestamp: timestamp to decode
+        :param timestamp: timestamp the data is due at, see _decode_timestamp
         :param data: data to add to schedule
+        :return: 1 once added
+        :raises CommandError if the timestamp can not be decoded
         """
-        try:
-            decoded_timestamp = self._decode_timestamp(timestamp)
-            heapq.heappush(self._schedule, (decoded_timestamp, data))
-            return 1
-        except Exception as error:
-            raise CommandError(
-                f"timestamp {timestamp} does not exist {error}"
-            ) from error
+        self._schedule.add(self._decode_timestamp(timestamp), data)
+        if self._schedule_readers:
+            self.arm_schedule_timer()
+        return 1
 
-    def schedule_read(self, timestamp=None) -> List:
-        """
-        Reads a given timestamp and returns the schedules that are less than the given timestamp. This removes the
-        schedules from the given schedule record.
+    def schedule_read(self, *args) -> Union[List, Waiter]:
+        """
+        Removes and returns the scheduled data that is due, earliest first. Takes an optional timestamp, which
+        defaults to now, followed by options:
+            LIMIT count returns at most count items
+            BLOCK timeout blocks the client until an item is due when none is, for at most timeout seconds or forever
+            if 0. Blocking reads take no timestamp
+        :param args: timestamp and options
+        :return: list of data, a Waiter if the client has to block
+        :raises CommandError if the timestamp or options are invalid
+        """
+        args = list(args)
+        timestamp = None
+        if len(args) % 2:
+            timestamp = self._decode_timestamp(args.pop(0))
+        limit, deadline, block = None, None, False
+        for option, value in zip(args[::2], args[1::2]):
+            option = decode(option).upper()
+            if option == "LIMIT":
+                try:
+                    limit = int(value)
+                except (TypeError, ValueError) as error:
+                    raise CommandError(f"LIMIT must be an integer, got {value}") from error
+                if limit < 1:
+                    raise CommandError("LIMIT must be positive")
+            elif option == "BLOCK":
+                deadline, block = self._deadline(value), True
+            else:
+                raise CommandError(f"unsupported READ option {option}")
+        if block and timestamp is not None:
+            raise CommandError("READ BLOCK reads the data due now, it takes no timestamp")
+
+        items = self._schedule.pop_due(time.time() if timestamp is None else timestamp, limit)
+        if items or not block:
+            return items
+        while self._schedule_readers and self._schedule_readers[0][0].done:
+            self._schedule_readers.popleft()
+        # the waiter has no keys, it is only queued for its timeout
+        waiter = self._waiters.block(Waiter(keys=[], deadline=deadline))
+        self._schedule_readers.append((waiter, limit))
+        self.arm_schedule_timer()
+        return waiter
+
+    def serve_schedule_readers(self, timestamp: float) -> int:
+        """
+        Hands the data that is due to the blocked schedule reads, in the order they blocked
+        :param timestamp: current timestamp
+        :return: number of reads served
+        """
+        served = 0
+        readers = self._schedule_readers
+        while readers and self._schedule.next_due() is not None and self._schedule.next_due() <= timestamp:
+            waiter, limit = readers.popleft()
+            if not self._waiters.claim(waiter):
+                continue
+            items = self._schedule.pop_due(timestamp, limit)
+            self.on_handed_off([b"READ", b"inf", b"LIMIT", len(items)])
+            waiter.finish(items)
+            served += 1
+        return served
+
+    def next_schedule_wakeup(self) -> Optional[float]:
+        """
+        Returns the timestamp blocked schedule reads have to be served at
+        :return: timestamp the earliest item is due at, None if no read is blocked or the schedule is empty
+        """
+        while self._schedule_readers and self._schedule_readers[0][0].done:
+            self._schedule_readers.popleft()
+        return self._schedule.next_due() if self._schedule_readers else None
+
+    def arm_schedule_timer(self):
+        """
+        Called when a schedule read blocks or data is added while reads are blocked, so that the reads are served
+        once the earliest item is due. Does nothing by default
         """
-        try:
-            decoded_timestamp = self._decode_timestamp(timestamp)
-            accum = []
-            while self._schedule and self._schedule[0][0] <= decoded_timestamp:
-                _, data = heapq.heappop(self._schedule)
-                accum.append(data)
-            return accum
-        except Exception as error:
-            raise CommandError(f"Failed to read {timestamp}. Error: {error}") from error
 
     def schedule_flush(self) -> int:
         """
         Flushes the schedule and returns the previous length.
         """
         schedule_len = self.schedule_length()
-        self._schedule = []
+        self._schedule.clear()
         return schedule_len
 
     def schedule_length(self) -> int:
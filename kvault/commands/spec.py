@@ -0,0 +1,164 @@
+"""
+Describes the keys each command operates on, so that requests can be routed and checked without running them
+"""
+from typing import Any, Callable, Dict, List, NamedTuple, Optional, Sequence
+
+KeyExtractor = Callable[[Sequence[Any]], List[Any]]
+
+
+def no_keys(_: Sequence[Any]) -> List[Any]:
+    """Command does not operate on keys"""
+    return []
+
+
+def first_key(args: Sequence[Any]) -> List[Any]:
+    """First argument is the key"""
+    return list(args[:1])
+
+
+def first_two_keys(args: Sequence[Any]) -> List[Any]:
+    """First two arguments are keys"""
+    return list(args[:2])
+
+
+def all_but_last_keys(args: Sequence[Any]) -> List[Any]:
+    """Every argument but the last is a key"""
+    return list(args[:-1])
+
+
+def all_keys(args: Sequence[Any]) -> List[Any]:
+    """Every argument is a key"""
+    return list(args)
+
+
+def mapping_keys(args: Sequence[Any]) -> List[Any]:
+    """First argument is a mapping of keys to values"""
+    if args and isinstance(args[0], dict):
+        return list(args[0])
+    return []
+
+
+class CommandSpec(NamedTuple):
+    """
+    Specification of a command
+    :cvar keys extracts the keys from the arguments of the command
+    :cvar write is set for commands that may modify the store, which are recorded in the append only log
+    :cvar grows is set for write commands that may add data to the store, which are refused when the store is out of
+    memory
+    """
+
+    keys: KeyExtractor = no_keys
+    write: bool = False
+    grows: bool = False
+
+
+COMMAND_SPECS: Dict[bytes, CommandSpec] = {
+    # Queue commands
+    b"LPUSH": CommandSpec(keys=first_key, write=True, grows=True),
+    b"RPUSH": CommandSpec(keys=first_key, write=True, grows=True),
+    b"LPOP": CommandSpec(keys=first_key, write=True),
+    b"RPOP": CommandSpec(keys=first_key, write=True),
+    b"LREM": CommandSpec(keys=first_key, write=True),
+    b"LLEN": CommandSpec(keys=first_key),
+    b"LINDEX": CommandSpec(keys=first_key),
+    b"LRANGE": CommandSpec(keys=first_key),
+    b"LSCAN": CommandSpec(keys=first_key),
+    b"LSET": CommandSpec(keys=first_key, write=True, grows=True),
+    b"LTRIM": CommandSpec(keys=first_key, write=True),
+    b"RPOPLPUSH": CommandSpec(keys=first_two_keys, write=True),
+    b"BLPOP": CommandSpec(keys=all_but_last_keys, write=True),
+    b"BRPOP": CommandSpec(keys=all_but_last_keys, write=True),
+    b"BRPOPLPUSH": CommandSpec(keys=first_two_keys, write=True),
+    b"LFLUSH": CommandSpec(keys=first_key, write=True),
+    # K/V commands
+    b"APPEND": CommandSpec(keys=first_key, write=True, grows=True),
+    b"DECR": CommandSpec(keys=first_key, write=True, grows=True),
+    b"DECRBY": CommandSpec(keys=first_key, write=True, grows=True),
+    b"DELETE": CommandSpec(keys=first_key, write=True),
+    b"EXISTS": CommandSpec(keys=first_key),
+    b"GET": CommandSpec(keys=first_key),
+    b"GETSET": CommandSpec(keys=first_key, write=True, grows=True),
+    b"INCR": CommandSpec(keys=first_key, write=True, grows=True),
+    b"INCRBY": CommandSpec(keys=first_key, write=True, grows=True),
+    b"MDELETE": CommandSpec(keys=all_keys, write=True),
+    b"MGET": CommandSpec(keys=all_keys),
+    b"MPOP": CommandSpec(keys=all_keys, write=True),
+    b"MSET": CommandSpec(keys=mapping_keys, write=True, grows=True),
+    b"MSETEX": CommandSpec(keys=mapping_keys, write=True, grows=True),
+    b"POP": CommandSpec(keys=first_key, write=True),
+    b"SET": CommandSpec(keys=first_key, write=True, grows=True),
+    b"SETNX": CommandSpec(keys=first_key, write=True, grows=True),
+    b"SETEX": CommandSpec(keys=first_key, write=True, grows=True),
+    # Hash commands.
+    b"HDEL": CommandSpec(keys=first_key, write=True),
+    b"HEXISTS": CommandSpec(keys=first_key),
+    b"HGET": CommandSpec(keys=first_key),
+    b"HGETALL": CommandSpec(keys=first_key),
+    b"HINCRBY": CommandSpec(keys=first_key, write=True, grows=True),
+    b"HKEYS": CommandSpec(keys=first_key),
+    b"HLEN": CommandSpec(keys=first_key),
+    b"HMGET": CommandSpec(keys=first_key),
+    b"HMSET": CommandSpec(keys=first_key, write=True, grows=True),
+    b"HSET": CommandSpec(keys=first_key, write=True, grows=True),
+    b"HSETNX": CommandSpec(keys=first_key, write=True, grows=True),
+    b"HVALS": CommandSpec(keys=first_key),
+    b"HSCAN": CommandSpec(keys=first_key),
+    # Set commands.
+    b"SADD": CommandSpec(keys=first_key, write=True, grows=True),
+    b"SCARD": CommandSpec(keys=first_key),
+    b"SDIFF": CommandSpec(keys=all_keys),
+    b"SDIFFSTORE": CommandSpec(keys=all_keys, write=True, grows=True),
+    b"SINTER": CommandSpec(keys=all_keys),
+    b"SINTERSTORE": CommandSpec(keys=all_keys, write=True, grows=True),
+    b"SISMEMBER": CommandSpec(keys=first_key),
+    b"SMEMBERS": CommandSpec(keys=first_key),
+    b"SSCAN": CommandSpec(keys=first_key),
+    b"SPOP": CommandSpec(keys=first_key, write=True),
+    b"SREM": CommandSpec(keys=first_key, write=True),
+    b"SUNION": CommandSpec(keys=all_keys),
+    b"SUNIONSTORE": CommandSpec(keys=all_keys, write=True, grows=True),
+    # Schedule commands.
+    b"ADD": CommandSpec(write=True, grows=True),
+    b"READ": CommandSpec(write=True),
+    b"FLUSH_SCHEDULE": CommandSpec(write=True),
+    # Misc.
+    b"EXPIRE": CommandSpec(keys=first_key, write=True),
+    b"EXPIREAT": CommandSpec(keys=first_key, write=True),
+    b"PEXPIREAT": CommandSpec(keys=first_key, write=True),
+    b"FLUSH": CommandSpec(write=True),
+    b"FLUSHALL": CommandSpec(write=True),
+    b"RESTORE": CommandSpec(write=True, grows=True),
+    b"MERGE": CommandSpec(write=True, grows=True),
+}
+
+
+def command_keys(command: bytes, args: Sequence[Any]) -> List[Any]:
+    """
+    Returns the keys a command operates on
+    :param command: upper cased command name
+    :param args: arguments of the command
+    :return: list of keys
+    """
+    spec = COMMAND_SPECS.get(command)
+    if spec is None:
+        return []
+    return spec.keys(args)
+
+
+def command_spec(command: bytes) -> Optional[CommandSpec]:
+    """
+    Returns the specification of a command
+    :param command: upper cased command name
+    :return: specification or None for commands without one
+    """
+    return COMMAND_SPECS.get(command)
+
+
+def is_write_command(command: bytes) -> bool:
+    """
+    Checks whether a command may modify the store
+    :param command: upper cased command name
+    :return: True for write commands
+    """
+    spec = COMMAND_SPECS.get(command)
+    return spec is not None and spec.write
@@ -0,0 +1,204 @@
+"""
+Per command statistics: the number of calls, the time spent running them and a histogram of their latencies. Like an
+HDR histogram, latencies are counted in buckets whose width grows with the latency, so that every latency is recorded
+with the same relative precision in a bounded number of buckets. A latency in microseconds below 2^SUB_BUCKET_BITS has
+a bucket of its own, larger ones share a bucket with the latencies having the same SUB_BUCKET_BITS most significant
+bits, which keeps the error of a percentile under 1 / 2^(SUB_BUCKET_BITS - 1), about 3%.
+
+Recording a call is a couple of integer operations and a list increment, cheap enough to run for every command.
+"""
+from typing import Any, Dict, Iterable, Iterator, List, Tuple
+
+SUB_BUCKET_BITS = 6
+SUB_BUCKETS = 1 << SUB_BUCKET_BITS
+# buckets per power of two past the first SUB_BUCKETS microseconds
+HALF_BUCKETS = SUB_BUCKETS >> 1
+# percentiles reported by INFO commandstats
+PERCENTILES = (50.0, 99.0, 99.9)
+
+
+def bucket_index(usec: int) -> int:
+    """
+    Returns the bucket counting a latency
+    :param usec: latency in microseconds
+    :return: index of the bucket
+    """
+    if usec < SUB_BUCKETS:
+        return usec
+    shift = usec.bit_length() - SUB_BUCKET_BITS
+    return shift * HALF_BUCKETS + (usec >> shift)
+
+
+def bucket_upper_bound(index: int) -> int:
+    """
+    Returns the highest latency counted by a bucket
+    :param index: index of the bucket
+    :return: latency in microseconds
+    """
+    if index < SUB_BUCKETS:
+        return index
+    shift, mantissa = divmod(index - SUB_BUCKETS, HALF_BUCKETS)
+    return ((mantissa + HALF_BUCKETS + 1) << (shift + 1)) - 1
+
+
+class LatencyHistogram:
+    """
+    Counts of latencies in buckets of the same relative width
+    """
+
+    def __init__(self):
+        """Creates an empty histogram"""
+        # number of latencies counted by every bucket
+        self.counts: List[int] = []
+
+    def __len__(self) -> int:
+        """Returns the number of latencies recorded"""
+        return sum(self.counts)
+
+    def record(self, usec: int):
+        """
+        Counts a latency
+        :param usec: latency in microseconds
+        """
+        index = bucket_index(usec)
+        counts = self.counts
+        if index >= len(counts):
+            counts.extend([0] * (index + 1 - len(counts)))
+        counts[index] += 1
+
+    def percentile(self, percentile: float) -> int:
+        """
+        Returns the latency a percentage of the recorded latencies are lower than or equal to
+        :param percentile: percentage between 0 and 100
+        :return: highest latency in microseconds of the bucket holding the percentile, 0 if nothing was recorded
+        """
+        target = max(1, -int(-percentile * len(self) // 100))
+        seen = 0
+        for index, count in enumerate(self.counts):
+            seen += count
+            if seen >= target:
+                return bucket_upper_bound(index)
+        return 0
+
+    def buckets(self) -> Iterator[Tuple[int, int]]:
+        """
+        Yields the non empty buckets
+        :return: iterator of the highest latency in microseconds of every bucket and its count, lowest first
+        """
+        for index, count in enumerate(self.counts):
+            if count:
+                yield bucket_upper_bound(index), count
+
+
+# pylint: disable-next=too-few-public-methods
+class CommandStats:
+    """
+    Statistics of a command
+    """
+
+    __slots__ = ("calls", "failed_calls", "nsec", "histogram")
+
+    def __init__(self):
+        """Creates empty statistics"""
+        self.calls = 0
+        self.failed_calls = 0
+        self.nsec = 0
+        self.histogram = LatencyHistogram()
+
+    def info(self) -> Dict[str, Any]:
+        """
+        Returns the statistics reported by INFO commandstats
+        :return: calls, failed calls, total and mean microseconds and latency percentiles
+        """
+        info: Dict[str, Any] = {
+            "calls": self.calls,
+            "failed_calls": self.failed_calls,
+            "usec": self.nsec // 1000,
+            "usec_per_call": round(self.nsec / self.calls / 1000, 2) if self.calls else 0.0,
+        }
+        for percentile in PERCENTILES:
+            info[f"p{percentile:g}".replace(".", "")] = self.histogram.percentile(percentile)
+        return info
+
+
+class CommandStatsTable:
+    """
+    Statistics of every command called since the server started or the statistics were reset
+    """
+
+    def __init__(self):
+        """Creates an empty table"""
+        self._stats: Dict[bytes, CommandStats] = {}
+
+    def __len__(self) -> int:
+        """Returns the number of commands called"""
+        return len(self._stats)
+
+    def __iter__(self) -> Iterator[Tuple[bytes, CommandStats]]:
+        """Yields the commands called and their statistics, sorted by command name"""
+        return iter(sorted(self._stats.items()))
+
+    def _get(self, command: bytes) -> CommandStats:
+        """
+        Returns the statistics of a command, creating them on its first call
+        :param command: name of the command
+        :return: statistics
+        """
+        stats = self._stats.get(command)
+        if stats is None:
+            stats = self._stats[command] = CommandStats()
+        return stats
+
+    def record(self, command: bytes, nsec: int):
+        """
+        Records a call that completed
+        :param command: name of the command
+        :param nsec: nanoseconds the call took
+        """
+        stats = self._stats.get(command)
+        if stats is None:
+            stats = self._stats[command] = CommandStats()
+        stats.calls += 1
+        stats.nsec += nsec
+        # LatencyHistogram.record inlined, as it runs for every command
+        usec = nsec // 1000
+        if usec < SUB_BUCKETS:
+            index = usec
+        else:
+            shift = usec.bit_length() - SUB_BUCKET_BITS
+            index = shift * HALF_BUCKETS + (usec >> shift)
+        counts = stats.histogram.counts
+        if index >= len(counts):
+            counts.extend([0] * (index + 1 - len(counts)))
+        counts[index] += 1
+
+    def record_failure(self, command: bytes):
+        """
+        Records a call that failed
+        :param command: name of the command
+        """
+        self._get(command).failed_calls += 1
+
+    def select(self, commands: Iterable[bytes]) -> List[Tuple[bytes, CommandStats]]:
+        """
+        Returns the statistics of some commands
+        :param commands: names of the commands, every command called if empty
+        :return: list of command names and statistics, leaving out the commands that were not called
+        """
+        commands = list(commands)
+        if not commands:
+            return list(self)
+        return [(command, self._stats[command]) for command in commands if command in self._stats]
+
+    def reset(self, commands: Iterable[bytes] = ()) -> int:
+        """
+        Drops the statistics of some commands
+        :param commands: names of the commands, every command if empty
+        :return: number of commands whose statistics were dropped
+        """
+        commands = list(commands)
+        if not commands:
+            dropped = len(self._stats)
+            self._stats.clear()
+            return dropped
+        return sum(self._stats.pop(command, None) is not None for command in commands)
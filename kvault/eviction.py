@@ -0,0 +1,300 @@
+"""
+Memory limit of the store and the eviction policies used to stay under it. The memory used by every key is estimated
+when it is written, so the total is known without walking the store. When a write finds the store over the limit, keys
+are evicted until it is back under. Like Redis, evictions pick the best candidate out of a small random sample of keys
+instead of keeping the keys ordered, so every eviction costs O(1):
+
+    allkeys-lru  - least recently used key
+    volatile-lru - least recently used key out of the keys with an expiry time
+    allkeys-lfu  - least frequently used key, counted with a logarithmic counter that decays over time
+    volatile-ttl - key that is closest to expiring
+    random       - any key
+    noeviction   - no key is evicted, writes that may add data are refused instead
+"""
+from typing import Any, Dict, List, Optional
+from dataclasses import dataclass
+from itertools import islice
+import os
+import random
+import resource
+import sys
+import time
+from .expiry import ExpiryIndex
+from .types import Entry, Value
+
+EVICTION_POLICIES = ("allkeys-lru", "volatile-lru", "allkeys-lfu", "volatile-ttl", "random", "noeviction")
+
+# number of items of a container that are measured to estimate the size of all of its items
+CONTAINER_SAMPLES = 5
+# approximate size of an entry of the dictionary holding the store
+DICT_ENTRY_SIZE = 3 * 8
+
+LFU_INIT_VALUE = 5
+LFU_LOG_FACTOR = 10
+LFU_DECAY_TIME = 60
+
+NO_VICTIM = object()
+
+_UNITS = {"b": 1, "kb": 1024, "mb": 1024**2, "gb": 1024**3}
+
+
+def parse_memory(value: str) -> int:
+    """
+    Parses an amount of memory with an optional unit, e.g. 100mb
+    :param value: amount of memory in bytes, kb, mb or gb
+    :return: number of bytes
+    :raises ValueError if the amount can not be parsed
+    """
+    value = value.strip().lower()
+    for unit in ("kb", "mb", "gb", "b"):
+        if value.endswith(unit):
+            return int(float(value[: -len(unit)]) * _UNITS[unit])
+    return int(value)
+
+
+def used_memory_rss() -> int:
+    """
+    Returns the resident memory of the process. Falls back to the peak resident memory where /proc is not available
+    :return: number of bytes
+    """
+    try:
+        with open("/proc/self/statm", "rb") as statm:
+            return int(statm.read().split()[1]) * os.sysconf("SC_PAGE_SIZE")
+    except OSError:
+        # ru_maxrss is in kilobytes on Linux and bytes on macOS
+        rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+        return rss if sys.platform == "darwin" else rss * 1024
+
+
+def _sizeof(obj: Any) -> int:
+    """
+    Estimates the size of an object. The items of containers are estimated from the first few of them, so the cost
+    does not grow with the size of the container
+    :param obj: object to estimate
+    :return: size in bytes
+    """
+    size = sys.getsizeof(obj)
+    if isinstance(obj, (str, bytes, int, float)) or not hasattr(obj, "__len__"):
+        return size
+    length = len(obj)
+    if not length:
+        return size
+    if isinstance(obj, dict):
+        sample = [sys.getsizeof(key) + sys.getsizeof(item) for key, item in islice(obj.items(), CONTAINER_SAMPLES)]
+    else:
+        sample = [sys.getsizeof(item) for item in islice(obj, CONTAINER_SAMPLES)]
+    return size + sum(sample) * length // len(sample)
+
+
+def estimate_size(key: Any, value: Any) -> int:
+    """
+    Estimates the memory used by a key
+    :param key: Key
+    :param value: entry of the key in the store, a Value or an inline value
+    :return: size in bytes
+    """
+    size = DICT_ENTRY_SIZE + sys.getsizeof(key)
+    if isinstance(value, Value):
+        return size + sys.getsizeof(value) + _sizeof(value.value)
+    return size + _sizeof(value)
+
+
+@dataclass(slots=True)
+class KeyUsage:
+    """
+    Contains the memory and usage of a key
+    :cvar size is the estimated size of the key in bytes
+    :cvar accessed is the monotonic time the key was last accessed
+    :cvar frequency is the logarithmic access counter of the key
+    :cvar index is the position of the key in the list keys are sampled from
+    """
+
+    size: int
+    accessed: float
+    frequency: int
+    index: int
+
+    def decayed_frequency(self, now: float) -> int:
+        """
+        Returns the access counter, decremented for every LFU_DECAY_TIME seconds without access
+        :param now: current monotonic time
+        :return: access counter
+        """
+        return max(self.frequency - int((now - self.accessed) // LFU_DECAY_TIME), 0)
+
+
+class MemoryLimit:
+    """
+    Keeps track of the memory used by the keys of the store and picks keys to evict once it exceeds the limit
+    """
+
+    def __init__(self, maxmemory: int, policy: str = "allkeys-lru", samples: int = 5):
+        """
+        Creates a memory limit
+        :param maxmemory: maximum number of bytes the keys may use
+        :param policy: eviction policy, one of EVICTION_POLICIES
+        :param samples: number of keys sampled to pick a key to evict
+        :raises ValueError if the eviction policy is not supported
+        """
+        if policy not in EVICTION_POLICIES:
+            raise ValueError(
+                f"Unsupported eviction policy {policy}. Supported policies: {', '.join(EVICTION_POLICIES)}"
+            )
+        self.maxmemory = maxmemory
+        self.policy = policy
+        self.samples = samples
+        self.used = 0
+        self.evicted_keys = 0
+        self._usage: Dict[Any, KeyUsage] = {}
+        # keys in a list as well, so that random keys can be sampled in constant time
+        self._keys: List[Any] = []
+
+    def __len__(self) -> int:
+        return len(self._keys)
+
+    def over_limit(self) -> bool:
+        """Returns True if the keys use more memory than the limit"""
+        return self.used > self.maxmemory
+
+    def touch(self, key: Any):
+        """
+        Records an access of a key
+        :param key: Key
+        """
+        usage = self._usage.get(key)
+        if usage is not None:
+            self._access(usage)
+
+    @staticmethod
+    def _access(usage: KeyUsage):
+        """
+        Updates the access time and counter of a key. The counter is incremented with a probability that falls as the
+        counter grows, so that it can count millions of accesses in a byte
+        :param usage: usage of the key
+        """
+        now = time.monotonic()
+        frequency = usage.decayed_frequency(now)
+        if frequency < 255:
+            base = max(frequency - LFU_INIT_VALUE, 0)
+            if random.random() < 1.0 / (base * LFU_LOG_FACTOR + 1):
+                frequency += 1
+        usage.frequency = frequency
+        usage.accessed = now
+
+    def update(self, key: Any, value: Optional[Entry]):
+        """
+        Records a write of a key, estimating its new size
+        :param key: Key
+        :param value: new value of the key, None if the key was removed
+        """
+        if value is None:
+            self.forget(key)
+            return
+        size = estimate_size(key, value)
+        usage = self._usage.get(key)
+        if usage is None:
+            usage = KeyUsage(size, time.monotonic(), LFU_INIT_VALUE, len(self._keys))
+            self._usage[key] = usage
+            self._keys.append(key)
+            self.used += size
+        else:
+            self.used += size - usage.size
+            usage.size = size
+            self._access(usage)
+
+    def forget(self, key: Any):
+        """
+        Stops tracking a key that was removed
+        :param key: Key
+        """
+        usage = self._usage.pop(key, None)
+        if usage is None:
+            return
+        self.used -= usage.size
+        # move the last key into the slot of the removed key
+        last = self._keys.pop()
+        if usage.index < len(self._keys):
+            self._keys[usage.index] = last
+            self._usage[last].index = usage.index
+
+    def rebuild(self, kv_store: Dict[Any, Entry]):
+        """
+        Estimates the memory of every key again, after the store has been replaced
+        :param kv_store: the store
+        """
+        self._usage.clear()
+        self._keys.clear()
+        self.used = 0
+        for key, value in kv_store.items():
+            self.update(key, value)
+
+    def victim(self, kv_store: Dict[Any, Entry], expiry_map: Dict[Any, float], expiry: ExpiryIndex) -> Any:
+        """
+        Picks the key to evict according to the eviction policy out of a sample of keys
+        :param kv_store: the store
+        :param expiry_map: expiry times of the keys
+        :param expiry: index of the keys with an expiry time
+        :return: key to evict or NO_VICTIM if no key can be evicted
+        """
+        if self.policy == "noeviction":
+            return NO_VICTIM
+        if self.policy.startswith("volatile"):
+            candidates = self._sample_volatile(kv_store, expiry_map, expiry)
+        else:
+            candidates = self._sample_keys(kv_store)
+        if not candidates:
+            return NO_VICTIM
+
+        if self.policy == "random":
+            return candidates[0]
+        if self.policy == "volatile-ttl":
+            return min(candidates, key=expiry_map.__getitem__)
+        now = time.monotonic()
+        usage = self._usage
+        if self.policy == "allkeys-lfu":
+            return min(candidates, key=lambda key: usage[key].decayed_frequency(now) if key in usage else 0)
+        return min(candidates, key=lambda key: usage[key].accessed if key in usage else 0)
+
+    def _sample_keys(self, kv_store: Dict[Any, Entry]) -> List[Any]:
+        """
+        Samples random tracked keys. Keys that have been removed without being forgotten are forgotten on the way
+        :param kv_store: the store
+        :return: list of keys
+        """
+        sample = []
+        for _ in range(self.samples):
+            if not self._keys:
+                break
+            key = self._keys[random.randrange(len(self._keys))]
+            if key in kv_store:
+                sample.append(key)
+            else:
+                self.forget(key)
+        return sample
+
+    def _sample_volatile(
+        self, kv_store: Dict[Any, Entry], expiry_map: Dict[Any, float], expiry: ExpiryIndex
+    ) -> List[Any]:
+        """
+        Samples keys with an expiry time. volatile-ttl takes the keys of the earliest expiry buckets, which hold the
+        keys closest to expiring. volatile-lru samples random tracked keys that have an expiry time, falling back to the
+        earliest expiring keys when few keys have one
+        :param kv_store: the store
+        :param expiry_map: expiry times of the keys
+        :param expiry: index of the keys with an expiry time
+        :return: list of keys
+        """
+        if self.policy == "volatile-ttl":
+            return [key for key in expiry.earliest(self.samples) if key in kv_store]
+
+        sample = []
+        # allow a few more draws than samples, as not every tracked key has an expiry time
+        for _ in range(self.samples * 4):
+            if not self._keys or len(sample) >= self.samples:
+                break
+            key = self._keys[random.randrange(len(self._keys))]
+            if key in expiry_map and key in kv_store:
+                sample.append(key)
+        if not sample:
+            sample = [key for key in expiry.earliest(self.samples) if key in kv_store]
+        return sample
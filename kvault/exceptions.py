@@ -18,6 +18,10 @@ class CommandError(Exception):
         super().__init__(message)
 
 
+class WatchError(Exception):
+    """Raised when a transaction did not run because a key it watched was modified"""
+
+
 class ClientQuit(Exception):
     """Raised when a client quits a connection to the server"""
 
@@ -26,6 +30,10 @@ class Shutdown(Exception):
     """Raised when a there is a shutdown command"""
 
 
+class ProtocolError(Exception):
+    """Raised when the bytes received are not a valid message of the wire protocol"""
+
+
 class ServerError(Exception):
     """Raised when a there is a server error"""
 
@@ -34,6 +42,10 @@ class ServerDisconnect(ServerError):
     """Raised when a there is a server disconnect from the connection pool"""
 
 
+class PoolTimeout(ServerError):
+    """Raised when no connection of the socket pool was checked in before the pool timeout"""
+
+
 class ServerInternalError(ServerError):
     """Raised when a there is an internal server error"""
 
@@ -0,0 +1,134 @@
+"""
+Index of the keys with an expiry time. Keys are kept in buckets by the interval of time they expire in, so that setting,
+changing or removing the expiry time of a key moves it between buckets in O(1) instead of leaving stale entries behind
+in a heap. The active expiry cycle removes the keys of the buckets whose interval has passed, while reads check the
+exact expiry time of a key, so an expired key is never returned even if its bucket has not been cleaned up yet.
+"""
+from typing import Any, Dict, List, Optional
+from itertools import islice
+import heapq
+import math
+
+
+class ExpiryIndex:
+    """
+    Keys bucketed by expiry time
+    """
+
+    def __init__(self, resolution: float = 0.1):
+        """
+        Creates an expiry index
+        :param resolution: width in seconds of the interval of a bucket
+        """
+        self.resolution = resolution
+        # bucket number to the keys expiring in the interval of the bucket, dicts are used as ordered sets
+        self._buckets: Dict[int, Dict[Any, None]] = {}
+        # heap of the bucket numbers, a bucket number stays on the heap until the bucket has been cleaned up
+        self._order: List[int] = []
+        self._size = 0
+
+    def __len__(self) -> int:
+        return self._size
+
+    def _bucket(self, timestamp: float) -> int:
+        return math.floor(timestamp / self.resolution)
+
+    def arm(self, key: Any, timestamp: float, previous: Optional[float] = None):
+        """
+        Adds a key to the bucket of its expiry time, moving it out of the bucket of its previous expiry time
+        :param key: Key
+        :param timestamp: timestamp the key expires at
+        :param previous: timestamp the key expired at before, None if it had no expiry time
+        """
+        if previous is not None:
+            self.cancel(key, previous)
+        number = self._bucket(timestamp)
+        bucket = self._buckets.get(number)
+        if bucket is None:
+            bucket = self._buckets[number] = {}
+            heapq.heappush(self._order, number)
+        bucket[key] = None
+        self._size += 1
+
+    def cancel(self, key: Any, timestamp: float):
+        """
+        Removes a key from the bucket of its expiry time
+        :param key: Key
+        :param timestamp: timestamp the key expires at
+        """
+        number = self._bucket(timestamp)
+        bucket = self._buckets.get(number)
+        if bucket is not None and key in bucket:
+            del bucket[key]
+            self._size -= 1
+            if not bucket:
+                # its number is left on the heap and skipped once it reaches the top
+                del self._buckets[number]
+
+    def clear(self):
+        """
+        Removes every key
+        """
+        self._buckets.clear()
+        self._order.clear()
+        self._size = 0
+
+    def _first_bucket(self) -> Optional[int]:
+        """
+        Returns the number of the earliest bucket, dropping the numbers of removed buckets off the heap
+        :return: bucket number or None if there are no buckets
+        """
+        while self._order and self._order[0] not in self._buckets:
+            heapq.heappop(self._order)
+        return self._order[0] if self._order else None
+
+    def has_due(self, timestamp: float) -> bool:
+        """
+        Checks if a bucket whose interval has passed still holds keys
+        :param timestamp: current timestamp
+        :return: True if there are keys to clean up
+        """
+        first = self._first_bucket()
+        return first is not None and first < self._bucket(timestamp)
+
+    def pop_due(self, timestamp: float, limit: Optional[int] = None) -> List[Any]:
+        """
+        Removes and returns the keys of the buckets whose interval has passed
+        :param timestamp: current timestamp
+        :param limit: maximum number of keys to return, None for all of them
+        :return: list of keys
+        """
+        current = self._bucket(timestamp)
+        keys: List[Any] = []
+        while limit is None or len(keys) < limit:
+            first = self._first_bucket()
+            if first is None or first >= current:
+                break
+            bucket = self._buckets[first]
+            while bucket and (limit is None or len(keys) < limit):
+                key, _ = bucket.popitem()
+                keys.append(key)
+            if not bucket:
+                del self._buckets[first]
+                heapq.heappop(self._order)
+        self._size -= len(keys)
+        return keys
+
+    def earliest(self, count: int) -> List[Any]:
+        """
+        Returns keys out of the earliest buckets, i.e. keys that are about to expire
+        :param count: maximum number of keys to return
+        :return: list of keys
+        """
+        first = self._first_bucket()
+        if first is None:
+            return []
+        keys = list(islice(self._buckets[first], count))
+        if len(keys) < count:
+            # rarely needed, the earliest bucket usually holds enough keys
+            for number in heapq.nsmallest(count, self._buckets):
+                if number != first:
+                    keys.extend(islice(self._buckets[number], count - len(keys)))
+                if len(keys) >= count:
+                    break
+        return keys
@@ -0,0 +1,100 @@
+"""
+Gevent stream server
+"""
+from typing import Callable, List
+import gevent
+from gevent import socket
+from gevent.event import Event
+from gevent.pool import Pool
+from gevent.server import StreamServer
+
+
+class GeventStreamServer:
+    """
+    Stream server that handles every connection on a greenlet from a bounded pool
+    """
+
+    def __init__(self, address, handler, max_clients: int = 1024):
+        self.address = address
+        self.handler = handler
+        self._pool = Pool(max_clients)
+        self.stream_server = StreamServer(
+            listener=self.address, handle=self.handler, spawn=self._pool
+        )
+        self._timers: List[Callable[[], float]] = []
+        self._greenlets: List[gevent.Greenlet] = []
+
+    def add_timer(self, callback: Callable[[], float]):
+        """
+        Registers a callback that is called repeatedly in the background while the server is serving. The callback
+        returns the number of seconds to wait before it is called again
+        :param callback: callback to run
+        """
+        self._timers.append(callback)
+
+    @staticmethod
+    def _run_timer(callback: Callable[[], float]):
+        """
+        Runs a timer callback forever
+        :param callback: callback to run
+        """
+        while True:
+            gevent.sleep(callback())
+
+    @staticmethod
+    def cooperate():
+        """
+        Lets other connections run before the current one continues
+        """
+        gevent.sleep(0)
+
+    @staticmethod
+    def spawn(func: Callable, *args):
+        """
+        Runs a function in the background, on a greenlet of its own
+        :param func: function to run
+        :param args: arguments of the function
+        """
+        gevent.spawn(func, *args)
+
+    @staticmethod
+    def call_later(delay: float, callback: Callable[[], None]) -> Callable[[], None]:
+        """
+        Calls a callback once after a delay
+        :param delay: number of seconds to wait
+        :param callback: callback to call
+        :return: function cancelling the call
+        """
+        return gevent.spawn_later(delay, callback).kill
+
+    @staticmethod
+    def create_connection(address):
+        """
+        Connects to another server, e.g. the primary of a replica, with a socket that blocks the calling greenlet only
+        :param address: host and port of the server
+        :return: socket connection
+        """
+        return socket.create_connection(address)
+
+    @staticmethod
+    def event() -> Event:
+        """
+        Returns an event a connection can wait on without blocking other connections
+        """
+        return Event()
+
+    def serve_forever(self):
+        """
+        Serves the server forever
+        """
+        self._greenlets = [gevent.spawn(self._run_timer, timer) for timer in self._timers]
+        try:
+            self.stream_server.serve_forever()
+        finally:
+            gevent.killall(self._greenlets)
+
+    def stop(self):
+        """
+        Stops the running server
+        """
+        self.stream_server.stop()
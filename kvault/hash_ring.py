@@ -0,0 +1,90 @@
+"""
+Consistent hash ring used by the sharded client to spread keys over independent servers. Every node is placed on the
+ring at a number of points, its virtual nodes, and a key belongs to the node of the first point at or after the hash of
+the key, wrapping around. Adding a node only takes over the keys falling just before its own points, about 1/N of them,
+and removing one hands its keys to the nodes following its points, while every other key stays where it was. Virtual
+nodes even out the share of the keys every node gets. Like cluster slots, keys with a hash tag, e.g. {user1}.name, are
+hashed on the tag only, so that related keys end up on the same node.
+"""
+from typing import Any, Dict, List
+import bisect
+import hashlib
+from .cluster import hash_tag
+from .utils import encode
+
+VIRTUAL_NODES = 160
+
+
+def ring_hash(data: bytes) -> int:
+    """
+    Returns the position of data on the ring
+    :param data: encoded key or name of a virtual node
+    :return: 64 bit position
+    """
+    return int.from_bytes(hashlib.blake2b(data, digest_size=8).digest(), "big")
+
+
+class HashRing:
+    """
+    Nodes placed on a ring at the hashes of their virtual nodes
+    """
+
+    def __init__(self, nodes=(), virtual_nodes: int = VIRTUAL_NODES):
+        """
+        Creates a ring
+        :param nodes: nodes to place on the ring, each with a string representation of its own, e.g. host:port
+        :param virtual_nodes: number of points every node is placed at
+        """
+        self.virtual_nodes = virtual_nodes
+        self.nodes: List[Any] = []
+        self._owners: Dict[int, Any] = {}
+        # sorted positions of the points and the node of each of them
+        self._points: List[int] = []
+        self._point_nodes: List[Any] = []
+        for node in nodes:
+            self.add(node)
+
+    def __len__(self) -> int:
+        """Returns the number of nodes"""
+        return len(self.nodes)
+
+    def add(self, node: Any):
+        """
+        Places a node on the ring
+        :param node: node
+        """
+        if node in self.nodes:
+            return
+        self.nodes.append(node)
+        for index in range(self.virtual_nodes):
+            # a point shared with another node, which is unlikely with 64 bit hashes, stays with the first one
+            self._owners.setdefault(ring_hash(f"{node}#{index}".encode("utf-8")), node)
+        self._build()
+
+    def remove(self, node: Any):
+        """
+        Takes a node off the ring, its keys move to the nodes following its points
+        :param node: node
+        """
+        self.nodes.remove(node)
+        self._owners = {point: owner for point, owner in self._owners.items() if owner != node}
+        self._build()
+
+    def _build(self):
+        """
+        Sorts the points of the nodes
+        """
+        self._points = sorted(self._owners)
+        self._point_nodes = [self._owners[point] for point in self._points]
+
+    def get(self, key: Any) -> Any:
+        """
+        Returns the node owning a key
+        :param key: Key
+        :return: node
+        :raises LookupError if the ring is empty
+        """
+        if not self._points:
+            raise LookupError("no node on the ring")
+        index = bisect.bisect_left(self._points, ring_hash(hash_tag(encode(key))))
+        return self._point_nodes[index % len(self._point_nodes)]
@@ -0,0 +1,327 @@
+"""
+Snapshot persistence. A snapshot is a stream of versioned records instead of a single pickle of the whole store, so
+that it can be written and read one key at a time:
+
+    header  | b"KVAULT" | version (2 bytes) |
+    record  | opcode (1 byte) | payload length (4 bytes) | pickled payload |
+    ...
+    trailer | OP_EOF record with the number of records written |
+
+Background saves fork a child process that writes a copy-on-write image of the store while the parent keeps serving,
+like BGSAVE of Redis. The child reports its progress to the parent over a pipe.
+"""
+from typing import Any, BinaryIO, Callable, Dict, Iterator, Optional, Tuple
+from dataclasses import dataclass
+import os
+import pickle
+import struct
+import time
+from .chunked_queue import ChunkedQueue
+from .types import QUEUE, pack, data_type_of, payload_of
+
+MAGIC = b"KVAULT"
+VERSION = 1
+
+OP_KEY = b"K"
+OP_SCHEDULE = b"S"
+OP_EOF = b"E"
+
+_HEADER = struct.Struct(">H")
+_RECORD = struct.Struct(">cI")
+_PROGRESS = struct.Struct(">Q")
+
+
+class SnapshotError(Exception):
+    """Raised when a snapshot can not be read"""
+
+
+class SnapshotWriter:
+    """
+    Writes the records of a snapshot to a binary file
+    """
+
+    def __init__(self, file_handle: BinaryIO):
+        self._file = file_handle
+        self.records = 0
+        self._file.write(MAGIC + _HEADER.pack(VERSION))
+
+    def write_record(self, opcode: bytes, payload: Any):
+        """
+        Writes a single record
+        :param opcode: type of the record
+        :param payload: picklable payload of the record
+        """
+        data = pickle.dumps(payload, pickle.HIGHEST_PROTOCOL)
+        self._file.write(_RECORD.pack(opcode, len(data)))
+        self._file.write(data)
+        self.records += 1
+
+    def write_key(self, key: Any, data_type: int, value: Any, expires: Optional[float]):
+        """
+        Writes a key along with its value and absolute expiry time
+        :param key: Key
+        :param data_type: Data type of the value
+        :param value: Value of the key
+        :param expires: timestamp when the key expires or None
+        """
+        self.write_record(OP_KEY, (key, data_type, value, expires))
+
+    def write_schedule(self, item: Tuple[Any, Any]):
+        """
+        Writes an item of the schedule
+        :param item: tuple of the timestamp and data
+        """
+        self.write_record(OP_SCHEDULE, item)
+
+    def finish(self):
+        """
+        Writes the trailer marking the snapshot as complete
+        """
+        self.write_record(OP_EOF, self.records)
+
+
+def read_records(file_handle: BinaryIO) -> Iterator[Tuple[bytes, Any]]:
+    """
+    Reads the records of a snapshot one at a time. The header must already have been consumed
+    :param file_handle: binary file positioned after the header
+    :return: iterator of opcodes and payloads
+    :raises SnapshotError if the snapshot is truncated
+    """
+    while True:
+        header = file_handle.read(_RECORD.size)
+        if len(header) < _RECORD.size:
+            raise SnapshotError("Snapshot is truncated")
+        opcode, length = _RECORD.unpack(header)
+        data = file_handle.read(length)
+        if len(data) < length:
+            raise SnapshotError("Snapshot is truncated")
+        if opcode == OP_EOF:
+            return
+        yield opcode, pickle.loads(data)
+
+
+def write_snapshot(
+    file_handle: BinaryIO,
+    state: Dict[str, Any],
+    progress: Optional[Callable[[int], None]] = None,
+    progress_interval: int = 1024,
+):
+    """
+    Writes the state of the store as a snapshot. Keys that have already expired are skipped
+    :param file_handle: binary file to write to
+    :param state: state of the store as returned by Commands._get_state
+    :param progress: called with the number of keys written every progress_interval keys
+    :param progress_interval: number of keys between calls of progress
+    """
+    writer = SnapshotWriter(file_handle)
+    now = time.time()
+    expiry_map = state.get("expiry", {})
+    for count, (key, value) in enumerate(state["kv"].items(), start=1):
+        expires = expiry_map.get(key)
+        if expires is None or expires > now:
+            writer.write_key(key, data_type_of(value), payload_of(value), expires)
+        if progress is not None and count % progress_interval == 0:
+            progress(count)
+    for item in state["schedule"]:
+        writer.write_schedule(item)
+    writer.finish()
+
+
+def save_snapshot(filename: str, state: Dict[str, Any], progress: Optional[Callable[[int], None]] = None):
+    """
+    Saves a snapshot to a temporary file and moves it into place once it is complete, so that a failed save never
+    replaces a good snapshot
+    :param filename: file name of the snapshot
+    :param state: state of the store as returned by Commands._get_state
+    :param progress: called with the number of keys written as the snapshot is written
+    """
+    tmp_filename = f"{filename}.tmp-{os.getpid()}"
+    try:
+        with open(tmp_filename, "wb") as file_handle:
+            write_snapshot(file_handle, state, progress)
+            file_handle.flush()
+            os.fsync(file_handle.fileno())
+        os.replace(tmp_filename, filename)
+    except BaseException:
+        try:
+            os.unlink(tmp_filename)
+        except OSError:
+            pass
+        raise
+
+
+def _load_entry(data_type: int, value: Any) -> Any:
+    """
+    Returns the entry to store for a loaded value. Queues saved before they were chunked are deques
+    :param data_type: Data type of the value
+    :param value: the value
+    :return: entry to store
+    """
+    if data_type == QUEUE and not isinstance(value, ChunkedQueue):
+        value = ChunkedQueue(value)
+    return pack(data_type, value)
+
+
+def load_snapshot(file_handle: BinaryIO) -> Dict[str, Any]:
+    """
+    Loads a snapshot. Files written before snapshots were versioned hold a single pickle of the state and are loaded
+    as such
+    :param file_handle: binary file to read from
+    :return: state with kv, schedule and expiry mappings
+    :raises SnapshotError if the snapshot has an unsupported version or is truncated
+    """
+    magic = file_handle.read(len(MAGIC))
+    if magic != MAGIC:
+        file_handle.seek(0)
+        state = pickle.load(file_handle)
+        state["kv"] = {key: _load_entry(value.data_type, value.value) for key, value in state["kv"].items()}
+        state.setdefault("expiry", {})
+        return state
+
+    (version,) = _HEADER.unpack(file_handle.read(_HEADER.size))
+    if version > VERSION:
+        raise SnapshotError(f"Unsupported snapshot version {version}")
+
+    state: Dict[str, Any] = {"kv": {}, "schedule": [], "expiry": {}}
+    for opcode, payload in read_records(file_handle):
+        if opcode == OP_KEY:
+            key, data_type, value, expires = payload
+            state["kv"][key] = _load_entry(data_type, value)
+            if expires is not None:
+                state["expiry"][key] = expires
+        elif opcode == OP_SCHEDULE:
+            state["schedule"].append(payload)
+    return state
+
+
+@dataclass
+class SaveStats:
+    """
+    Contains the statistics of snapshots
+    :cvar in_progress is set while a background save is running
+    :cvar keys_total is the number of keys in the store when the running background save started
+    :cvar keys_written is the number of keys the running background save has written so far
+    :cvar started_at is the timestamp the running background save started at
+    :cvar last_status is the status of the last background save, ok or err
+    :cvar last_duration is the duration in seconds of the last background save
+    :cvar last_save_time is the timestamp of the last successful save
+    """
+
+    in_progress: bool = False
+    keys_total: int = 0
+    keys_written: int = 0
+    started_at: float = 0.0
+    last_status: str = "ok"
+    last_duration: float = 0.0
+    last_save_time: float = 0.0
+
+
+class BackgroundSaver:
+    """
+    Saves snapshots from a forked child process. The child writes the copy-on-write image of the store it inherited,
+    while the parent polls for progress and completion
+    """
+
+    def __init__(self):
+        self.stats = SaveStats()
+        self._pid: Optional[int] = None
+        self._progress_fd: Optional[int] = None
+        self._on_done: Optional[Callable[[bool], None]] = None
+
+    @property
+    def in_progress(self) -> bool:
+        """Returns True while a background save is running"""
+        return self._pid is not None
+
+    def start(self, filename: str, state: Dict[str, Any], on_done: Optional[Callable[[bool], None]] = None) -> bool:
+        """
+        Forks a child process that saves a snapshot of the state
+        :param filename: file name of the snapshot
+        :param state: state of the store as returned by Commands._get_state
+        :param on_done: called with whether the save succeeded once the child has exited
+        :return: False if a background save is already running
+        """
+        if self._pid is not None:
+            return False
+
+        read_fd, write_fd = os.pipe()
+        pid = os.fork()
+        if pid == 0:
+            os.close(read_fd)
+            os.set_blocking(write_fd, False)
+            self._save_child(filename, state, write_fd)
+
+        os.close(write_fd)
+        os.set_blocking(read_fd, False)
+        self._pid = pid
+        self._progress_fd = read_fd
+        self._on_done = on_done
+        self.stats.in_progress = True
+        self.stats.keys_total = len(state["kv"])
+        self.stats.keys_written = 0
+        self.stats.started_at = time.time()
+        return True
+
+    @staticmethod
+    def _save_child(filename: str, state: Dict[str, Any], write_fd: int):
+        """
+        Runs in the child process, saves the snapshot and exits without returning to the server code
+        :param filename: file name of the snapshot
+        :param state: state of the store
+        :param write_fd: write end of the progress pipe
+        """
+
+        def progress(count: int):
+            try:
+                os.write(write_fd, _PROGRESS.pack(count))
+            except BlockingIOError:
+                # the parent has not caught up yet, it will get the next update
+                pass
+
+        status = 1
+        try:
+            save_snapshot(filename, state, progress)
+            status = 0
+        finally:
+            # pylint: disable-next=protected-access
+            os._exit(status)
+
+    def poll(self) -> Optional[bool]:
+        """
+        Collects the progress of the running background save and reaps the child once it has exited
+        :return: None while the save is running or no save was started, else whether the save succeeded
+        """
+        if self._pid is None:
+            return None
+        self._read_progress()
+        pid, status = os.waitpid(self._pid, os.WNOHANG)
+        if pid == 0:
+            return None
+
+        os.close(self._progress_fd)
+        succeeded = os.waitstatus_to_exitcode(status) == 0
+        stats = self.stats
+        stats.in_progress = False
+        stats.last_status = "ok" if succeeded else "err"
+        stats.last_duration = time.time() - stats.started_at
+        if succeeded:
+            stats.keys_written = stats.keys_total
+            stats.last_save_time = time.time()
+        self._pid = None
+        self._progress_fd = None
+        on_done, self._on_done = self._on_done, None
+        if on_done is not None:
+            on_done(succeeded)
+        return succeeded
+
+    def _read_progress(self):
+        """
+        Reads the progress updates the child has sent so far and keeps the latest
+        """
+        try:
+            data = os.read(self._progress_fd, _PROGRESS.size * 1024)
+        except BlockingIOError:
+            return
+        complete = len(data) - len(data) % _PROGRESS.size
+        if complete:
+            (self.stats.keys_written,) = _PROGRESS.unpack(data[complete - _PROGRESS.size:complete])
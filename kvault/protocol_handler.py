@@ -7,13 +7,32 @@ from typing import Union, Optional, List, Dict, Set, Any, Callable
 import json
 from io import BytesIO
 from collections import deque
+from .chunked_queue import ChunkedQueue
 from .exceptions import Error
+from .resp_parser import RespParser, INCOMPLETE
+from .serialization import ARRAY_TYPES, pack, unpack
 from .types import unicode
 from .utils import encode
 from .utils.mixins import MetaUtils
 from .infra.logger import logger
 
 
+# pylint: disable-next=too-few-public-methods
+class Encoded:
+    """
+    Reply that has already been serialized, written as it is
+    """
+
+    __slots__ = ("data",)
+
+    def __init__(self, data: bytes):
+        """
+        Wraps serialized bytes
+        :param data: serialized reply
+        """
+        self.data = data
+
+
 class ProtocolHandler(MetaUtils):
     """
     ProtocolHandler is based on Redis Wire protocol which uses a request/response communication pattern with clients.
@@ -43,6 +62,9 @@ class ProtocolHandler(MetaUtils):
 
     Json string(uses bulk string rules) | '@' | @number of bytes\r\nJSON string\r\n |
 
+    Packed value(uses bulk string rules) | '~' | ~number of bytes\r\nMessagePack bytes\r\n |
+    Arrays, dictionaries and sets are sent packed in one piece by connections that switched to it with HELLO MSGPACK
+
     Array | "*" | "*number of elements\r\n...elements..." |
     *3\r\n+a simple string element\r\n:12345\r\n$7\r\ntesting\r\n
     Empty array: "*0\r\n"
@@ -59,7 +81,8 @@ class ProtocolHandler(MetaUtils):
     """
 
     # pylint: disable-next=missing-function-docstring
-    def __init__(self):
+    def __init__(self, read_size: int = 65536):
+        self.read_size = read_size
         self.handlers: Dict[bytes, Callable] = {
             b"+": self.handle_simple_string,
             b"-": self.handle_error,
@@ -67,6 +90,7 @@ class ProtocolHandler(MetaUtils):
             b"$": self.handle_string,
             b"^": self.handle_unicode,
             b"@": self.handle_json,
+            b"~": self.handle_packed,
             b"*": self.handle_array,
             b"%": self.handle_dict,
             b"&": self.handle_set,
@@ -94,18 +118,107 @@ class ProtocolHandler(MetaUtils):
         rest = socket_file.readline().rstrip(b"\r\n")
         return first_byte + rest
 
-    def write_response(self, socket_file, data: Any):
+    def read_request(self, conn, parser: RespParser) -> Any:
+        """
+        Parse the next request from the receive buffer of a connection. The socket is only read when the buffer does
+        not hold a complete request.
+        :param conn: socket connection
+        :param parser: parser holding the receive buffer of the connection
+        :return: parsed request
+        """
+        request = parser.gets()
+        while request is INCOMPLETE:
+            data = conn.recv(self.read_size)
+            if not data:
+                raise EOFError()
+            parser.feed(data)
+            request = parser.gets()
+        return request
+
+    def encode(self, data: Any, packed: bool = False) -> bytes:
+        """
+        Serialize the response data
+        :param data: Data to serialize
+        :param packed: whether arrays, dictionaries and sets are packed
+        :return: serialized bytes
+        """
+        buf = BytesIO()
+        self.write(buf, data, packed)
+        return buf.getvalue()
+
+    def write(self, buf: BytesIO, data: Any, packed: bool = False):
+        """
+        Serialize the response data onto a buffer, so that several responses can be sent with a single write
+        :param buf: Buffer to write the response to
+        :param data: Data to serialize
+        :param packed: whether arrays, dictionaries and sets are packed
+        """
+        if data.__class__ is Encoded:
+            buf.write(data.data)
+        elif packed and isinstance(data, (ARRAY_TYPES, dict, set)) and not isinstance(data, Error):
+            self._write_packed(buf, data)
+        else:
+            self._write(buf, data)
+
+    def encode_request(self, args: Any, packed: bool = False) -> bytes:
+        """
+        Serialize a request
+        :param args: command name and arguments
+        :param packed: whether the arguments that are arrays, dictionaries or sets are packed. The request itself stays
+        an array, as flat arrays of strings are written faster element by element
+        :return: serialized bytes
+        """
+        buf = BytesIO()
+        self.write_request(buf, args, packed)
+        return buf.getvalue()
+
+    def write_request(self, buf: BytesIO, args: Any, packed: bool = False):
+        """
+        Serialize a request onto a buffer, so that several requests can be sent with a single write
+        :param buf: Buffer to write the request to
+        :param args: command name and arguments
+        :param packed: whether the arguments that are arrays, dictionaries or sets are packed
+        """
+        if not packed:
+            self._write(buf, args)
+            return
+        buf.write(b"*%d\r\n" % len(args))
+        for arg in args:
+            self.write(buf, arg, packed)
+
+    def write_response(self, socket_file, data: Any, packed: bool = False):
         """
         Serialize the response data and send it to the client
         :param socket_file:
         :param data: Data to respond
+        :param packed: whether arrays, dictionaries and sets are packed
         """
-        buf = BytesIO()
-        self._write(buf, data)
-        buf.seek(0)
-        socket_file.write(buf.getvalue())
+        socket_file.write(self.encode(data, packed))
         socket_file.flush()
 
+    def send_response(self, conn, data: Any, packed: bool = False):
+        """
+        Serialize the response data and send it to the client over a socket connection
+        :param conn: socket connection
+        :param data: Data to respond
+        :param packed: whether arrays, dictionaries and sets are packed
+        """
+        conn.sendall(self.encode(data, packed))
+
+    def _write_packed(self, buf: BytesIO, data: Any):
+        """
+        Packs an array, dictionary or set in one pass and writes it as a single bulk. Values that can not be packed,
+        such as integers over 64 bits, are written element by element instead
+        :param buf: Buffer to write the response to
+        :param data: Data to serialize
+        """
+        try:
+            bdata = pack(data)
+        except (TypeError, OverflowError):
+            self._write(buf, data)
+        else:
+            buf.write(b"~%d\r\n%s\r\n" % (len(bdata), bdata))
+
     # pylint: disable-next=too-many-branches
     def _write(self, buf: BytesIO, data: Any):
         """
@@ -125,7 +238,7 @@ class ProtocolHandler(MetaUtils):
             buf.write(b":%d\r\n" % data)
         elif isinstance(data, Error):
             buf.write(b"-%s\r\n" % encode(data.message))
-        elif isinstance(data, (list, tuple, deque)):
+        elif isinstance(data, (list, tuple, deque, ChunkedQueue)):
             buf.write(b"*%d\r\n" % len(data))
             for item in data:
                 self._write(buf, item)
@@ -220,6 +333,14 @@ class ProtocolHandler(MetaUtils):
             return json.loads(deserialized_str)
         return None
 
+    def handle_packed(self, socket_file) -> Any:
+        """
+        Handles a packed value (uses bulk string rules), which is unpacked in one pass
+        :param socket_file: File like object to read data
+        :return: Python object
+        """
+        return unpack(self.handle_string(socket_file=socket_file))
+
     def handle_array(self, socket_file) -> List[Any]:
         """
         Handles array deserialization. Format that is expected has this format "*number of elements\r\n...elements..."
@@ -0,0 +1,226 @@
+"""
+Publish/subscribe. Connections subscribe to channels, or to channel patterns, and switch to push mode: messages
+published to a channel are pushed to them as they are published, without being requested. A published message is
+serialized once per channel or pattern it matches and the same bytes are handed to every subscriber. Handing bytes to
+a subscriber never blocks the publisher, every subscriber has an output buffer of its own and a subscriber whose buffer
+grows past the limit is disconnected, like the pubsub client output buffer limit of Redis.
+"""
+from typing import Any, Callable, Deque, Dict, List, Optional
+from collections import deque
+from fnmatch import fnmatchcase
+import threading
+from .utils import decode
+
+
+# pylint: disable-next=too-many-instance-attributes
+class Outbox:
+    """
+    Bounded output buffer of a connection in push mode, drained by a writer of its own so that a slow subscriber does
+    not block the publishers. Used by the engines whose connections write with blocking sends
+    """
+
+    def __init__(self, limit: int, event, on_overflow: Callable[[], None]):
+        """
+        Creates an output buffer
+        :param limit: maximum number of buffered bytes, the buffer is closed once it would hold more
+        :param event: event of the engine, set whenever data is buffered or the buffer is closed
+        :param on_overflow: called once when the buffer overflows, to disconnect the subscriber
+        """
+        self.limit = limit
+        self.size = 0
+        self.closed = False
+        self.overflowed = False
+        self._chunks: Deque[bytes] = deque()
+        self._event = event
+        self._on_overflow = on_overflow
+        # the writer may run on another thread than the connection and the publishers
+        self._mutex = threading.Lock()
+
+    def put(self, data: bytes, exempt: bool = False) -> bool:
+        """
+        Buffers data to be written to the connection
+        :param data: bytes to write
+        :param exempt: set for data that is not held against the limit, e.g. the snapshot sent to a replica, so that
+        the limit applies again in full once it has been taken by the writer
+        :return: False if the buffer is closed, or has just been closed as it overflowed
+        """
+        with self._mutex:
+            if self.closed:
+                return False
+            overflowed = not exempt and self.size + len(data) > self.limit
+            if overflowed:
+                self.overflowed = True
+                self.closed = True
+                self._chunks.clear()
+            else:
+                self._chunks.append(data)
+                if not exempt:
+                    self.size += len(data)
+        self._event.set()
+        if overflowed:
+            # the writer may be stuck sending to the subscriber, so it is not left to disconnect it
+            self._on_overflow()
+        return not overflowed
+
+    def get(self) -> Optional[bytes]:
+        """
+        Takes all the buffered data, waiting for data if there is none
+        :return: buffered bytes, None once the buffer is closed
+        """
+        while True:
+            with self._mutex:
+                if self._chunks:
+                    data = b"".join(self._chunks)
+                    self._chunks.clear()
+                    self.size = 0
+                    return data
+                if self.closed:
+                    return None
+            self._event.wait()
+            self._event.clear()
+
+    def close(self):
+        """
+        Closes the buffer, the writer stops once it has written the data that is left
+        """
+        with self._mutex:
+            self.closed = True
+        self._event.set()
+
+
+class PubSub:
+    """
+    Subscriptions of the connections to channels and channel patterns
+    """
+
+    def __init__(self):
+        """Creates an empty registry of subscriptions"""
+        # channel or pattern to the connections subscribed to it, dicts are used as ordered sets
+        self._channels: Dict[Any, Dict[Any, None]] = {}
+        self._patterns: Dict[Any, Dict[Any, None]] = {}
+
+    @property
+    def channels(self) -> int:
+        """Returns the number of channels with subscribers"""
+        return len(self._channels)
+
+    @property
+    def patterns(self) -> int:
+        """Returns the number of patterns with subscribers"""
+        return len(self._patterns)
+
+    def subscribe(self, connection, channels) -> List[List[Any]]:
+        """
+        Subscribes a connection to channels
+        :param connection: state of the connection, with subscriptions, patterns and push set
+        :param channels: channels to subscribe to
+        :return: confirmation of every channel, with the number of subscriptions of the connection
+        """
+        replies = []
+        for channel in channels:
+            self._channels.setdefault(channel, {})[connection] = None
+            connection.subscriptions.add(channel)
+            replies.append([b"subscribe", channel, self.count(connection)])
+        return replies
+
+    def psubscribe(self, connection, patterns) -> List[List[Any]]:
+        """
+        Subscribes a connection to channel patterns, glob patterns channels are matched against
+        :param connection: state of the connection
+        :param patterns: patterns to subscribe to
+        :return: confirmation of every pattern, with the number of subscriptions of the connection
+        """
+        replies = []
+        for pattern in patterns:
+            self._patterns.setdefault(pattern, {})[connection] = None
+            connection.patterns.add(pattern)
+            replies.append([b"psubscribe", pattern, self.count(connection)])
+        return replies
+
+    def unsubscribe(self, connection, channels) -> List[List[Any]]:
+        """
+        Unsubscribes a connection from channels
+        :param connection: state of the connection
+        :param channels: channels to unsubscribe from, every subscribed channel if empty
+        :return: confirmation of every channel, with the number of subscriptions left
+        """
+        replies = []
+        for channel in channels or list(connection.subscriptions):
+            self._discard(self._channels, channel, connection)
+            connection.subscriptions.discard(channel)
+            replies.append([b"unsubscribe", channel, self.count(connection)])
+        return replies
+
+    def punsubscribe(self, connection, patterns) -> List[List[Any]]:
+        """
+        Unsubscribes a connection from channel patterns
+        :param connection: state of the connection
+        :param patterns: patterns to unsubscribe from, every subscribed pattern if empty
+        :return: confirmation of every pattern, with the number of subscriptions left
+        """
+        replies = []
+        for pattern in patterns or list(connection.patterns):
+            self._discard(self._patterns, pattern, connection)
+            connection.patterns.discard(pattern)
+            replies.append([b"punsubscribe", pattern, self.count(connection)])
+        return replies
+
+    def remove(self, connection):
+        """
+        Removes every subscription of a connection that went away
+        :param connection: state of the connection
+        """
+        self.unsubscribe(connection, ())
+        self.punsubscribe(connection, ())
+
+    @staticmethod
+    def count(connection) -> int:
+        """
+        Returns the number of channels and patterns a connection is subscribed to
+        :param connection: state of the connection
+        :return: number of subscriptions
+        """
+        return len(connection.subscriptions) + len(connection.patterns)
+
+    @staticmethod
+    def _discard(registry: Dict[Any, Dict[Any, None]], name: Any, connection):
+        """
+        Removes a connection from the subscribers of a channel or pattern
+        :param registry: channels or patterns
+        :param name: channel or pattern
+        :param connection: state of the connection
+        """
+        subscribers = registry.get(name)
+        if subscribers is not None:
+            subscribers.pop(connection, None)
+            if not subscribers:
+                del registry[name]
+
+    def publish(self, channel: Any, message: Any, encode: Callable[[Any], bytes]) -> int:
+        """
+        Pushes a message to the subscribers of a channel and of the patterns matching it
+        :param channel: channel to publish to
+        :param message: the message
+        :param encode: serializes a push message
+        :return: number of subscribers the message was pushed to
+        """
+        receivers = 0
+        subscribers = self._channels.get(channel)
+        if subscribers:
+            receivers += self._fan_out(subscribers, encode([b"message", channel, message]))
+        if self._patterns:
+            name = decode(channel)
+            for pattern, subscribers in list(self._patterns.items()):
+                if fnmatchcase(name, decode(pattern)):
+                    receivers += self._fan_out(subscribers, encode([b"pmessage", pattern, channel, message]))
+        return receivers
+
+    @staticmethod
+    def _fan_out(subscribers: Dict[Any, None], data: bytes) -> int:
+        """
+        Hands the same bytes to every subscriber
+        :param subscribers: connections to push to
+        :param data: serialized message
+        :return: number of subscribers that accepted the message
+        """
+        return sum(1 for connection in list(subscribers) if connection.push(data))
@@ -1,20 +1,50 @@
+# pylint: disable=too-many-lines
 """
 KVault server that is used by the clients to send commands. The QueueServer has the same implementation of the protocol
 handler that clients use to parse and send commands. The queue server uses the protocol handler to serialize &
 deserialize the messages
 """
-from typing import Dict, Callable, Union, Any, List, Tuple
+from typing import Dict, Callable, Union, Any, List, Tuple, Deque, Optional, Sequence, Set
 from dataclasses import dataclass, field
+from collections import deque
+from contextlib import nullcontext
+from io import BytesIO
+import os
+import select
+import socket
+import threading
 import time
-from io import BufferedRWPair
-from gevent.pool import Pool
-from gevent.server import StreamServer
 from kvault.infra.logger import logger
-from .exceptions import ClientQuit, Shutdown, CommandError, Error
-from .protocol_handler import ProtocolHandler
-from .types import basestring, Value, unicode
+from .append_only_log import AppendOnlyLog
+from .asyncio_stream_server import AsyncioStreamServer
+from .blocking import Waiter
+from .cluster import ClusterNode, HASH_SLOTS, key_slot, slot_table
+from .commandstats import CommandStatsTable
+from .expiry import ExpiryIndex
+from .exceptions import ClientQuit, Shutdown, CommandError, Error, ProtocolError
+from .gevent_stream_server import GeventStreamServer
+from .persistence import BackgroundSaver
+from .protocol_handler import Encoded, ProtocolHandler
+from .pubsub import Outbox, PubSub
+from .replication import Primary, Replica, REPL_BACKLOG_SIZE
+from .response_cache import ResponseCache, RESPONSE_CACHE_SIZE
+from .resp_parser import RespParser, INCOMPLETE
+from .schedule import Schedule
+from .serialization import ACCELERATED
+from .types import basestring, Entry, unicode
 from .utils.mixins import MetaUtils
 from .commands import Commands
+from .commands.spec import CommandSpec, command_keys, command_spec
+from .eviction import MemoryLimit, NO_VICTIM, used_memory_rss
+from .threaded_stream_server import ThreadedStreamServer
+from .tracking import KeyTracker, TRACKING_TABLE_MAX_KEYS
+from .utils import decode, encode
+
+ENGINES = ("gevent", "threads", "asyncio")
+# commands replacing the whole store, after which the memory of every key is estimated again
+KEYSPACE_COMMANDS = (b"FLUSH", b"FLUSHALL", b"RESTORE", b"MERGE")
+# commands a connection subscribed to channels may still send
+SUBSCRIBED_COMMANDS = (b"SUBSCRIBE", b"UNSUBSCRIBE", b"PSUBSCRIBE", b"PUNSUBSCRIBE", b"QUIT")
 
 
 @dataclass
@@ -47,23 +77,156 @@ class ServerInfo:
     max_clients: int = 1024
 
 
+@dataclass
+# pylint: disable-next=too-many-instance-attributes
+class ServerConfig:
+    """
+    Contains the settings of the server
+    :cvar expiry_interval is the number of seconds between active expiry cycles
+    :cvar expiry_time_budget is the maximum number of seconds a single active expiry cycle may run for
+    :cvar max_batch_size is the maximum number of pipelined requests of a connection processed before its responses
+    are flushed and other connections get a turn
+    :cvar engine is the engine serving connections, one of gevent, threads or asyncio
+    :cvar cluster contains the nodes sharing the keyspace when the server is one of several workers, each owning a
+    range of hash slots. None when the server owns the whole keyspace
+    :cvar append_only_file is the file name of the append only log, None to disable the log
+    :cvar fsync is the fsync policy of the append only log, one of always, everysec or no
+    :cvar rewrite_min_size is the minimum size in bytes of the append only log before it is rewritten
+    :cvar maxmemory is the maximum number of bytes the keys may use before keys are evicted, 0 for no limit
+    :cvar maxmemory_policy is the eviction policy used once maxmemory is reached
+    :cvar maxmemory_samples is the number of keys sampled to pick a key to evict
+    :cvar output_buffer_limit is the maximum number of bytes buffered for a subscribed connection before it is
+    disconnected, so that a slow subscriber can not hold publishers up
+    :cvar tracking_table_max_keys is the maximum number of keys tracked for the near caches of clients, past which the
+    oldest tracked key is invalidated
+    :cvar response_cache_size is the maximum number of bytes of serialized GET replies kept for hot keys, 0 to disable
+    the cache
+    :cvar replica_of is the host and port of the primary the server replicates on startup, None to start as a primary
+    :cvar repl_backlog_size is the number of bytes of the replication stream kept for replicas to resume from
+    """
+
+    expiry_interval: float = 0.1
+    expiry_time_budget: float = 0.025
+    max_batch_size: int = 256
+    engine: str = "gevent"
+    cluster: Optional[List[ClusterNode]] = None
+    append_only_file: Optional[str] = None
+    fsync: str = "everysec"
+    rewrite_min_size: int = 64 * 1024 * 1024
+    maxmemory: int = 0
+    maxmemory_policy: str = "allkeys-lru"
+    maxmemory_samples: int = 5
+    output_buffer_limit: int = 32 * 1024 * 1024
+    tracking_table_max_keys: int = TRACKING_TABLE_MAX_KEYS
+    response_cache_size: int = RESPONSE_CACHE_SIZE
+    replica_of: Optional[Tuple[str, int]] = None
+    repl_backlog_size: int = REPL_BACKLOG_SIZE
+
+
+@dataclass
+class ExpiryStats:
+    """
+    Contains the statistics of the active expiry cycle
+    :cvar expired_keys is the total number of keys evicted by the active expiry cycle
+    :cvar sweep_cycles is the number of active expiry cycles that have run
+    :cvar last_sweep_duration is the duration in seconds of the most recent active expiry cycle
+    :cvar max_sweep_duration is the duration in seconds of the slowest active expiry cycle
+    :cvar samples contains (timestamp, expired_keys) pairs of recent cycles used to compute the eviction rate
+    """
+
+    expired_keys: int = 0
+    sweep_cycles: int = 0
+    last_sweep_duration: float = 0.0
+    max_sweep_duration: float = 0.0
+    samples: Deque[Tuple[float, int]] = field(default_factory=lambda: deque(maxlen=16))
+
+    def evictions_per_sec(self) -> float:
+        """
+        Computes the eviction rate over the recorded samples
+        :return: number of keys evicted per second
+        """
+        if len(self.samples) < 2:
+            return 0.0
+        (start, start_count), (end, end_count) = self.samples[0], self.samples[-1]
+        if end <= start:
+            return 0.0
+        return (end_count - start_count) / (end - start)
+
+
 @dataclass
 class ServerState:
     """
     Contains the server state
     :cvar kv_store is the in memory Key Value store
-    :cvar schedule contains a list of tuples of scheduled commands
-    :cvar expiry
+    :cvar schedule contains the scheduled data ordered by the time it is due at
+    :cvar expiry is the index of the keys with an expiry time, bucketed by expiry time
     :cvar expiry_map a key value pair where the key is the expiry time and the value is the value. This contains the
     expired data
     """
 
-    kv_store: Dict[Any, Value] = field(default_factory=dict)
-    schedule: List[Tuple[Any, Any]] = field(default_factory=list)
-    expiry: List[Tuple[float, Any]] = field(default_factory=list)
+    kv_store: Dict[Any, Entry] = field(default_factory=dict)
+    schedule: Schedule = field(default_factory=Schedule)
+    expiry: ExpiryIndex = field(default_factory=ExpiryIndex)
     expiry_map: Dict[Any, float] = field(default_factory=dict)
 
 
+@dataclass(eq=False)
+# pylint: disable-next=too-many-instance-attributes
+class Connection:
+    """
+    Contains the state of a client connection
+    :cvar id identifies the connection, for other connections to refer to it
+    :cvar address is the address of the client
+    :cvar parser holds the receive buffer of the connection
+    :cvar transaction contains the requests queued since MULTI, None when the connection is not in a transaction
+    :cvar transaction_failed is set when a request could not be queued, which aborts the transaction on EXEC
+    :cvar watched are the keys watched by the connection for its next transaction
+    :cvar watch_dirty is set once a watched key is modified, which makes the next EXEC fail
+    :cvar waiter is the blocked pop the connection waits on, requests received meanwhile are handled once it is done
+    :cvar alive checks whether the client is still connected
+    :cvar subscriptions are the channels the connection is subscribed to
+    :cvar patterns are the channel patterns the connection is subscribed to
+    :cvar push writes bytes to the connection without blocking once it is in push mode, None until it subscribes.
+    Returns False once the connection is being disconnected
+    :cvar open_push switches the connection to push mode and returns its push function, provided by the engine
+    :cvar outbox is the output buffer of a connection in push mode, for the engines writing with blocking sends
+    :cvar tracking is the connection invalidations of the keys read by this connection are pushed to, None when
+    tracking is off
+    :cvar packed is set once the connection switched to packed replies with HELLO MSGPACK
+    """
+
+    id: int = 0
+    address: Any = None
+    parser: RespParser = field(default_factory=RespParser)
+    transaction: Optional[List[List[Any]]] = None
+    transaction_failed: bool = False
+    watched: Set[Any] = field(default_factory=set)
+    watch_dirty: bool = False
+    waiter: Optional[Waiter] = None
+    alive: Callable[[], bool] = field(default=lambda: True)
+    subscriptions: Set[Any] = field(default_factory=set)
+    patterns: Set[Any] = field(default_factory=set)
+    push: Optional[Callable[[bytes], bool]] = None
+    open_push: Optional[Callable[[], Callable[[bytes], bool]]] = None
+    outbox: Optional[Outbox] = None
+    tracking: Optional["Connection"] = None
+    packed: bool = False
+
+
+def socket_alive(conn) -> bool:
+    """
+    Checks without blocking whether the client of a socket is still connected
+    :param conn: socket connection
+    :return: False once the client has closed the connection
+    """
+    try:
+        readable, _, _ = select.select([conn], [], [], 0)
+        return not readable or conn.recv(1, socket.MSG_PEEK) != b""
+    except (OSError, ValueError):
+        return False
+
+
+# pylint: disable-next=too-many-instance-attributes,too-many-public-methods
 class QueueServer(Commands, MetaUtils):
     """
     Queue Server where server send commands to
@@ -71,26 +234,65 @@ class QueueServer(Commands, MetaUtils):
 
     # pylint: disable-next=missing-function-docstring
     def __init__(
-            self, host: str = "127.0.0.1", port: int = 31337, max_clients: int = 1024
+            self,
+            host: str = "127.0.0.1",
+            port: int = 31337,
+            max_clients: int = 1024,
+            config: Optional[ServerConfig] = None,
     ):
         self._server_info = ServerInfo(host=host, port=port, max_clients=max_clients)
+        self._config = config = config if config is not None else ServerConfig()
+        self._slot_table: Optional[List[Optional[int]]] = None
+        self._node_index: Optional[int] = None
+        if config.cluster:
+            self._slot_table = slot_table(config.cluster)
+            self._node_index = next(
+                index for index, node in enumerate(config.cluster) if (node.host, node.port) == (host, port)
+            )
 
-        self._pool = Pool(max_clients)
-        self._server = StreamServer(
-            listener=(self._server_info.host, self._server_info.port),
-            handle=self.connection_handler,
-            spawn=self._pool,
-        )
+        self._server = self.create_server(config.engine)
+        # only the threads engine runs requests concurrently, the others interleave connections between requests
+        self._lock = threading.RLock() if config.engine == "threads" else nullcontext()
         self._commands = self.get_commands()
+        self._connection_commands = self.get_connection_commands()
         self._protocol = ProtocolHandler()
 
         self._server_state = ServerState(
-            kv_store={}, schedule=[], expiry=[], expiry_map={}
+            kv_store={}, schedule=Schedule(), expiry=ExpiryIndex(), expiry_map={}
         )
 
         self._counter = Counter(
             active_connections=0, commands_processed=0, command_errors=0, connections=0
         )
+        self._expiry_stats = ExpiryStats()
+        self._command_stats = CommandStatsTable()
+        self._saver = BackgroundSaver()
+        self._log: Optional[AppendOnlyLog] = None
+        if config.append_only_file:
+            self._log = AppendOnlyLog(
+                config.append_only_file, fsync=config.fsync, rewrite_min_size=config.rewrite_min_size
+            )
+        self._memory: Optional[MemoryLimit] = None
+        if config.maxmemory:
+            self._memory = MemoryLimit(
+                config.maxmemory, policy=config.maxmemory_policy, samples=config.maxmemory_samples
+            )
+        # pops handed to blocked clients by the running command, recorded once the command has been
+        self._handed_off: Deque[List[Any]] = deque()
+        # cancels the timer serving the blocked schedule reads and the timestamp it fires at, None when not armed
+        self._schedule_timer: Optional[Callable[[], None]] = None
+        self._schedule_timer_due = 0.0
+        self._pubsub = PubSub()
+        self._tracker = KeyTracker(self._protocol.encode, config.tracking_table_max_keys)
+        self._responses: Optional[ResponseCache] = None
+        if config.response_cache_size:
+            self._responses = ResponseCache(self._protocol.encode, config.response_cache_size)
+        # open connections by id
+        self._clients: Dict[int, Connection] = {}
+        # watched key to the connections watching it, dicts are used as ordered sets
+        self._watchers: Dict[Any, Dict[Connection, None]] = {}
+        # set while the writes streamed by the primary are applied, the only writes a replica accepts
+        self._applying_stream = False
 
         super().__init__(
             kv_store=self._server_state.kv_store,
@@ -98,6 +300,72 @@ class QueueServer(Commands, MetaUtils):
             expiry=self._server_state.expiry,
             schedule=self._server_state.schedule,
         )
+        self._primary = Primary(
+            self._protocol.encode, self._waiters, config.repl_backlog_size, config.output_buffer_limit
+        )
+        self._replica = Replica(self._server, self._lock, self._protocol.encode, self._load_state, self._apply_stream)
+
+    def create_server(self, engine: str):
+        """
+        Creates the stream server for the given engine
+        :param engine: one of gevent, threads or asyncio
+        :return: stream server
+        :raises ValueError if the engine is not supported
+        """
+        address = (self._server_info.host, self._server_info.port)
+        if engine == "gevent":
+            return GeventStreamServer(address, self.connection_handler, self._server_info.max_clients)
+        if engine == "threads":
+            return ThreadedStreamServer(address, self.connection_handler)
+        if engine == "asyncio":
+            return AsyncioStreamServer(address, self)
+        raise ValueError(f"Unsupported engine {engine}. Supported engines: {', '.join(ENGINES)}")
+
+    def open_connection(self, address) -> Optional[Connection]:
+        """
+        Registers a new client connection
+        :param address: address of the client
+        :return: state of the connection or None if the server already has the maximum number of clients
+        """
+        if self._counter.active_connections >= self._server_info.max_clients:
+            logger.error(f"[{self.name}] Max number of clients reached, refusing {address}")
+            return None
+        logger.info(f"[{self.name}] Connection received: {address}")
+        self._counter.active_connections += 1
+        self._counter.connections += 1
+        connection = Connection(id=self._counter.connections, address=address)
+        self._clients[connection.id] = connection
+        return connection
+
+    def close_connection(self, connection: Connection):
+        """
+        Unregisters a client connection
+        :param connection: state of the connection
+        """
+        self._counter.active_connections -= 1
+        self._clients.pop(connection.id, None)
+        # the keys it read are left in the tracking table, they are skipped once they change
+        connection.tracking = None
+        if connection.waiter is not None:
+            with self._lock:
+                self._waiters.cancel(connection.waiter)
+                connection.waiter = None
+        if connection.subscriptions or connection.patterns:
+            with self._lock:
+                self._pubsub.remove(connection)
+        if connection.watched:
+            with self._lock:
+                self.unwatch(connection)
+        if self._primary.source is not None:
+            with self._lock:
+                self._primary.source.remove_replica(connection)
+        if connection.outbox is not None:
+            connection.outbox.close()
+
+    @property
+    def output_buffer_limit(self) -> int:
+        """Returns the maximum number of bytes buffered for a subscribed connection"""
+        return self._config.output_buffer_limit
 
     def connection_handler(self, conn, address):
         """
@@ -105,38 +373,201 @@ class QueueServer(Commands, MetaUtils):
         :param conn: File like socket object
         :param address: address to handle connection on
         """
-        logger.info(f"[{self.name}] Connection received: {address}")
-        socket_file = conn.makefile("rwb")
-        self._counter.active_connections += 1
+        connection = self.open_connection(address)
+        if connection is None:
+            conn.close()
+            return
+        conn.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+        connection.alive = lambda: socket_alive(conn)
+        connection.open_push = lambda: self.open_outbox(conn, connection)
         while True:
             try:
-                self.request_response(socket_file)
-            except EOFError:
+                self.request_response(conn, connection)
+                if connection.parser:
+                    # the batch limit was reached, let other connections run before processing the rest
+                    self._server.cooperate()
+            except (EOFError, ConnectionError):
                 logger.info(f"Client went away: {address}")
-                socket_file.close()
+                conn.close()
                 break
             except ClientQuit:
                 logger.info(f"Client exited: {address}")
                 break
+            except ProtocolError as exc:
+                try:
+                    conn.sendall(self.protocol_error(address, exc))
+                except OSError:
+                    pass
+                conn.close()
+                break
             # pylint: disable-next=broad-exception-caught
             except Exception as exc:
                 logger.exception(f"Error processing command: {exc}", exc)
-        self._counter.active_connections -= 1
+        self.close_connection(connection)
+
+    def protocol_error(self, address, error: ProtocolError) -> bytes:
+        """
+        Logs an invalid request, after which the connection that sent it is closed as the requests following it can
+        not be told apart
+        :param address: address of the connection
+        :param error: error raised by the parser
+        :return: error reply sent before closing the connection
+        """
+        logger.warning(f"Closing a connection that sent an invalid request: {address}: {error}")
+        return self._protocol.encode(Error(f"ERR Protocol error: {error}"))
+
+    def request_response(self, conn, connection: Connection):
+        """
+        Handles the requests from a connection and responds on the protocol handler. Waits for a request if none is
+        buffered, then also handles the pipelined requests that are already in the receive buffer and flushes all the
+        responses with a single write.
+        :param conn: socket connection
+        :param connection: state of the connection
+        """
+        data = self._protocol.read_request(conn, connection.parser)
+        buf = BytesIO()
+        try:
+            with self._lock:
+                try:
+                    self.process_batch(buf, connection, data)
+                finally:
+                    self.push_responses(buf, connection)
+        finally:
+            if connection.push is None:
+                conn.sendall(buf.getvalue())
+
+        while connection.waiter is not None:
+            # park until the blocked pop is served or times out, outside the lock so other connections keep running
+            waiter, event = connection.waiter, self._server.event()
+            with self._lock:
+                if not waiter.done:
+                    waiter.notify = event.set
+            if not waiter.done:
+                event.wait()
+            buf = BytesIO()
+            try:
+                with self._lock:
+                    try:
+                        self.resume(buf, connection)
+                    finally:
+                        self.push_responses(buf, connection)
+            finally:
+                if connection.push is None:
+                    conn.sendall(buf.getvalue())
+
+    @staticmethod
+    def push_responses(buf: BytesIO, connection: Connection):
+        """
+        Queues the responses of a connection in push mode behind the messages already pushed to it. Called under the
+        lock, so that responses and messages reach the client in the order they were produced
+        :param buf: Buffer holding the responses
+        :param connection: state of the connection
+        """
+        if connection.push is not None and buf.tell():
+            connection.push(buf.getvalue())
+
+    def open_outbox(self, conn, connection: Connection) -> Callable[[bytes], bool]:
+        """
+        Switches a connection of a blocking engine to push mode. Pushed bytes go into a bounded output buffer which
+        is written to the socket by a writer of its own
+        :param conn: socket connection
+        :param connection: state of the connection
+        :return: push function of the connection
+        """
+        connection.outbox = Outbox(
+            self._config.output_buffer_limit, self._server.event(), lambda: self._disconnect_subscriber(conn)
+        )
+        self._server.spawn(self._outbox_writer, conn, connection.outbox)
+        return connection.outbox.put
+
+    @staticmethod
+    def _outbox_writer(conn, outbox: Outbox):
+        """
+        Writes the output buffer of a connection in push mode to its socket until the buffer is closed
+        :param conn: socket connection
+        :param outbox: output buffer of the connection
+        """
+        while True:
+            data = outbox.get()
+            if data is None:
+                break
+            try:
+                conn.sendall(data)
+            except OSError:
+                break
 
-    def request_response(self, socket_file: BufferedRWPair):
+    def _disconnect_subscriber(self, conn):
         """
-        Handles the request from a socket file and responds on the protocol handler
-        :param socket_file: File like object
+        Shuts down the socket of a subscriber over the output buffer limit, which wakes up its writer and ends its
+        request loop
+        :param conn: socket connection
         """
-        data = self._protocol.handle_request(socket_file)
+        logger.warning(f"[{self.name}] Disconnecting a subscriber over the output buffer limit")
         try:
-            resp = self.respond(data)
+            conn.shutdown(socket.SHUT_RDWR)
+        except OSError:
+            pass
+
+    def resume(self, buf: BytesIO, connection: Connection) -> int:
+        """
+        Serializes the response of the blocked pop of a connection once it is done, then handles the requests received
+        while it was blocked
+        :param buf: Buffer to write responses to
+        :param connection: state of the connection
+        :return: number of requests handled, including the blocked pop
+        """
+        waiter, connection.waiter = connection.waiter, None
+        self._protocol.write(buf, waiter.result, connection.packed)
+        return 1 + self.process_batch(buf, connection)
+
+    def process_batch(self, buf: BytesIO, connection: Connection, data: Any = INCOMPLETE) -> int:
+        """
+        Handles up to max_batch_size complete requests of a connection back to back and serializes the responses onto
+        a buffer. Requests beyond the limit are left in the receive buffer of the connection.
+        :param buf: Buffer to write responses to
+        :param connection: state of the connection
+        :param data: request that has already been taken from the receive buffer, if any
+        :return: number of requests handled
+        """
+        if data is INCOMPLETE:
+            data = connection.parser.gets()
+        processed = 0
+        try:
+            while data is not INCOMPLETE:
+                self.handle_request(buf, data, connection)
+                processed += 1
+                if processed >= self._config.max_batch_size or connection.waiter is not None:
+                    break
+                data = connection.parser.gets()
+        finally:
+            # the writes of the batch reach the log before any of its responses are sent
+            self._flush_writes()
+        return processed
+
+    def _flush_writes(self):
+        """
+        Flushes the requests recorded since the last flush to the append only log and the replicas
+        """
+        if self._log is not None:
+            self._log.flush()
+        if self._primary.source is not None:
+            self._primary.source.flush()
+
+    def handle_request(self, buf: BytesIO, data: Any, connection: Connection):
+        """
+        Handles a single request and serializes its response onto a buffer
+        :param buf: Buffer to write the response to
+        :param data: the request
+        :param connection: state of the connection
+        """
+        try:
+            resp = self.respond(data, connection)
         except Shutdown as exc:
             logger.info(f"[{self.name}] Shutting down...")
-            self._protocol.write_response(socket_file=socket_file, data=1)
+            self._protocol.write(buf, 1)
             raise KeyboardInterrupt from exc
         except ClientQuit:
-            self._protocol.write_response(socket_file=socket_file, data=1)
+            self._protocol.write(buf, 1)
             raise
         except CommandError as cmd_error:
             resp = Error(cmd_error.message)
@@ -147,15 +578,62 @@ class QueueServer(Commands, MetaUtils):
             resp = Error(f"Unhandled server error: {err}")
         else:
             self._counter.commands_processed += 1
-        self._protocol.write_response(socket_file=socket_file, data=resp)
+            if isinstance(resp, Waiter):
+                # the response is written once the pop is served or times out
+                resp.alive = connection.alive
+                connection.waiter = resp
+                return
+        self._protocol.write(buf, resp, connection.packed)
 
-    def respond(self, data):
+    def respond(self, data, connection: Optional[Connection] = None):
         """
         Responds to a given command with the given data. The data is split into 2 parts, the first part is the command
         the second is the data.
         :param data: data to respond to
+        :param connection: state of the connection the command was received on, if any
         :return: response from callback
         """
+        data = self._split_request(data)
+        command = data[0].upper()
+        if connection is not None:
+            if (connection.subscriptions or connection.patterns) and command not in SUBSCRIBED_COMMANDS:
+                raise CommandError(
+                    f"{command} is not allowed while subscribed, only (P)SUBSCRIBE, (P)UNSUBSCRIBE and QUIT are"
+                )
+            if command in self._connection_commands:
+                return self._connection_commands[command](connection, *data[1:])
+            if connection.transaction is not None:
+                return self.queue_command(connection, command, data)
+
+        if command not in self._commands:
+            logger.error(f"{self.name} Unrecognized command: {command}")
+            raise CommandError(f"Unrecognized command: {command}")
+
+        if self._slot_table is not None:
+            self.check_slots(command, data[1:])
+        spec = command_spec(command)
+        write = spec is not None and spec.write
+        if write:
+            self._prepare_write(command, data[1:], spec.grows)
+        start = time.perf_counter_ns()
+        try:
+            result = self._commands[command](*data[1:])
+        except (ClientQuit, Shutdown):
+            raise
+        except Exception:
+            self._command_stats.record_failure(command)
+            raise
+        self._command_stats.record(command, time.perf_counter_ns() - start)
+        return self._after_command(command, data, result, spec, connection)
+
+    @staticmethod
+    def _split_request(data) -> List[Any]:
+        """
+        Returns a request as a list of the command and its arguments, splitting requests sent as a single string
+        :param data: the request
+        :return: the command followed by its arguments
+        :raises CommandError if the request has no command name
+        """
         if isinstance(data, str):
             try:
                 data = data.split()
@@ -166,13 +644,580 @@ class QueueServer(Commands, MetaUtils):
             raise CommandError(
                 f"First parameter must be command name. Received {data[0]}"
             )
+        return data
 
-        command = data[0].upper()
+    def _prepare_write(self, command: bytes, args: List[Any], grows: bool):
+        """
+        Prepares for a write command: replicas only accept the writes streamed by their primary, the scans of the keys
+        written are invalidated and keys are evicted until the store is back under the memory limit
+        :param command: name of the command
+        :param args: arguments of the command
+        :param grows: whether the command may add data to the store
+        :raises CommandError if the server is a replica or no key can be evicted
+        """
+        if self._replica.link is not None and not self._applying_stream:
+            raise CommandError("READONLY replicas only serve reads")
+        if self._cursors.live:
+            self.before_write(command_keys(command, args))
+        if self._memory is not None:
+            self.free_memory(grows)
+
+    def _after_command(
+            self,
+            command: bytes,
+            data: List[Any],
+            result: Any,
+            spec: Optional[CommandSpec],
+            connection: Optional[Connection],
+    ) -> Any:
+        """
+        Signals the keys a command modified or read, updates their memory statistics and records a write in the append
+        only log and the replication stream
+        :param command: name of the command
+        :param data: the request
+        :param result: response of the command
+        :param spec: spec of the command, None for commands operating on no key
+        :param connection: state of the connection the command was received on, if any
+        :return: response to send
+        """
+        write = spec is not None and spec.write
+        if write:
+            if self._tracker or self._watchers or self._responses:
+                if command in KEYSPACE_COMMANDS:
+                    self.keyspace_flushed()
+                else:
+                    self.keys_modified(command_keys(command, data[1:]))
+        elif spec is not None and connection is not None and connection.tracking is not None:
+            self._tracker.track(connection, command_keys(command, data[1:]))
+        if command == b"GET" and connection is not None and self._responses is not None and result is not None:
+            result = Encoded(self._responses.get(data[1], result, connection.packed))
+        if isinstance(result, Waiter) and connection is None:
+            # transactions and replayed requests can not block, they time out right away
+            self._waiters.cancel(result)
+            result = None
+        if self._memory is not None:
+            self.track_memory(command, data[1:], write)
+        if write and (self._log is not None or self._primary.source is not None):
+            self.propagate(command, data[1:], result)
+        self.record_handed_off()
+        return result
+
+    def record_handed_off(self):
+        """
+        Records the pops handed to blocked clients, once the request that served them has been recorded
+        """
+        while self._handed_off:
+            request = self._handed_off.popleft()
+            if self._memory is not None:
+                self.track_memory(request[0], request[1:], True)
+            self.record_request(request)
+            if self._tracker or self._watchers or self._responses:
+                self.keys_modified(command_keys(request[0], request[1:]))
+
+    def free_memory(self, grows: bool):
+        """
+        Evicts keys according to the eviction policy until the store is back under the memory limit
+        :param grows: whether the command about to run may add data to the store
+        :raises CommandError if the store is over the limit, no key can be evicted and the command may add data
+        """
+        memory = self._memory
+        while memory.over_limit():
+            key = memory.victim(self._kv, self._expiry_map, self._expiry)
+            if key is NO_VICTIM:
+                if grows:
+                    raise CommandError("OOM command not allowed when used memory > maxmemory")
+                return
+            self._kv.pop(key, None)
+            self.unexpire(key)
+            if self._tracker or self._watchers or self._responses:
+                self.keys_modified((key,))
+            memory.forget(key)
+            memory.evicted_keys += 1
+            if self._log is not None or self._primary.source is not None:
+                self.propagate(b"DELETE", [key], 1)
+
+    def track_memory(self, command: bytes, args: List[Any], write: bool):
+        """
+        Updates the memory and access statistics of the keys a command operated on
+        :param command: name of the command
+        :param args: arguments of the command
+        :param write: whether the command may have modified the keys
+        """
+        if command in KEYSPACE_COMMANDS:
+            self._memory.rebuild(self._kv)
+            return
+        for key in command_keys(command, args):
+            if write:
+                self._memory.update(key, self._kv.get(key))
+            elif key in self._kv:
+                self._memory.touch(key)
+            else:
+                # removed as it expired
+                self._memory.forget(key)
+
+    def on_handed_off(self, request: List[Any]):
+        """
+        Records the pop of a value handed to a blocked client, once the push that served it has been recorded
+        :param request: request with the same effect as the pop
+        """
+        recorded = self._log is not None or self._primary.source is not None or self._memory is not None
+        if recorded or self._tracker or self._watchers or self._responses:
+            self._handed_off.append(request)
+
+    def arm_schedule_timer(self):
+        """
+        Arms the timer serving the blocked schedule reads for the time the earliest item is due at, unless it is
+        already armed for an earlier time
+        """
+        due = self.next_schedule_wakeup()
+        if due is None:
+            return
+        if self._schedule_timer is not None:
+            if self._schedule_timer_due <= due:
+                return
+            self._schedule_timer()
+        self._schedule_timer_due = due
+        self._schedule_timer = self._server.call_later(max(due - time.time(), 0), self._schedule_timeout)
+
+    def _schedule_timeout(self):
+        """
+        Serves the blocked schedule reads once the earliest item is due, then arms the timer for the next one
+        """
+        with self._lock:
+            self._schedule_timer = None
+            self.serve_schedule_readers(time.time())
+            self.record_handed_off()
+            if self._primary.source is not None:
+                self._primary.source.flush()
+            self.arm_schedule_timer()
+
+    def on_key_expired(self, key):
+        """
+        Stops tracking the memory of an expired key and signals that it was modified
+        :param key: Key
+        """
+        if self._memory is not None:
+            self._memory.forget(key)
+        if self._tracker or self._watchers or self._responses:
+            self.keys_modified((key,))
+
+    def keys_modified(self, keys: Sequence[Any]):
+        """
+        Called with the keys that were written, expired or evicted. Invalidates them in the near caches of the clients
+        and in the cache of serialized replies, and fails the transactions watching them
+        :param keys: keys modified
+        """
+        if self._tracker:
+            self._tracker.invalidate(keys)
+        if self._responses:
+            self._responses.invalidate(keys)
+        if self._watchers:
+            for key in keys:
+                for connection in self._watchers.get(key, ()):
+                    connection.watch_dirty = True
+
+    def keyspace_flushed(self):
+        """
+        Called once every key may have been modified, by a flush or a restore
+        """
+        if self._tracker:
+            self._tracker.flush()
+        if self._responses:
+            self._responses.clear()
+        for watchers in self._watchers.values():
+            for connection in watchers:
+                connection.watch_dirty = True
+
+    def propagate(self, command: bytes, args: List[Any], result: Any):
+        """
+        Records a write request that completed successfully in the append only log and the replication stream.
+        Requests whose effect depends on when or how they ran are recorded as requests with the same effect when they
+        are replayed: relative expiry times become absolute ones and popped random members are removed by name.
+        :param command: name of the command
+        :param args: arguments of the command
+        :param result: response of the command
+        """
+        if command == b"EXPIRE":
+            requests = [self._expire_request(args[0])]
+        elif command == b"SETEX":
+            requests = [[b"SET", args[0], args[1]], self._expire_request(args[0])]
+        elif command == b"MSETEX":
+            requests = [[b"MSET", args[0]]]
+            requests.extend(self._expire_request(key) for key in args[0])
+        elif command == b"SPOP":
+            requests = [[b"SREM", args[0], *result]] if result else []
+        elif command in (b"BLPOP", b"BRPOP"):
+            # a blocked pop is recorded when a push serves it
+            requests = [[b"LPOP" if command == b"BLPOP" else b"RPOP", result[0]]] if isinstance(result, list) else []
+        elif command == b"BRPOPLPUSH":
+            requests = [] if result is None or isinstance(result, Waiter) else [[b"RPOPLPUSH", args[0], args[1]]]
+        elif command == b"READ":
+            # the items read are the earliest ones, whatever the time the read ran at
+            requests = [[b"READ", b"inf", b"LIMIT", len(result)]] if isinstance(result, list) and result else []
+        else:
+            requests = [[command, *args]]
+
+        for request in requests:
+            self.record_request(request)
+
+    def record_request(self, request: List[Any]):
+        """
+        Appends a request to the append only log and the replication stream
+        :param request: request as a list of the command and its arguments
+        """
+        if self._log is not None:
+            self._log.append(request)
+        if self._primary.source is not None:
+            self._primary.source.append(request)
+
+    def check_slots(self, command: bytes, args: List[Any]):
+        """
+        Checks that the keys of a command hash to slots owned by this server
+        :param command: name of the command
+        :param args: arguments of the command
+        :raises CommandError with the node owning the slot if a key belongs to another node
+        """
+        for key in command_keys(command, args):
+            slot = key_slot(key)
+            owner = self._slot_table[slot]
+            if owner != self._node_index:
+                node = self._config.cluster[owner]
+                raise CommandError(f"MOVED {slot} {node.host}:{node.port}")
+
+    def slots(self) -> List[List[Any]]:
+        """
+        Returns the ranges of hash slots and the nodes owning them
+        :return: list of [start slot, end slot, host, port]
+        """
+        if not self._config.cluster:
+            return [[0, HASH_SLOTS - 1, self._server_info.host, self._server_info.port]]
+        return [list(node) for node in self._config.cluster]
+
+    def psync(self, connection: Connection, replid, offset) -> Any:
+        """
+        Syncs a replica and streams the writes to it from then on. A replica that followed the stream up to an offset
+        still in the backlog resumes from it, any other gets a snapshot of the store
+        :param connection: state of the connection of the replica
+        :param replid: id of the replication stream the replica followed, ? if none
+        :param offset: offset in the stream the replica got to, -1 if none
+        :return: CONTINUE with the id of the stream, its offset and the writes the replica missed, or a waiter that is
+        finished once FULLRESYNC with the id of the stream, its offset and the snapshot has been pushed
+        :raises CommandError if the offset is invalid or the connection can not be pushed to
+        """
+        return self._primary.psync(connection, replid, offset, self._get_state)
+
+    def replicaof(self, host, port) -> int:
+        """
+        Makes the server a replica of another server, which then only serves reads. The replica loads a snapshot of the
+        primary and applies its writes as they happen, in the background. REPLICAOF NO ONE makes the server a primary
+        again, keeping its keys
+        :param host: host of the primary, or NO
+        :param port: port of the primary, or ONE
+        :return: 1 once the replica started following the primary
+        :raises CommandError if the port is invalid or the server can not be a replica
+        """
+        host, port = decode(host), decode(port)
+        if (host.upper(), port.upper()) == ("NO", "ONE"):
+            self._replica.stop()
+            return 1
+        if self._config.engine == "asyncio":
+            raise CommandError("REPLICAOF is not supported by the asyncio engine")
+        if self._slot_table is not None:
+            raise CommandError("REPLICAOF is not supported in cluster mode")
+        try:
+            port = int(port)
+        except ValueError as error:
+            raise CommandError(f"invalid port {port}") from error
+        self._replica.start(host, port)
+        return 1
+
+    def _load_state(self, state: Dict[str, Any]):
+        """
+        Replaces the store with the state of a snapshot of the primary
+        :param state: state of the store
+        """
+        self._set_state(state)
+        self.keyspace_flushed()
+        if self._memory is not None:
+            self._memory.rebuild(self._kv)
+        if self._log is not None:
+            # the log is folded into the new state, so that it does not replay the writes of the old one
+            self._log.rewrite(self._get_state())
+
+    def _apply_stream(self, parser: RespParser):
+        """
+        Applies the complete writes buffered from the replication stream of the primary
+        :param parser: parser holding the stream
+        """
+        self._applying_stream = True
+        try:
+            request = parser.gets()
+            while request is not INCOMPLETE:
+                self._replay(request)
+                request = parser.gets()
+        finally:
+            self._applying_stream = False
+            self._flush_writes()
+
+    def replication_info(self) -> Dict[str, Any]:
+        """
+        Returns the replication fields of INFO
+        :return: dictionary mapping of the replication information
+        """
+        info = {"role": "replica" if self._replica.link is not None else "primary", **self._primary.info()}
+        info.update(self._replica.info())
+        return info
+
+    def get_connection_commands(self) -> Dict[Union[bytes, str], Callable]:
+        """
+        Returns a mapping of commands that act on the state of the connection they are received on to handlers. The
+        handlers receive the connection as their first argument.
+        :return: Dictionary of commands to handlers
+        """
+        return dict(
+            (
+                (b"MULTI", self.multi),
+                (b"EXEC", self.exec_transaction),
+                (b"DISCARD", self.discard),
+                (b"WATCH", self.watch),
+                (b"UNWATCH", self.unwatch),
+                (b"SUBSCRIBE", self.subscribe),
+                (b"PSUBSCRIBE", self.psubscribe),
+                (b"UNSUBSCRIBE", self.unsubscribe),
+                (b"PUNSUBSCRIBE", self.punsubscribe),
+                (b"CLIENT", self.client),
+                (b"HELLO", self.hello),
+                (b"PSYNC", self.psync),
+            )
+        )
+
+    def client(self, connection: Connection, subcommand, *args) -> int:
+        """
+        Handles the subcommands acting on the connection itself:
+            CLIENT ID returns the id of the connection
+            CLIENT TRACKING ON REDIRECT id remembers the keys read on the connection and pushes their invalidations to
+            the connection with the given id, which has to be subscribed to __kvault__:invalidate
+            CLIENT TRACKING OFF stops tracking the keys read on the connection
+        :param connection: state of the connection
+        :param subcommand: ID or TRACKING
+        :param args: arguments of the subcommand
+        :return: id of the connection for ID, 1 for TRACKING
+        :raises CommandError if the subcommand or its arguments are invalid
+        """
+        subcommand = decode(subcommand).upper()
+        if subcommand == "ID":
+            return connection.id
+        if subcommand != "TRACKING":
+            raise CommandError(f"Unsupported CLIENT subcommand {subcommand}")
+        mode = decode(args[0]).upper() if args else ""
+        if mode == "OFF":
+            connection.tracking = None
+            return 1
+        if mode != "ON" or len(args) != 3 or decode(args[1]).upper() != "REDIRECT":
+            raise CommandError("syntax error, expected CLIENT TRACKING ON REDIRECT id or CLIENT TRACKING OFF")
+        try:
+            target = self._clients.get(int(args[2]))
+        except (TypeError, ValueError) as error:
+            raise CommandError(f"invalid client id {args[2]}") from error
+        if target is None:
+            raise CommandError(f"no client with id {args[2]}")
+        connection.tracking = target
+        return 1
+
+    @staticmethod
+    def hello(connection: Connection, serializer=None) -> Dict[str, Any]:
+        """
+        Picks how the replies to the connection are serialized:
+            HELLO MSGPACK packs arrays, dictionaries and sets in one piece with MessagePack
+            HELLO RESP writes them element by element, the default
+        Requests may use either serialization whatever the choice
+        :param connection: state of the connection
+        :param serializer: MSGPACK or RESP, the serialization is left as is if not given
+        :return: the serialization of the connection and whether the server packs with the msgpack C extension. The
+        reply is already serialized the way that was picked
+        :raises CommandError if the serializer is unknown
+        """
+        if serializer is not None:
+            serializer = decode(serializer).upper()
+            if serializer not in ("MSGPACK", "RESP"):
+                raise CommandError(f"Unsupported serializer {serializer}, expected MSGPACK or RESP")
+            connection.packed = serializer == "MSGPACK"
+        return {"serializer": "msgpack" if connection.packed else "resp", "accelerated": int(ACCELERATED)}
+
+    @staticmethod
+    def _open_push(connection: Connection, command: str, names: Tuple[Any, ...]):
+        """
+        Switches a connection to push mode before it subscribes
+        :param connection: state of the connection
+        :param command: name of the subscribing command
+        :param names: channels or patterns to subscribe to
+        :raises CommandError if no channel is given or the connection can not be pushed to
+        """
+        if not names:
+            raise CommandError(f"{command} requires at least one channel")
+        if connection.push is None:
+            if connection.open_push is None:
+                raise CommandError(f"{command} is not supported on this connection")
+            connection.push = connection.open_push()
+
+    def subscribe(self, connection: Connection, *channels) -> List[List[Any]]:
+        """
+        Subscribes the connection to channels. Messages published to them are pushed to the connection from then on
+        :param connection: state of the connection
+        :param channels: channels to subscribe to
+        :return: subscribe, the channel and the number of subscriptions of the connection, for every channel
+        """
+        self._open_push(connection, "SUBSCRIBE", channels)
+        return self._pubsub.subscribe(connection, channels)
+
+    def psubscribe(self, connection: Connection, *patterns) -> List[List[Any]]:
+        """
+        Subscribes the connection to channel patterns, e.g. news.*
+        :param connection: state of the connection
+        :param patterns: glob patterns to subscribe to
+        :return: psubscribe, the pattern and the number of subscriptions of the connection, for every pattern
+        """
+        self._open_push(connection, "PSUBSCRIBE", patterns)
+        return self._pubsub.psubscribe(connection, patterns)
+
+    def unsubscribe(self, connection: Connection, *channels) -> List[List[Any]]:
+        """
+        Unsubscribes the connection from channels
+        :param connection: state of the connection
+        :param channels: channels to unsubscribe from, all of them if none is given
+        :return: unsubscribe, the channel and the number of subscriptions left, for every channel
+        """
+        return self._pubsub.unsubscribe(connection, channels)
+
+    def punsubscribe(self, connection: Connection, *patterns) -> List[List[Any]]:
+        """
+        Unsubscribes the connection from channel patterns
+        :param connection: state of the connection
+        :param patterns: patterns to unsubscribe from, all of them if none is given
+        :return: punsubscribe, the pattern and the number of subscriptions left, for every pattern
+        """
+        return self._pubsub.punsubscribe(connection, patterns)
+
+    def publish(self, channel, message) -> int:
+        """
+        Publishes a message to a channel. The message is serialized once and the same bytes are pushed to every
+        subscriber of the channel, then once more for every pattern matching the channel
+        :param channel: channel to publish to
+        :param message: the message
+        :return: number of subscribers the message was pushed to
+        """
+        return self._pubsub.publish(channel, message, self._protocol.encode)
+
+    @staticmethod
+    def multi(connection: Connection) -> int:
+        """
+        Starts a transaction on the connection. Requests received after MULTI are queued until EXEC
+        :param connection: connection to start the transaction on
+        :return: 1 once the transaction has started
+        :raises CommandError if the connection is already in a transaction
+        """
+        if connection.transaction is not None:
+            raise CommandError("MULTI calls can not be nested")
+        connection.transaction = []
+        connection.transaction_failed = False
+        return 1
+
+    def queue_command(self, connection: Connection, command: bytes, data: List[Any]) -> bytes:
+        """
+        Queues a request in the transaction of the connection
+        :param connection: connection in a transaction
+        :param command: name of the command
+        :param data: the request
+        :return: QUEUED
+        :raises CommandError if the command is not recognized, which also aborts the transaction
+        """
         if command not in self._commands:
-            logger.error(f"{self.name} Unrecognized command: {command}")
+            connection.transaction_failed = True
             raise CommandError(f"Unrecognized command: {command}")
+        connection.transaction.append(data)
+        return b"QUEUED"
+
+    def exec_transaction(self, connection: Connection) -> Optional[List[Any]]:
+        """
+        Runs the requests queued in the transaction of the connection back to back. As commands never yield to other
+        connections while running, no other request is processed until the transaction completes. The keys watched by
+        the connection are unwatched.
+        :param connection: connection in a transaction
+        :return: list with the response of every queued request, failed requests have an Error as their response.
+        None if a watched key was modified, in which case no request is run
+        :raises CommandError if the connection is not in a transaction or the transaction was aborted
+        """
+        if connection.transaction is None:
+            raise CommandError("EXEC without MULTI")
+        queued, connection.transaction = connection.transaction, None
+        dirty = connection.watch_dirty
+        self.unwatch(connection)
+        if connection.transaction_failed:
+            connection.transaction_failed = False
+            raise CommandError("Transaction discarded because of previous errors")
+        if dirty:
+            return None
+
+        responses = []
+        for data in queued:
+            try:
+                responses.append(self.respond(data))
+            except CommandError as cmd_error:
+                responses.append(Error(cmd_error.message))
+                self._counter.command_errors += 1
+        return responses
 
-        return self._commands[command](*data[1:])
+    def discard(self, connection: Connection) -> int:
+        """
+        Discards the requests queued in the transaction of the connection and unwatches the keys it watched
+        :param connection: connection in a transaction
+        :return: 1 once the transaction has been discarded
+        :raises CommandError if the connection is not in a transaction
+        """
+        if connection.transaction is None:
+            raise CommandError("DISCARD without MULTI")
+        connection.transaction = None
+        connection.transaction_failed = False
+        self.unwatch(connection)
+        return 1
+
+    def watch(self, connection: Connection, *keys) -> int:
+        """
+        Watches keys for the next transaction of the connection. EXEC fails if any of them is written, expires or is
+        evicted before it runs, which makes check-and-set possible: read the keys, then write them in a transaction
+        that only runs if they have not changed since
+        :param connection: state of the connection
+        :param keys: keys to watch
+        :return: 1 once the keys are watched
+        :raises CommandError if no key is given or the connection is already in a transaction
+        """
+        if connection.transaction is not None:
+            raise CommandError("WATCH inside MULTI is not allowed")
+        if not keys:
+            raise CommandError("WATCH requires at least one key")
+        for key in keys:
+            self._watchers.setdefault(key, {})[connection] = None
+            connection.watched.add(key)
+        return 1
+
+    def unwatch(self, connection: Connection) -> int:
+        """
+        Unwatches every key watched by the connection
+        :param connection: state of the connection
+        :return: 1 once the keys are unwatched
+        :raises CommandError if the connection is in a transaction, which unwatches the keys once it completes
+        """
+        if connection.transaction is not None:
+            raise CommandError("UNWATCH inside MULTI is not allowed")
+        for key in connection.watched:
+            watchers = self._watchers.get(key)
+            if watchers is not None:
+                watchers.pop(connection, None)
+                if not watchers:
+                    del self._watchers[key]
+        connection.watched.clear()
+        connection.watch_dirty = False
+        return 1
 
     def get_commands(self) -> Dict[Union[bytes, str], Callable]:
         """
@@ -190,9 +1235,13 @@ class QueueServer(Commands, MetaUtils):
                 (b"LLEN", self.llen),
                 (b"LINDEX", self.lindex),
                 (b"LRANGE", self.lrange),
+                (b"LSCAN", self.lscan),
                 (b"LSET", self.lset),
                 (b"LTRIM", self.ltrim),
                 (b"RPOPLPUSH", self.rpoplpush),
+                (b"BLPOP", self.blpop),
+                (b"BRPOP", self.brpop),
+                (b"BRPOPLPUSH", self.brpoplpush),
                 (b"LFLUSH", self.lflush),
                 # K/V commands
                 (b"APPEND", self.kv_append),
@@ -213,6 +1262,7 @@ class QueueServer(Commands, MetaUtils):
                 (b"SET", self.kv_set),
                 (b"SETNX", self.kv_setnx),
                 (b"SETEX", self.kv_setex),
+                (b"SCAN", self.scan),
                 (b"LEN", self.kv_len),
                 (b"FLUSH", self.kv_flush),
                 # Hash commands.
@@ -228,6 +1278,7 @@ class QueueServer(Commands, MetaUtils):
                 (b"HSET", self.hset),
                 (b"HSETNX", self.hsetnx),
                 (b"HVALS", self.hvals),
+                (b"HSCAN", self.hscan),
                 # Set commands.
                 (b"SADD", self.sadd),
                 (b"SCARD", self.scard),
@@ -237,6 +1288,7 @@ class QueueServer(Commands, MetaUtils):
                 (b"SINTERSTORE", self.sinterstore),
                 (b"SISMEMBER", self.sismember),
                 (b"SMEMBERS", self.smembers),
+                (b"SSCAN", self.sscan),
                 (b"SPOP", self.spop),
                 (b"SREM", self.srem),
                 (b"SUNION", self.sunion),
@@ -248,30 +1300,132 @@ class QueueServer(Commands, MetaUtils):
                 (b"LENGTH_SCHEDULE", self.schedule_length),
                 # Misc.
                 (b"EXPIRE", self.expire),
+                (b"EXPIREAT", self.expire_at),
+                (b"PEXPIREAT", self.pexpire_at),
                 (b"INFO", self.info),
+                (b"LATENCY", self.latency),
+                (b"CONFIG", self.config),
+                (b"SLOTS", self.slots),
+                (b"PUBLISH", self.publish),
                 (b"FLUSHALL", self.flush_all),
                 (b"SAVE", self.save_to_disk),
+                (b"BGSAVE", self.bgsave),
+                (b"BGREWRITEAOF", self.rewrite_log),
                 (b"RESTORE", self.restore_from_disk),
                 (b"MERGE", self.merge_from_disk),
+                (b"REPLICAOF", self.replicaof),
                 (b"QUIT", self.client_quit),
                 (b"SHUTDOWN", self.shutdown),
             )
         )
 
-    def info(self) -> Dict:
+    def info(self, section=None) -> Dict:
         """
         Retrieves the current information of the server
+        :param section: commandstats for the statistics of every command called, all for everything, the server
+        information if not given
         :return: dictionary mapping of the server information
+        :raises CommandError if the section is unknown
         """
+        section = decode(section).lower() if section is not None else "default"
+        if section == "commandstats":
+            return self.command_stats()
+        if section == "all":
+            return {**self.info(), **self.command_stats()}
+        if section != "default":
+            raise CommandError(f"Unknown INFO section {section}")
         return {
             "active_connections": self._counter.active_connections,
             "commands_processed": self._counter.commands_processed,
             "command_errors": self._counter.command_errors,
             "connections": self._counter.connections,
             "keys": len(self._kv),
+            "blocked_clients": len(self._waiters),
+            "pubsub_channels": self._pubsub.channels,
+            "pubsub_patterns": self._pubsub.patterns,
+            "tracking_total_keys": len(self._tracker),
+            "tracking_invalidations": self._tracker.invalidations,
+            "response_cache_bytes": self._responses.size if self._responses is not None else 0,
+            "response_cache_hits": self._responses.hits if self._responses is not None else 0,
+            "response_cache_misses": self._responses.misses if self._responses is not None else 0,
+            "expired_keys": self._expiry_stats.expired_keys,
+            "expired_keys_per_sec": round(self._expiry_stats.evictions_per_sec(), 2),
+            "expiry_sweep_cycles": self._expiry_stats.sweep_cycles,
+            "expiry_sweep_latency_ms": round(self._expiry_stats.last_sweep_duration * 1000, 3),
+            "expiry_sweep_max_latency_ms": round(self._expiry_stats.max_sweep_duration * 1000, 3),
+            "used_memory": self._memory.used if self._memory else 0,
+            "used_memory_rss": used_memory_rss(),
+            "maxmemory": self._config.maxmemory,
+            "maxmemory_policy": self._config.maxmemory_policy,
+            "evicted_keys": self._memory.evicted_keys if self._memory else 0,
+            "bgsave_in_progress": int(self._saver.stats.in_progress),
+            "bgsave_keys_written": self._saver.stats.keys_written,
+            "bgsave_keys_total": self._saver.stats.keys_total,
+            "last_bgsave_status": self._saver.stats.last_status,
+            "last_bgsave_duration_sec": round(self._saver.stats.last_duration, 3),
+            "last_save_time": self._saver.stats.last_save_time,
+            "aof_enabled": int(self._log is not None),
+            "aof_size": self._log.stats.size if self._log else 0,
+            "aof_base_size": self._log.stats.base_size if self._log else 0,
+            "aof_rewrite_in_progress": int(self._log is not None and self._log.rewrite_in_progress),
+            "aof_rewrites": self._log.stats.rewrites if self._log else 0,
+            "aof_last_rewrite_status": self._log.stats.last_rewrite_status if self._log else "ok",
+            **self.replication_info(),
             "timestamp": time.time(),
         }
 
+    def command_stats(self) -> Dict[str, Dict[str, Any]]:
+        """
+        Returns the statistics of every command called, with the percentiles of their latencies
+        :return: dictionary mapping of cmdstat_ followed by the command name to its statistics
+        """
+        return {f"cmdstat_{decode(command).lower()}": stats.info() for command, stats in self._command_stats}
+
+    def latency(self, subcommand, *commands) -> Any:
+        """
+        Handles the subcommands reporting the latencies of the commands:
+            LATENCY HISTOGRAM [command ...] returns the number of calls and the latency histogram of the commands, every
+            command called if none is given. A histogram maps the highest latency in microseconds of every non empty
+            bucket to the number of calls in it
+            LATENCY RESET [command ...] drops the statistics of the commands, every command if none is given
+        :param subcommand: HISTOGRAM or RESET
+        :param commands: names of the commands
+        :return: histograms for HISTOGRAM, number of commands whose statistics were dropped for RESET
+        :raises CommandError if the subcommand is unknown
+        """
+        subcommand = decode(subcommand).upper()
+        names = [encode(command).upper() for command in commands]
+        if subcommand == "HISTOGRAM":
+            return {
+                decode(command).lower(): {"calls": stats.calls, "histogram_usec": dict(stats.histogram.buckets())}
+                for command, stats in self._command_stats.select(names)
+            }
+        if subcommand == "RESET":
+            return self._command_stats.reset(names)
+        raise CommandError(f"Unsupported LATENCY subcommand {subcommand}")
+
+    def config(self, subcommand, *args) -> int:
+        """
+        Handles the subcommands acting on the configuration of the server:
+            CONFIG RESETSTAT resets the statistics reported by INFO, including the statistics of every command
+        :param subcommand: RESETSTAT
+        :param args: arguments of the subcommand
+        :return: 1 once the statistics are reset
+        :raises CommandError if the subcommand is unknown
+        """
+        subcommand = decode(subcommand).upper()
+        if subcommand != "RESETSTAT" or args:
+            raise CommandError(f"Unsupported CONFIG subcommand {subcommand}")
+        self._command_stats.reset()
+        self._counter.commands_processed = 0
+        self._counter.command_errors = 0
+        self._expiry_stats = ExpiryStats()
+        if self._responses is not None:
+            self._responses.hits = self._responses.misses = 0
+        if self._memory is not None:
+            self._memory.evicted_keys = 0
+        return 1
+
     def flush_all(self):
         """
         Clears the store and scheduled commands
@@ -281,11 +1435,186 @@ class QueueServer(Commands, MetaUtils):
         self.schedule_flush()
         return 1
 
+    def bgsave(self, filename) -> int:
+        """
+        Saves the current state to disk from a forked child process while the server keeps serving requests. The child
+        writes the point in time image of the store it inherited, so writes made after BGSAVE are not part of it.
+        Platforms without fork save in the foreground
+        :param filename: filename to use
+        :return: 1 once the save has started
+        :raises CommandError if a background save is already in progress
+        """
+        if not hasattr(os, "fork"):
+            self.save_to_disk(filename)
+            return 1
+        if not self._saver.start(filename, self._get_state()):
+            raise CommandError("Background save already in progress")
+        logger.info(f"[{self.name}] Background saving started by pid {os.getpid()}")
+        return 1
+
+    def _bgsave_timer(self) -> float:
+        """
+        Collects the progress of a running background save
+        :return: number of seconds until the next check
+        """
+        with self._lock:
+            self._primary.poll()
+        succeeded = self._saver.poll()
+        if succeeded is not None:
+            if succeeded:
+                logger.info(f"[{self.name}] Background saving terminated with success")
+            else:
+                logger.error(f"[{self.name}] Background saving failed")
+        return self._config.expiry_interval
+
+    def _expire_request(self, key) -> List[Any]:
+        """
+        Returns a request setting the current expiry time of a key. The time is sent in milliseconds as floats are
+        serialized as integers
+        :param key: Key
+        :return: PEXPIREAT request
+        """
+        return [b"PEXPIREAT", key, round(self._expiry_map[key] * 1000)]
+
+    def rewrite_log(self) -> int:
+        """
+        Rewrites the append only log in the background, folding it into a snapshot of the current state
+        :return: 1 once the rewrite has started
+        :raises CommandError if the log is disabled or already being rewritten
+        """
+        if self._log is None:
+            raise CommandError("Append only log is not enabled")
+        if not self._log.rewrite(self._get_state()):
+            raise CommandError("Append only log rewrite already in progress")
+        return 1
+
+    def load_log(self) -> int:
+        """
+        Restores the store from the append only log and opens the log for appending
+        :return: number of requests replayed
+        """
+        log, self._log = self._log, None
+        # the requests replayed are not calls of clients, they are left out of the command statistics
+        command_stats, self._command_stats = self._command_stats, CommandStatsTable()
+        try:
+            replayed = log.load(self._set_state, self._replay)
+        finally:
+            self._log = log
+            self._command_stats = command_stats
+        log.open()
+        if self._memory is not None:
+            self._memory.rebuild(self._kv)
+        logger.info(f"[{self.name}] Loaded {replayed} requests from {log.filename}")
+        return replayed
+
+    def _replay(self, request: Any):
+        """
+        Replays a request of the append only log or the replication stream. A request that fails is logged and
+        skipped, as it would have failed when it was first handled
+        :param request: the request
+        """
+        try:
+            self.respond(request)
+        except CommandError as error:
+            logger.warning(f"[{self.name}] Failed to replay {request}: {error.message}")
+        # pylint: disable-next=broad-exception-caught
+        except Exception as error:
+            logger.error(f"[{self.name}] Unhandled exception replaying {request}: {error}")
+
+    def _log_timer(self) -> float:
+        """
+        Runs the periodic work of the append only log
+        :return: number of seconds until the next run
+        """
+        with self._lock:
+            self._log.tick(self._get_state)
+        return self._config.expiry_interval
+
+    def active_expire_cycle(self, keys_per_loop: int = 20) -> bool:
+        """
+        Evicts expired keys in batches of keys_per_loop until no due keys remain or the time budget of the cycle is
+        used up, similar to the adaptive active expire loop of Redis.
+        :param keys_per_loop: number of expiry entries to inspect between checks of the time budget
+        :return: True if the time budget ran out before all due keys were evicted
+        """
+        start = time.perf_counter()
+        deadline = start + self._config.expiry_time_budget
+        expired = 0
+        timed_out = False
+        while self.has_expired_pending():
+            expired += self.clean_expired(limit=keys_per_loop)
+            if time.perf_counter() >= deadline:
+                timed_out = self.has_expired_pending()
+                break
+
+        duration = time.perf_counter() - start
+        stats = self._expiry_stats
+        stats.expired_keys += expired
+        stats.sweep_cycles += 1
+        stats.last_sweep_duration = duration
+        stats.max_sweep_duration = max(stats.max_sweep_duration, duration)
+        stats.samples.append((time.time(), stats.expired_keys))
+        return timed_out
+
+    def _expiry_timer(self) -> float:
+        """
+        Runs an active expiry cycle. When the cycle runs out of its time budget, the next cycle starts as soon as other
+        connections have had a chance to run instead of waiting for the full interval.
+        :return: number of seconds until the next cycle
+        """
+        with self._lock:
+            timed_out = self.active_expire_cycle()
+            self._waiters.expire(time.time())
+        return 0 if timed_out else self._config.expiry_interval
+
     def run(self):
         """
         Runs and starts the server
         """
-        self._server.serve_forever()
+        if self._log is not None:
+            self.load_log()
+            self._server.add_timer(self._log_timer)
+        if self._config.replica_of is not None:
+            self.replicaof(*self._config.replica_of)
+        self._server.add_timer(self._expiry_timer)
+        self._server.add_timer(self._bgsave_timer)
+        try:
+            self._server.serve_forever()
+        finally:
+            if self._log is not None:
+                self._log.close()
+
+    def call(self, command, *args) -> Any:
+        """
+        Runs a command on behalf of a script, like a request received without a connection
+        :param command: command name
+        :param args: arguments of the command
+        :return: response of the command
+        :raises CommandError if the command fails
+        """
+        if isinstance(command, unicode):
+            command = command.encode("utf-8")
+        return self.respond([command, *args])
+
+    def add_script(self, command, script: Callable[..., Any]):
+        """
+        Adds a command running a Python script on the server, e.g. from an extension module. The script is called with
+        call, which runs a command, followed by the arguments of the request. It runs several commands in a single
+        round trip and no other request is processed until it returns:
+
+            def check_and_set(call, key, expected, value):
+                if call("GET", key) != expected:
+                    return 0
+                return call("SET", key, value)
+
+            server.add_script("CAS", check_and_set)
+
+        The commands the script runs are recorded in the append only log one by one, so the script itself does not
+        need to be deterministic.
+        :param command: command name
+        :param script: script to run
+        """
+        self.add_command(command, lambda *args: script(self.call, *args))
 
     def add_command(self, command, callback):
         """
@@ -0,0 +1,549 @@
+"""
+Primary/replica replication. A replica connects to its primary and sends PSYNC with the id of the replication stream it
+followed and the offset it got to, or ? and -1 the first time. The primary answers with one of:
+
+    FULLRESYNC id offset snapshot - the replica replaces its store with the snapshot, which holds every write up to
+                                    offset in the stream
+    CONTINUE id offset backlog    - the replica applies the writes of the backlog, which take it from its own offset
+                                    to offset
+
+and from then on streams every write it records, in the form they are appended to the append only log, so that a write
+whose effect depends on when it ran has the same effect on the replica. The primary keeps the last bytes of the stream
+in a backlog, so that a replica that lost its link for a short while resumes from its offset instead of loading a new
+snapshot. Replicas only serve reads.
+"""
+from typing import Any, Callable, Dict, List, Optional, Tuple
+from dataclasses import dataclass, field
+from io import BytesIO
+import os
+import secrets
+import socket
+import tempfile
+from kvault.infra.logger import logger
+from .blocking import Waiter, WaiterQueues
+from .exceptions import CommandError, Error, ProtocolError
+from .persistence import BackgroundSaver, SnapshotError, load_snapshot, save_snapshot
+from .protocol_handler import Encoded
+from .resp_parser import RespParser, INCOMPLETE
+from .utils import decode, encode
+
+REPL_BACKLOG_SIZE = 1024 * 1024
+# number of seconds a replica waits before connecting again once the link to its primary is lost
+REPLICA_RETRY_INTERVAL = 1.0
+
+
+class ReplicationBacklog:
+    """
+    Last bytes of the replication stream
+    """
+
+    def __init__(self, size: int = REPL_BACKLOG_SIZE):
+        """
+        Creates an empty backlog
+        :param size: number of bytes of the stream kept
+        """
+        self.size = size
+        # number of bytes streamed since the stream started
+        self.offset = 0
+        self._data = bytearray()
+
+    def __len__(self) -> int:
+        """Returns the number of bytes in the backlog"""
+        return len(self._data)
+
+    def append(self, data: bytes):
+        """
+        Appends bytes to the stream, dropping the oldest ones past the size of the backlog
+        :param data: bytes streamed
+        """
+        self._data += data
+        self.offset += len(data)
+        if len(self._data) > self.size:
+            del self._data[:len(self._data) - self.size]
+
+    def since(self, offset: int) -> Optional[bytes]:
+        """
+        Returns the bytes streamed since an offset
+        :param offset: offset in the stream
+        :return: the bytes, None if some of them are no longer in the backlog
+        """
+        start = self.offset - len(self._data)
+        if not start <= offset <= self.offset:
+            return None
+        return bytes(self._data[offset - start:])
+
+
+class ReplicationSource:
+    """
+    Replication stream of a primary and the replicas following it
+    """
+
+    def __init__(self, encode_request: Callable[[Any], bytes], backlog_size: int = REPL_BACKLOG_SIZE):
+        """
+        Starts a new stream
+        :param encode_request: serializes a request
+        :param backlog_size: number of bytes of the stream kept for partial resyncs
+        """
+        self.replid = secrets.token_hex(20)
+        self.backlog = ReplicationBacklog(backlog_size)
+        self.full_syncs = 0
+        self.partial_syncs = 0
+        self._encode = encode_request
+        self._buffer = bytearray()
+        # replica connections to their push functions, which return False once the replica is being disconnected
+        self._replicas: Dict[Any, Callable[[bytes], bool]] = {}
+
+    def __len__(self) -> int:
+        """Returns the number of replicas"""
+        return len(self._replicas)
+
+    @property
+    def offset(self) -> int:
+        """Returns the offset of the stream, including the requests that have not been flushed yet"""
+        return self.backlog.offset + len(self._buffer)
+
+    def append(self, request: Any):
+        """
+        Buffers a request until the batch it is part of completes
+        :param request: request as a list of the command and its arguments
+        """
+        self._buffer += self._encode(request)
+
+    def flush(self):
+        """
+        Streams the buffered requests to the replicas and keeps them in the backlog
+        """
+        if not self._buffer:
+            return
+        data = bytes(self._buffer)
+        self._buffer.clear()
+        self.backlog.append(data)
+        for replica, push in list(self._replicas.items()):
+            if not push(data):
+                del self._replicas[replica]
+
+    def add_replica(self, replica: Any, push: Callable[[bytes], bool]):
+        """
+        Streams the requests flushed from now on to a replica
+        :param replica: connection of the replica
+        :param push: writes bytes to the replica without blocking
+        """
+        self._replicas[replica] = push
+
+    def remove_replica(self, replica: Any):
+        """
+        Stops streaming to a replica
+        :param replica: connection of the replica
+        """
+        self._replicas.pop(replica, None)
+
+
+@dataclass(eq=False)
+class FullSync:
+    """
+    Contains a snapshot being saved in the background for the replicas that need a full resync, and the stream written
+    since it was taken. The replicas get the snapshot followed by the stream once it is saved
+    :cvar filename is the file the snapshot is saved to
+    :cvar offset is the offset in the stream the snapshot was taken at
+    :cvar limit is the maximum number of bytes of the stream buffered, the sync fails once more is written
+    :cvar replicas are the connections of the replicas waiting for the snapshot, with the waiters of their PSYNC
+    :cvar pending is the stream written since the snapshot was taken
+    :cvar overflowed is set once more than limit bytes were written
+    :cvar saved is whether a snapshot saved in the foreground, on platforms without fork, was saved. None while it is
+    saved in the background
+    """
+
+    filename: str
+    offset: int
+    limit: int
+    replicas: List[Tuple[Any, Waiter]] = field(default_factory=list)
+    pending: bytearray = field(default_factory=bytearray)
+    overflowed: bool = False
+    saved: Optional[bool] = None
+
+    def push(self, data: bytes) -> bool:
+        """
+        Buffers the stream written while the snapshot is saved, so that it follows the snapshot
+        :param data: bytes streamed
+        :return: False once the buffer overflowed
+        """
+        if self.overflowed or len(self.pending) + len(data) > self.limit:
+            self.overflowed = True
+            self.pending.clear()
+            return False
+        self.pending += data
+        return True
+
+
+@dataclass(eq=False)
+# pylint: disable-next=too-many-instance-attributes
+class ReplicaLink:
+    """
+    Contains the state of the link of a replica to its primary
+    :cvar host is the host of the primary
+    :cvar port is the port of the primary
+    :cvar replid is the id of the replication stream followed, ? until the first sync
+    :cvar offset is the offset in the stream of the last write applied, -1 until the first sync
+    :cvar status is up once the replica follows the stream, down otherwise
+    :cvar full_syncs is the number of snapshots loaded from the primary
+    :cvar partial_syncs is the number of times the replica resumed the stream from its offset
+    :cvar stopped is set once the replica no longer follows the primary
+    :cvar conn is the socket connected to the primary, None while it is not connected
+    """
+
+    host: str
+    port: int
+    replid: str = "?"
+    offset: int = -1
+    status: str = "down"
+    full_syncs: int = 0
+    partial_syncs: int = 0
+    stopped: bool = False
+    conn: Any = None
+
+
+class Primary:
+    """
+    Primary side of the replication. Syncs the replicas that send PSYNC, from the backlog or from a snapshot saved in
+    the background, and streams the writes of the server to them from then on
+    """
+
+    def __init__(
+        self,
+        encode_reply: Callable[[Any], bytes],
+        waiters: WaiterQueues,
+        backlog_size: int = REPL_BACKLOG_SIZE,
+        output_buffer_limit: int = 32 * 1024 * 1024,
+    ):
+        """
+        Creates the primary side, which starts streaming once the first replica syncs
+        :param encode_reply: serializes a reply or a request
+        :param waiters: queues the PSYNC of the replicas waiting for a snapshot
+        :param backlog_size: number of bytes of the stream kept for partial resyncs
+        :param output_buffer_limit: maximum number of bytes of the stream buffered while a snapshot is saved
+        """
+        self.backlog_size = backlog_size
+        self.output_buffer_limit = output_buffer_limit
+        # replication stream, None until the first replica syncs
+        self.source: Optional[ReplicationSource] = None
+        self._encode = encode_reply
+        self._waiters = waiters
+        # snapshot being saved for the replicas that need a full resync, None when no replica waits for one
+        self._full_sync: Optional[FullSync] = None
+        self._saver = BackgroundSaver()
+
+    def psync(self, connection: Any, replid, offset, get_state: Callable[[], Dict[str, Any]]) -> Any:
+        """
+        Syncs a replica and streams the writes to it from then on. A replica that followed the stream up to an offset
+        still in the backlog resumes from it, any other gets a snapshot of the store
+        :param connection: state of the connection of the replica
+        :param replid: id of the replication stream the replica followed, ? if none
+        :param offset: offset in the stream the replica got to, -1 if none
+        :param get_state: returns the state of the store to save a snapshot of
+        :return: CONTINUE with the id of the stream, its offset and the writes the replica missed, or a waiter that is
+        finished once FULLRESYNC with the id of the stream, its offset and the snapshot has been pushed
+        :raises CommandError if the offset is invalid, the connection can not be pushed to or a full resync can not be
+        started
+        """
+        try:
+            offset = int(offset)
+        except (TypeError, ValueError) as error:
+            raise CommandError(f"invalid replication offset {offset}") from error
+        if connection.push is None:
+            if connection.open_push is None:
+                raise CommandError("PSYNC is not supported on this connection")
+            connection.push = connection.open_push()
+        if self.source is None:
+            self.source = ReplicationSource(self._encode, self.backlog_size)
+        source = self.source
+        # the writes of the running batch are sent to the other replicas first, the new one is synced past them
+        source.flush()
+        backlog = source.backlog.since(offset) if decode(replid) == source.replid else None
+        if backlog is not None:
+            source.add_replica(connection, connection.push)
+            source.partial_syncs += 1
+            logger.info(f"Replica {connection.address} resumed from offset {offset}")
+            return [b"CONTINUE", source.replid, source.offset, backlog]
+        if self._full_sync is None:
+            self._start_full_sync(get_state)
+        # the reply is pushed once the snapshot is saved, replicas asking meanwhile share it
+        waiter = self._waiters.block(Waiter(keys=[]))
+        self._full_sync.replicas.append((connection, waiter))
+        return waiter
+
+    def _start_full_sync(self, get_state: Callable[[], Dict[str, Any]]):
+        """
+        Starts saving a snapshot for the replicas that need a full resync. The snapshot is saved from a forked child
+        process while the server keeps serving requests, and the stream written meanwhile is buffered to be sent after
+        it. Platforms without fork save it in the foreground
+        :param get_state: returns the state of the store
+        :raises CommandError if the child process can not be forked
+        """
+        file_handle, filename = tempfile.mkstemp(prefix="kvault-sync-", suffix=".state")
+        os.close(file_handle)
+        sync = FullSync(filename=filename, offset=self.source.offset, limit=self.output_buffer_limit)
+        if hasattr(os, "fork"):
+            try:
+                self._saver.start(filename, get_state(), on_done=self._finish_full_sync)
+            except OSError as error:
+                os.unlink(filename)
+                raise CommandError(f"could not start a full resync: {error}") from error
+        else:
+            try:
+                save_snapshot(filename, get_state())
+                sync.saved = True
+            # pylint: disable-next=broad-exception-caught
+            except Exception as error:
+                logger.error(f"Could not save the snapshot of a full resync: {error}")
+                sync.saved = False
+        self._full_sync = sync
+        self.source.add_replica(sync, sync.push)
+
+    def poll(self):
+        """
+        Sends the snapshot of a full resync to the replicas waiting for it once it is saved. Called periodically under
+        the lock of the server, so that the replicas get the snapshot once the responses of the running batch have been
+        sent
+        """
+        sync = self._full_sync
+        if sync is None:
+            return
+        if sync.saved is not None:
+            self._finish_full_sync(sync.saved)
+        else:
+            self._saver.poll()
+
+    def _finish_full_sync(self, succeeded: bool):
+        """
+        Sends the snapshot saved for a full resync to the replicas waiting for it, followed by the stream written since
+        it was taken, and streams to them from then on
+        :param succeeded: whether the snapshot was saved
+        """
+        sync, self._full_sync = self._full_sync, None
+        source = self.source
+        source.remove_replica(sync)
+        snapshot = None
+        if succeeded and not sync.overflowed:
+            try:
+                with open(sync.filename, "rb") as file_handle:
+                    snapshot = file_handle.read()
+            except OSError as error:
+                logger.error(f"Could not read the snapshot of a full resync: {error}")
+        elif sync.overflowed:
+            logger.warning("Full resync over the output buffer limit, the replicas will retry")
+        try:
+            os.unlink(sync.filename)
+        except OSError:
+            pass
+
+        reply = None
+        if snapshot is not None:
+            reply = self._encode([b"FULLRESYNC", source.replid, sync.offset, snapshot])
+        for connection, waiter in sync.replicas:
+            if not self._waiters.claim(waiter):
+                continue
+            if reply is None:
+                waiter.finish(Error("full resync failed, the snapshot could not be saved"))
+                continue
+            if connection.outbox is not None:
+                # the snapshot is not held against the output buffer limit of the replica
+                pushed = connection.outbox.put(reply, exempt=True)
+            else:
+                pushed = connection.push(reply)
+            if pushed and (not sync.pending or connection.push(bytes(sync.pending))):
+                source.add_replica(connection, connection.push)
+                source.full_syncs += 1
+                logger.info(f"Replica {connection.address} synced from a snapshot at offset {sync.offset}")
+            # the reply has been pushed ahead of the stream, there is nothing left to write for the request
+            waiter.finish(Encoded(b""))
+
+    def info(self) -> Dict[str, Any]:
+        """
+        Returns the replication fields of INFO of the primary side
+        :return: dictionary mapping of the replication information
+        """
+        source = self.source
+        return {
+            "connected_replicas": len(source) if source is not None else 0,
+            "repl_id": source.replid if source is not None else "",
+            "repl_offset": source.offset if source is not None else 0,
+            "repl_backlog_size": self.backlog_size,
+            "repl_backlog_histlen": len(source.backlog) if source is not None else 0,
+            "sync_full": source.full_syncs if source is not None else 0,
+            "sync_partial_ok": source.partial_syncs if source is not None else 0,
+        }
+
+
+class Replica:
+    """
+    Replica side of the replication. Follows the replication stream of a primary in the background, loading its
+    snapshot and applying its writes, over a link that is connected again whenever it is lost
+    """
+
+    def __init__(
+        self,
+        engine: Any,
+        lock: Any,
+        encode_request: Callable[[Any], bytes],
+        load_state: Callable[[Dict[str, Any]], None],
+        apply_stream: Callable[[RespParser], None],
+    ):
+        """
+        Creates the replica side, which follows no primary until it is started
+        :param engine: stream server of the server, which runs the link in the background and connects it
+        :param lock: lock of the server, held while the store is synced
+        :param encode_request: serializes a request to the primary
+        :param load_state: replaces the store with the state of a snapshot of the primary
+        :param apply_stream: applies the complete writes buffered in a parser of the stream
+        """
+        # link to the primary, None for a primary
+        self.link: Optional[ReplicaLink] = None
+        self._engine = engine
+        self._lock = lock
+        self._encode = encode_request
+        self._load_state = load_state
+        self._apply_stream = apply_stream
+
+    def start(self, host: str, port: int):
+        """
+        Follows a primary, in place of the one followed so far if any
+        :param host: host of the primary
+        :param port: port of the primary
+        """
+        link = self.link
+        if link is not None and (link.host, link.port) == (host, port):
+            return
+        self.stop()
+        self.link = link = ReplicaLink(host, port)
+        self._engine.spawn(self._replicate, link)
+
+    def stop(self):
+        """
+        Stops following the primary, closing the link to it
+        """
+        link, self.link = self.link, None
+        if link is None:
+            return
+        link.stopped = True
+        if link.conn is not None:
+            try:
+                # wakes up the link waiting for the stream
+                link.conn.shutdown(socket.SHUT_RDWR)
+            except OSError:
+                pass
+
+    def _replicate(self, link: ReplicaLink):
+        """
+        Follows the replication stream of the primary until the replica stops following it, connecting again after
+        REPLICA_RETRY_INTERVAL seconds whenever the link is lost
+        :param link: link to the primary
+        """
+        while not link.stopped:
+            try:
+                link.conn = self._engine.create_connection((link.host, link.port))
+                self._follow(link)
+            except (OSError, EOFError, CommandError, ProtocolError, SnapshotError, ValueError) as error:
+                if not link.stopped:
+                    logger.warning(f"Lost the link to the primary {link.host}:{link.port}: {error}")
+            # pylint: disable-next=broad-exception-caught
+            except Exception as error:
+                # the link is followed again rather than left for dead while the server still is a replica
+                logger.error(f"Unhandled exception following the primary {link.host}:{link.port}: {error}")
+            finally:
+                link.status = "down"
+                if link.conn is not None:
+                    link.conn.close()
+                    link.conn = None
+            if not link.stopped:
+                self._engine.event().wait(REPLICA_RETRY_INTERVAL)
+
+    def _follow(self, link: ReplicaLink):
+        """
+        Syncs with the primary, then applies the writes it streams until the link is lost
+        :param link: link to the primary
+        :raises EOFError once the primary closed the link
+        :raises CommandError if the primary refused to sync
+        """
+        conn = link.conn
+        if link.stopped:
+            return
+        conn.sendall(self._encode([b"PSYNC", link.replid, link.offset]))
+        parser = RespParser()
+        reply = INCOMPLETE
+        while reply is INCOMPLETE:
+            data = conn.recv(65536)
+            if not data:
+                raise EOFError("primary closed the link")
+            parser.feed(data)
+            reply = parser.gets()
+        if isinstance(reply, Error):
+            raise CommandError(reply.message)
+        mode, replid, offset, payload = reply
+        self._sync(link, decode(mode), decode(replid), int(offset), encode(payload))
+        link.status = "up"
+        logger.info(f"Following the primary {link.host}:{link.port} from offset {link.offset}")
+
+        # offset of the end of the stream received so far
+        received = link.offset + len(parser)
+        while True:
+            self._apply(link, parser)
+            link.offset = received - len(parser)
+            data = conn.recv(65536)
+            if not data:
+                raise EOFError("primary closed the link")
+            parser.feed(data)
+            received += len(data)
+
+    def _sync(self, link: ReplicaLink, mode: str, replid: str, offset: int, payload: bytes):
+        """
+        Brings the store up to an offset of the replication stream of the primary
+        :param link: link to the primary
+        :param mode: FULLRESYNC to load the snapshot in the payload, CONTINUE to apply the writes in the payload
+        :param replid: id of the replication stream
+        :param offset: offset in the stream the payload brings the store to
+        :param payload: snapshot or writes
+        :raises CommandError if the mode is unknown
+        """
+        if mode == "FULLRESYNC":
+            state = load_snapshot(BytesIO(payload))
+            with self._lock:
+                if self.link is not link:
+                    return
+                self._load_state(state)
+            link.full_syncs += 1
+        elif mode == "CONTINUE":
+            backlog = RespParser()
+            backlog.feed(payload)
+            self._apply(link, backlog)
+            link.partial_syncs += 1
+        else:
+            raise CommandError(f"unexpected reply to PSYNC {mode}")
+        link.replid, link.offset = replid, offset
+
+    def _apply(self, link: ReplicaLink, parser: RespParser):
+        """
+        Applies the complete writes buffered from the replication stream, unless the replica stopped following the
+        primary meanwhile
+        :param link: link to the primary
+        :param parser: parser holding the stream
+        """
+        with self._lock:
+            if self.link is link:
+                self._apply_stream(parser)
+
+    def info(self) -> Dict[str, Any]:
+        """
+        Returns the replication fields of INFO of the replica side
+        :return: dictionary mapping of the replication information, empty when the server follows no primary
+        """
+        link = self.link
+        if link is None:
+            return {}
+        return {
+            "primary_host": link.host,
+            "primary_port": link.port,
+            "primary_link_status": link.status,
+            "replica_repl_offset": link.offset,
+            "replica_full_syncs": link.full_syncs,
+            "replica_partial_syncs": link.partial_syncs,
+        }
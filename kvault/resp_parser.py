@@ -0,0 +1,329 @@
+"""
+Incremental parser for the wire protocol spoken by the ProtocolHandler. Instead of reading from a socket file one byte
+or one line at a time, bytes received from a socket are fed into a single receive buffer and complete messages are
+parsed out of it by offset. The socket only needs to be read again once the buffer no longer holds a complete message.
+"""
+from typing import Any, Callable, Dict, List, Optional, Tuple
+import json
+from .exceptions import Error, ProtocolError
+from .serialization import unpack
+from .utils.mixins import MetaUtils
+from .infra.logger import logger
+
+# Returned by RespParser.gets when the receive buffer does not hold a complete message yet
+INCOMPLETE = object()
+# prefixes of the aggregate types, whose elements are parsed one at a time so that an aggregate that is only partially
+# buffered is resumed once more data is fed, instead of being parsed again from its start
+ARRAY, DICT, SET = b"*"[0], b"%"[0], b"&"[0]
+
+
+class IncompleteMessage(Exception):
+    """Raised internally when the receive buffer ends in the middle of a message"""
+
+
+# pylint: disable-next=too-many-instance-attributes
+class RespParser(MetaUtils):
+    """
+    RespParser parses messages out of a receive buffer. Data received from the socket is appended with feed and
+    complete messages are taken out with gets, which returns INCOMPLETE when more data is needed. The elements of a
+    message that is only partially buffered are kept, and parsing resumes past them once more data has been fed.
+    Bytes that are not a valid message raise ProtocolError and are dropped.
+
+    Dispatch uses the same prefix table as the ProtocolHandler and produces the same Python types.
+    """
+
+    # pylint: disable-next=missing-function-docstring
+    def __init__(self, compact_threshold: int = 65536):
+        self._buffer = bytearray()
+        self._view = memoryview(b"")
+        # offset of the message being parsed
+        self._start = 0
+        # offset parsing resumes from
+        self._pos = 0
+        # aggregates being parsed, innermost last: their prefix, number of elements and elements parsed so far
+        self._stack: List[Tuple[int, int, list]] = []
+        self._compact_threshold = compact_threshold
+        self.handlers: Dict[bytes, Callable[[int], Tuple[Any, int]]] = {
+            b"+": self.parse_simple_string,
+            b"-": self.parse_error,
+            b":": self.parse_integer,
+            b"$": self.parse_string,
+            b"^": self.parse_unicode,
+            b"@": self.parse_json,
+            b"~": self.parse_packed,
+            b"*": self.parse_array,
+            b"%": self.parse_dict,
+            b"&": self.parse_set,
+        }
+        # indexing the buffer yields ints, so dispatch on the integer value of each prefix
+        self._dispatch = {prefix[0]: handler for prefix, handler in self.handlers.items()}
+
+    def __len__(self) -> int:
+        """Returns the number of buffered bytes that are not part of a complete message yet"""
+        return len(self._buffer) - self._start
+
+    def feed(self, data: bytes):
+        """
+        Appends data received from the socket to the receive buffer. Bytes of messages that have already been parsed
+        are released from the buffer first.
+        :param data: bytes received from the socket
+        """
+        if self._start:
+            if self._start == len(self._buffer):
+                self._buffer.clear()
+                self._start = self._pos = 0
+            elif self._start >= self._compact_threshold:
+                del self._buffer[: self._start]
+                self._pos -= self._start
+                self._start = 0
+        self._buffer += data
+
+    def reset(self):
+        """
+        Drops the receive buffer and the message being parsed
+        """
+        self._buffer.clear()
+        self._start = self._pos = 0
+        self._stack.clear()
+
+    def gets(self) -> Any:
+        """
+        Parses the next complete message out of the receive buffer
+        :return: parsed message or INCOMPLETE if the buffer does not hold a complete message
+        :raises ProtocolError if the buffer does not hold a valid message, the buffer is dropped
+        """
+        if self._pos >= len(self._buffer):
+            return INCOMPLETE
+        self._view = memoryview(self._buffer)
+        try:
+            return self._resume()
+        except IncompleteMessage:
+            return INCOMPLETE
+        except (TypeError, ValueError) as error:
+            # the messages past an invalid one can not be told apart, parsing them again would fail the same way
+            self._view.release()
+            self.reset()
+            raise ProtocolError(f"invalid message: {error}") from error
+        finally:
+            # the buffer can not be resized while a view of it is held
+            self._view.release()
+
+    def _resume(self) -> Any:
+        """
+        Parses elements from the offset the last call stopped at until a message is complete. Aggregates are parsed
+        one element at a time, keeping the elements parsed so far
+        :return: the message
+        :raises IncompleteMessage if the buffer ends before the message does
+        """
+        stack = self._stack
+        while True:
+            pos = self._pos
+            if pos >= len(self._buffer):
+                raise IncompleteMessage()
+            prefix = self._buffer[pos]
+            if prefix in (ARRAY, DICT, SET):
+                # only arrays have a null value
+                count, self._pos = self._length(pos + 1, nullable=prefix == ARRAY)
+                if prefix == DICT:
+                    count *= 2
+                if count > 0:
+                    stack.append((prefix, count, []))
+                    continue
+                value = None if count == -1 else self._aggregate(prefix, [])
+            else:
+                value, self._pos = self.parse(pos)
+            while stack:
+                prefix, count, elements = stack[-1]
+                elements.append(value)
+                if len(elements) < count:
+                    break
+                stack.pop()
+                value = self._aggregate(prefix, elements)
+            else:
+                self._start = self._pos
+                return value
+
+    @staticmethod
+    def _aggregate(prefix: int, elements: list) -> Any:
+        """
+        Builds an aggregate out of its elements
+        :param prefix: prefix of the aggregate
+        :param elements: elements, alternating keys and values for a dictionary
+        :return: list, dictionary or set
+        """
+        if prefix == DICT:
+            return dict(zip(elements[::2], elements[1::2]))
+        if prefix == SET:
+            return set(elements)
+        return elements
+
+    def parse(self, pos: int) -> Tuple[Any, int]:
+        """
+        Parses a message starting at the given offset of the receive buffer
+        :param pos: offset of the prefix byte of the message
+        :return: tuple of the parsed message and the offset just past it
+        :raises IncompleteMessage if the buffer ends before the message does
+        """
+        if pos >= len(self._buffer):
+            raise IncompleteMessage()
+        handler = self._dispatch.get(self._buffer[pos])
+        if handler:
+            return handler(pos + 1)
+        end = self._line_end(pos)
+        logger.error(
+            f"{self.name}> failed to handle request, missing value for key {self._buffer[pos:pos + 1]}"
+        )
+        return bytes(self._view[pos:end]), end + 2
+
+    def _line_end(self, pos: int) -> int:
+        """
+        Finds the end of the line starting at the given offset
+        :param pos: offset where the line starts
+        :return: offset of the carriage-return that terminates the line
+        :raises IncompleteMessage if the line has not been fully received
+        """
+        end = self._buffer.find(b"\r\n", pos)
+        if end == -1:
+            raise IncompleteMessage()
+        return end
+
+    def _length(self, pos: int, nullable: bool = True) -> Tuple[int, int]:
+        """
+        Reads a length or element count line
+        :param pos: offset where the line starts
+        :param nullable: whether a length of -1, which stands for None, is valid
+        :return: tuple of the length and the offset of the next line
+        :raises ValueError if the line is not a length
+        """
+        end = self._line_end(pos)
+        length = int(self._buffer[pos:end])
+        if length < (-1 if nullable else 0):
+            raise ValueError(f"invalid length {length}")
+        return length, end + 2
+
+    def parse_simple_string(self, pos: int) -> Tuple[bytes, int]:
+        """
+        Parses a simple string in the format +{simple string}\r\n
+        :param pos: offset just past the prefix
+        :return: tuple of the string and the offset just past it
+        """
+        end = self._line_end(pos)
+        return bytes(self._view[pos:end]), end + 2
+
+    def parse_error(self, pos: int) -> Tuple[Error, int]:
+        """
+        Parses an error in the format -{error message}\r\n
+        :param pos: offset just past the prefix
+        :return: tuple of the error and the offset just past it
+        """
+        message, pos = self.parse_simple_string(pos)
+        return Error(message), pos
+
+    def parse_integer(self, pos: int) -> Tuple[Any, int]:
+        """
+        Parses an integer or float in the format :{number}\r\n
+        :param pos: offset just past the prefix
+        :return: tuple of the number and the offset just past it
+        """
+        end = self._line_end(pos)
+        number = self._buffer[pos:end]
+        if b"." in number:
+            return float(number), end + 2
+        return int(number), end + 2
+
+    def parse_string(self, pos: int) -> Tuple[Any, int]:
+        """
+        Parses a bulk string in the format ${number of bytes}\r\n{data}\r\n. The data is copied straight out of the
+        receive buffer into the returned bytes object.
+        :param pos: offset just past the prefix
+        :return: tuple of the string, or None for a length of -1, and the offset just past it
+        """
+        length, pos = self._length(pos)
+        if length == -1:
+            return None, pos
+        end = pos + length
+        if end + 2 > len(self._buffer):
+            raise IncompleteMessage()
+        return bytes(self._view[pos:end]), end + 2
+
+    def parse_unicode(self, pos: int) -> Tuple[Any, int]:
+        """
+        Parses a bulk unicode string, which uses the same format as a bulk string
+        :param pos: offset just past the prefix
+        :return: tuple of the decoded string or None and the offset just past it
+        """
+        string_, pos = self.parse_string(pos)
+        if string_:
+            return string_.decode("utf-8"), pos
+        return None, pos
+
+    def parse_json(self, pos: int) -> Tuple[Any, int]:
+        """
+        Parses a JSON string, which uses the same format as a bulk string
+        :param pos: offset just past the prefix
+        :return: tuple of the deserialized object or None and the offset just past it
+        """
+        string_, pos = self.parse_string(pos)
+        if string_:
+            return json.loads(string_), pos
+        return None, pos
+
+    def parse_packed(self, pos: int) -> Tuple[Any, int]:
+        """
+        Parses a packed value, which uses the same format as a bulk string. It is unpacked in one pass straight from
+        the receive buffer, without copying it out first
+        :param pos: offset just past the prefix
+        :return: tuple of the unpacked object and the offset just past it
+        """
+        length, pos = self._length(pos, nullable=False)
+        end = pos + length
+        if end + 2 > len(self._buffer):
+            raise IncompleteMessage()
+        return unpack(self._view[pos:end]), end + 2
+
+    def parse_array(self, pos: int) -> Tuple[Optional[list], int]:
+        """
+        Parses an array in the format *{number of elements}\r\n...elements...
+        :param pos: offset just past the prefix
+        :return: tuple of the list of elements, or None for a count of -1, and the offset just past it
+        """
+        num_elements, pos = self._length(pos)
+        if num_elements == -1:
+            return None, pos
+        return self._elements(pos, num_elements)
+
+    def _elements(self, pos: int, num_elements: int) -> Tuple[list, int]:
+        """
+        Parses the elements of an array or set
+        :param pos: offset of the first element
+        :param num_elements: number of elements
+        :return: tuple of the list of elements and the offset just past them
+        """
+        elements = []
+        for _ in range(num_elements):
+            element, pos = self.parse(pos)
+            elements.append(element)
+        return elements, pos
+
+    def parse_dict(self, pos: int) -> Tuple[dict, int]:
+        """
+        Parses a dictionary in the format %{number of keys}\r\n...key0...value0...key1...value1...
+        :param pos: offset just past the prefix
+        :return: tuple of the dictionary and the offset just past it
+        """
+        num_items, pos = self._length(pos, nullable=False)
+        accum = {}
+        for _ in range(num_items):
+            key, pos = self.parse(pos)
+            accum[key], pos = self.parse(pos)
+        return accum, pos
+
+    def parse_set(self, pos: int) -> Tuple[set, int]:
+        """
+        Parses a set, which uses the same format as an array
+        :param pos: offset just past the prefix
+        :return: tuple of the set and the offset just past it
+        """
+        num_elements, pos = self._length(pos, nullable=False)
+        elements, pos = self._elements(pos, num_elements)
+        return set(elements), pos
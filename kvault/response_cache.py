@@ -0,0 +1,83 @@
+"""
+Cache of the serialized replies to GET. A hot key read over and over is serialized on its first read only: later reads
+of the key write the cached bytes as they are. An entry remembers the value it was serialized from and is only used
+while the key still holds that very object, so a key set to a new value is never served its old reply. Values updated in
+place, such as lists and dictionaries, are invalidated once a command writes, expires or evicts their key.
+
+The cache holds up to a number of bytes of replies and drops the least recently read ones past it.
+"""
+from typing import Any, Callable, Iterable, Tuple
+from collections import OrderedDict
+
+RESPONSE_CACHE_SIZE = 16 * 1024 * 1024
+
+
+class ResponseCache:
+    """
+    Serialized replies to the reads of keys, least recently read first
+    """
+
+    def __init__(self, encode: Callable[[Any, bool], bytes], max_bytes: int = RESPONSE_CACHE_SIZE):
+        """
+        Creates an empty cache
+        :param encode: serializes a reply, packed or not
+        :param max_bytes: number of bytes of replies above which the least recently read ones are dropped
+        """
+        self.max_bytes = max_bytes
+        self.size = 0
+        self.hits = 0
+        self.misses = 0
+        self._encode = encode
+        # (key, packed) to the value the reply was serialized from and the reply
+        self._entries: OrderedDict[Tuple[Any, bool], Tuple[Any, bytes]] = OrderedDict()
+
+    def __len__(self) -> int:
+        """Returns the number of cached replies"""
+        return len(self._entries)
+
+    def get(self, key: Any, value: Any, packed: bool) -> bytes:
+        """
+        Returns the reply to a read of a key, serializing and caching it unless the key still holds the value it was
+        serialized from
+        :param key: Key
+        :param value: value the key holds
+        :param packed: whether the reply is packed
+        :return: serialized reply
+        """
+        entry_key = (key, packed)
+        entry = self._entries.get(entry_key)
+        if entry is not None and entry[0] is value:
+            self._entries.move_to_end(entry_key)
+            self.hits += 1
+            return entry[1]
+        self.misses += 1
+        data = self._encode(value, packed)
+        if entry is not None:
+            self.size -= len(entry[1])
+            del self._entries[entry_key]
+        if len(data) <= self.max_bytes:
+            self._entries[entry_key] = (value, data)
+            self.size += len(data)
+            while self.size > self.max_bytes:
+                _, (_, dropped) = self._entries.popitem(last=False)
+                self.size -= len(dropped)
+        return data
+
+    def invalidate(self, keys: Iterable[Any]):
+        """
+        Drops the replies about keys that changed
+        :param keys: keys that changed
+        """
+        entries = self._entries
+        for key in keys:
+            for entry_key in ((key, False), (key, True)):
+                entry = entries.pop(entry_key, None)
+                if entry is not None:
+                    self.size -= len(entry[1])
+
+    def clear(self):
+        """
+        Drops every reply
+        """
+        self._entries.clear()
+        self.size = 0
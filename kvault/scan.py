@@ -0,0 +1,216 @@
+"""
+Cursors of the SCAN, HSCAN and SSCAN commands. LSCAN does not need one, its cursor is an index in the queue.
+
+An iteration walks the container itself, through an iterator kept with its cursor, so it copies nothing and a call walks
+at most COUNT elements. Python dicts and sets do not expose their hash table, so a cursor can not be a position in it
+like in Redis, and their iterators stop working once the container changes size. Commands that may add or remove
+elements of a container being walked only mark the iterations over it as stale, and a stale iteration resumes on its
+next call right after the last elements it walked, found again by walking the container from its start without
+copying it. Dicts keep their insertion order, and removing elements only moves the ones after them closer to the
+start, so the elements after the last one walked are the ones left to walk, unless it was removed and added back at the
+end. Sets are walked in the order of their hash table, which they rebuild as they grow, so an iteration over a set that
+was rebuilt starts over. So:
+
+    - a call walks at most COUNT elements, but for a stale iteration, which first walks back to where it stopped
+    - every key or hash field present for the whole iteration is returned at least once
+    - every set member present for the whole iteration is returned at least once, and possibly more than once
+    - elements added during the iteration may not be returned
+    - an iteration whose last elements walked were all removed, or whose cursor was released, starts over and may
+      return elements more than once
+"""
+from typing import Any, Callable, Dict, Hashable, Iterable, Iterator, List, Optional, Tuple, Union
+from collections import OrderedDict
+from dataclasses import dataclass, field
+from fnmatch import fnmatchcase
+from itertools import islice
+from operator import indexOf
+import sys
+from .exceptions import CommandError
+from .utils import decode
+
+DEFAULT_COUNT = 10
+# iterations are rarely abandoned half way, but their cursors are released past this many open cursors. An iteration
+# whose cursor was released starts over
+MAX_CURSORS = 128
+# number of the last elements walked an iteration keeps to resume after once it is stale
+ANCHORS = 4
+
+
+@dataclass
+class ScanCursor:
+    """
+    Contains an iteration in progress
+    :cvar source identifies the container being iterated, so a cursor can not be used with another container
+    :cvar remaining iterates over the elements left to walk, None once the iteration is stale
+    :cvar walked is the number of elements walked
+    :cvar anchors are the last elements walked with their position in the walk, most recent last. A stale iteration
+    resumes after the most recent one still at or before its position
+    :cvar table_size is the size in bytes of the set when it was last walked, which changes when the set is rebuilt
+    """
+
+    source: Hashable
+    remaining: Optional[Iterator[Any]] = None
+    walked: int = 0
+    anchors: List[Tuple[int, Any]] = field(default_factory=list)
+    table_size: int = 0
+
+
+def scan_options(args: Iterable[Any]) -> Tuple[Optional[str], int]:
+    """
+    Parses the MATCH and COUNT options of a scan command
+    :param args: options and their values
+    :return: glob pattern or None to match everything, number of elements to walk
+    :raises CommandError if an option is not supported or its value is invalid
+    """
+    args = list(args)
+    if len(args) % 2:
+        raise CommandError("syntax error, scan options are MATCH pattern and COUNT count")
+    pattern, count = None, DEFAULT_COUNT
+    for option, value in zip(args[::2], args[1::2]):
+        option = decode(option).upper()
+        if option == "MATCH":
+            pattern = decode(value)
+        elif option == "COUNT":
+            try:
+                count = int(value)
+            except (TypeError, ValueError) as error:
+                raise CommandError(f"COUNT must be an integer, got {value}") from error
+            if count < 1:
+                raise CommandError("COUNT must be positive")
+        else:
+            raise CommandError(f"unsupported scan option {option}")
+    return pattern, count
+
+
+def matches(element: Any, pattern: Optional[str]) -> bool:
+    """
+    Checks an element against the glob pattern of a MATCH option
+    :param element: key, field or member
+    :param pattern: glob pattern, None matches every element
+    :return: True if the element matches
+    """
+    return pattern is None or fnmatchcase(decode(element), pattern)
+
+
+class ScanCursors:
+    """
+    Open cursors of the iterations in progress
+    """
+
+    def __init__(self, max_cursors: int = MAX_CURSORS):
+        """
+        Creates the table of cursors
+        :param max_cursors: number of open cursors above which the least recently used one is released
+        """
+        self.max_cursors = max_cursors
+        self._cursors: "OrderedDict[int, ScanCursor]" = OrderedDict()
+        # containers walked by iterations that are not stale, to the cursors of those iterations
+        self.live: Dict[Hashable, Dict[int, ScanCursor]] = {}
+        self._next_id = 1
+
+    def __len__(self) -> int:
+        return len(self._cursors)
+
+    def clear(self):
+        """
+        Releases every cursor
+        """
+        self._cursors.clear()
+        self.live.clear()
+
+    def invalidate(self, source: Hashable):
+        """
+        Marks the iterations over a container as stale before it changes. They resume after their last elements walked
+        on their next call
+        :param source: identifies the container
+        """
+        for state in self.live.pop(source, {}).values():
+            state.remaining = None
+
+    def _release(self, cursor: int, state: ScanCursor):
+        """
+        Stops tracking the container of an iteration that completed or was released
+        :param cursor: cursor of the iteration
+        :param state: the iteration
+        """
+        cursors = self.live.get(state.source)
+        if cursors is not None:
+            cursors.pop(cursor, None)
+            if not cursors:
+                del self.live[state.source]
+
+    @staticmethod
+    def _resume(state: ScanCursor, container: Union[dict, set]):
+        """
+        Finds where a stale iteration stopped in its container, and continues it after the last element walked that
+        is still in place. The iteration starts over if there is none or the set was rebuilt
+        :param state: the iteration
+        :param container: dict or set walked
+        """
+        if isinstance(container, dict) or sys.getsizeof(container) == state.table_size:
+            for position, anchor in reversed(state.anchors):
+                if anchor not in container:
+                    continue
+                # walks up to the anchor without copying the elements, the iterator then continues past it
+                iterator = iter(container)
+                index = indexOf(iterator, anchor)
+                if index <= position:
+                    state.remaining, state.walked = iterator, index + 1
+                    return
+                # further than where it was walked, the anchor was removed and added back
+        state.remaining, state.walked, state.anchors = iter(container), 0, []
+
+    def advance(
+        self, cursor: Any, source: Hashable, container: Union[dict, set], present: Callable[[Any], bool], count: int
+    ) -> Tuple[int, List[Any]]:
+        """
+        Walks the next elements of an iteration
+        :param cursor: cursor returned by the previous call, 0 to start an iteration
+        :param source: identifies the container being iterated
+        :param container: dict or set to walk
+        :param present: checks whether an element is still in the store
+        :param count: number of elements to walk
+        :return: cursor to continue the iteration with, 0 once it is complete, and the elements still present
+        :raises CommandError if the cursor was never handed out or belongs to another container
+        """
+        try:
+            cursor = int(cursor)
+        except (TypeError, ValueError) as error:
+            raise CommandError(f"invalid cursor {cursor}") from error
+
+        if cursor == 0:
+            state = ScanCursor(source=source, remaining=iter(container))
+            cursor = self._next_id
+            self._next_id += 1
+        else:
+            state = self._cursors.pop(cursor, None)
+            if state is None:
+                if not 0 < cursor < self._next_id:
+                    raise CommandError(f"invalid cursor {cursor}")
+                # the cursor was released or its iteration has completed, the iteration starts over
+                state = ScanCursor(source=source, remaining=iter(container))
+            elif state.source != source:
+                raise CommandError(f"invalid cursor {cursor}, it belongs to the iteration of another container")
+
+        if state.remaining is None:
+            self._resume(state, container)
+        try:
+            walked = list(islice(state.remaining, count))
+        except RuntimeError:
+            # the container changed size without the iteration being marked as stale first
+            self._resume(state, container)
+            walked = list(islice(state.remaining, count))
+        batch = [element for element in walked if present(element)]
+        if len(walked) < count:
+            self._release(cursor, state)
+            return 0, batch
+
+        state.anchors = (state.anchors + list(enumerate(walked, state.walked)))[-ANCHORS:]
+        state.walked += len(walked)
+        if isinstance(container, set):
+            state.table_size = sys.getsizeof(container)
+        self.live.setdefault(source, {})[cursor] = state
+        self._cursors[cursor] = state
+        while len(self._cursors) > self.max_cursors:
+            self._release(*self._cursors.popitem(last=False))
+        return cursor, batch
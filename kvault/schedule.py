@@ -0,0 +1,74 @@
+"""
+Schedule of the ADD and READ commands. Items are kept in a heap of (timestamp, sequence number, data) entries keyed by
+epoch seconds, so ordering them is a float comparison. The sequence number breaks ties between items due at the same
+time in the order they were added, which also means the data is never compared.
+"""
+from typing import Any, Iterator, List, Optional, Tuple
+import datetime
+import heapq
+import itertools
+
+
+def epoch(timestamp: Any) -> float:
+    """
+    Returns a timestamp as epoch seconds
+    :param timestamp: epoch seconds or a datetime, as stored by schedules saved before they were keyed by epoch seconds
+    :return: epoch seconds
+    """
+    if isinstance(timestamp, datetime.datetime):
+        return timestamp.timestamp()
+    return float(timestamp)
+
+
+class Schedule:
+    """
+    Items ordered by the time they are due at
+    """
+
+    def __init__(self):
+        """Creates an empty schedule"""
+        self._heap: List[Tuple[float, int, Any]] = []
+        self._sequence = itertools.count()
+
+    def __len__(self) -> int:
+        return len(self._heap)
+
+    def __iter__(self) -> Iterator[Tuple[float, Any]]:
+        """Yields the timestamps and data of the items in the order they are due"""
+        for timestamp, _, data in sorted(self._heap):
+            yield timestamp, data
+
+    def add(self, timestamp: float, data: Any):
+        """
+        Adds an item
+        :param timestamp: epoch seconds the item is due at
+        :param data: the item
+        """
+        heapq.heappush(self._heap, (timestamp, next(self._sequence), data))
+
+    def next_due(self) -> Optional[float]:
+        """
+        Returns the timestamp the earliest item is due at
+        :return: epoch seconds, None if the schedule is empty
+        """
+        return self._heap[0][0] if self._heap else None
+
+    def pop_due(self, timestamp: float, limit: Optional[int] = None) -> List[Any]:
+        """
+        Removes the items due at or before a timestamp, earliest first
+        :param timestamp: epoch seconds
+        :param limit: maximum number of items to remove, None for all of the due items
+        :return: the items
+        """
+        heap = self._heap
+        count = len(heap) if limit is None else limit
+        items = []
+        while heap and heap[0][0] <= timestamp and len(items) < count:
+            items.append(heapq.heappop(heap)[2])
+        return items
+
+    def clear(self):
+        """
+        Removes every item
+        """
+        self._heap = []
@@ -0,0 +1,381 @@
+"""
+Packed serialization of structured values, the MessagePack format. A nested value is encoded into a single bulk of
+bytes in one pass and decoded from it in one pass, instead of being written and parsed element by element as RESP
+arrays and dictionaries. Connections switch to it with HELLO MSGPACK.
+
+The msgpack package is used when it is installed, it packs and unpacks in C. Otherwise the pure Python encoder and
+decoder below are used, which produce and read the same format, so either side of a connection may have it or not.
+
+Values RESP has types for that MessagePack does not are packed as extension types:
+
+    set     extension 1, holding the elements packed as an array
+    Error   extension 2, holding the message as UTF-8
+
+Tuples, deques and ChunkedQueues are packed as arrays and datetimes as strings, as RESP does.
+"""
+from typing import Any, Callable, List, Tuple
+from collections import deque
+import datetime
+import struct
+from .chunked_queue import ChunkedQueue
+from .exceptions import Error
+from .utils import encode
+
+try:
+    import msgpack
+except ImportError:  # pragma: no cover
+    msgpack = None
+
+SET_EXT = 1
+ERROR_EXT = 2
+
+# sequences packed as arrays, Error is a tuple too and has to be checked first
+ARRAY_TYPES = (list, tuple, deque, ChunkedQueue)
+
+# prefixes of the fixed size forms to the smallest length they can not hold
+_FIX_LIMITS = {0xA0: 0x20, 0x90: 0x10, 0x80: 0x10}
+# single bytes, to write one byte headers and small integers without packing them
+_BYTES = [bytes((code,)) for code in range(0x100)]
+# lengths of the fixed size extensions to their prefix
+_EXT_FIXED = {1: 0xD4, 2: 0xD5, 4: 0xD6, 8: 0xD7, 16: 0xD8}
+
+
+def python_pack(data: Any) -> bytes:
+    """
+    Packs a value with the pure Python encoder
+    :param data: value to pack
+    :return: packed bytes
+    :raises TypeError if the value, or one nested in it, can not be packed
+    :raises OverflowError for integers that do not fit in 64 bits
+    """
+    chunks: List[bytes] = []
+    _pack(data, chunks.append)
+    return b"".join(chunks)
+
+
+# pylint: disable-next=too-many-branches,too-many-statements
+def _pack(data: Any, write: Callable[[bytes], Any]):
+    """
+    Writes the packed chunks of a value
+    :param data: value to pack
+    :param write: appends a chunk to the output
+    """
+    if data is None:
+        write(b"\xc0")
+    elif data is True:
+        write(b"\xc3")
+    elif data is False:
+        write(b"\xc2")
+    elif isinstance(data, int):
+        if -0x20 <= data < 0x80:
+            write(_BYTES[data & 0xFF])
+        elif data > 0:
+            if data <= 0xFF:
+                write(struct.pack(">BB", 0xCC, data))
+            elif data <= 0xFFFF:
+                write(struct.pack(">BH", 0xCD, data))
+            elif data <= 0xFFFFFFFF:
+                write(struct.pack(">BI", 0xCE, data))
+            elif data <= 0xFFFFFFFFFFFFFFFF:
+                write(struct.pack(">BQ", 0xCF, data))
+            else:
+                raise OverflowError(f"integer {data} does not fit in 64 bits")
+        elif data >= -0x80:
+            write(struct.pack(">Bb", 0xD0, data))
+        elif data >= -0x8000:
+            write(struct.pack(">Bh", 0xD1, data))
+        elif data >= -0x80000000:
+            write(struct.pack(">Bi", 0xD2, data))
+        elif data >= -0x8000000000000000:
+            write(struct.pack(">Bq", 0xD3, data))
+        else:
+            raise OverflowError(f"integer {data} does not fit in 64 bits")
+    elif isinstance(data, float):
+        write(struct.pack(">Bd", 0xCB, data))
+    elif isinstance(data, (bytes, bytearray, memoryview)):
+        _pack_header(write, len(data), None, 0xC4, 0xC5, 0xC6)
+        write(bytes(data))
+    elif isinstance(data, str):
+        bdata = data.encode("utf-8")
+        _pack_header(write, len(bdata), 0xA0, 0xD9, 0xDA, 0xDB)
+        write(bdata)
+    elif isinstance(data, Error):
+        _pack_ext(write, ERROR_EXT, encode(data.message))
+    elif isinstance(data, ARRAY_TYPES):
+        _pack_header(write, len(data), 0x90, None, 0xDC, 0xDD)
+        for item in data:
+            _pack(item, write)
+    elif isinstance(data, dict):
+        _pack_header(write, len(data), 0x80, None, 0xDE, 0xDF)
+        for key, value in data.items():
+            _pack(key, write)
+            _pack(value, write)
+    elif isinstance(data, (set, frozenset)):
+        _pack_ext(write, SET_EXT, python_pack(list(data)))
+    elif isinstance(data, datetime.datetime):
+        _pack(str(data), write)
+    else:
+        raise TypeError(f"can not pack {type(data).__name__}")
+
+
+# pylint: disable-next=too-many-arguments,too-many-positional-arguments
+def _pack_header(write: Callable[[bytes], Any], length: int, fix: Any, code8: Any, code16: int, code32: int):
+    """
+    Writes the header of a string, bytes, array or map
+    :param write: appends a chunk to the output
+    :param length: number of bytes or elements
+    :param fix: prefix of the fixed size form, which holds the length in its low bits, None if the type has none
+    :param code8: prefix of the form with an 8 bit length, None if the type has none
+    :param code16: prefix of the form with a 16 bit length
+    :param code32: prefix of the form with a 32 bit length
+    """
+    if fix is not None and length < _FIX_LIMITS[fix]:
+        write(_BYTES[fix | length])
+    elif code8 is not None and length <= 0xFF:
+        write(struct.pack(">BB", code8, length))
+    elif length <= 0xFFFF:
+        write(struct.pack(">BH", code16, length))
+    else:
+        write(struct.pack(">BI", code32, length))
+
+
+def _pack_ext(write: Callable[[bytes], Any], code: int, data: bytes):
+    """
+    Writes an extension type
+    :param write: appends a chunk to the output
+    :param code: extension type
+    :param data: payload of the extension
+    """
+    length = len(data)
+    if length in _EXT_FIXED:
+        write(struct.pack(">Bb", _EXT_FIXED[length], code))
+    elif length <= 0xFF:
+        write(struct.pack(">BBb", 0xC7, length, code))
+    elif length <= 0xFFFF:
+        write(struct.pack(">BHb", 0xC8, length, code))
+    else:
+        write(struct.pack(">BIb", 0xC9, length, code))
+    write(data)
+
+
+def python_unpack(data: bytes) -> Any:
+    """
+    Unpacks a value with the pure Python decoder
+    :param data: packed bytes
+    :return: the value
+    :raises ValueError if the bytes are truncated, hold more than one value or are not packed
+    """
+    try:
+        value, pos = _unpack(memoryview(data), 0)
+    except (IndexError, struct.error) as error:
+        raise ValueError("truncated packed value") from error
+    if pos != len(data):
+        raise ValueError(f"{len(data) - pos} extra bytes after the packed value")
+    return value
+
+
+# length prefixed types, to the format of their length and their kind
+_LENGTHS = {
+    0xC4: (">B", "bin"),
+    0xC5: (">H", "bin"),
+    0xC6: (">I", "bin"),
+    0xC7: (">B", "ext"),
+    0xC8: (">H", "ext"),
+    0xC9: (">I", "ext"),
+    0xD9: (">B", "str"),
+    0xDA: (">H", "str"),
+    0xDB: (">I", "str"),
+    0xDC: (">H", "array"),
+    0xDD: (">I", "array"),
+    0xDE: (">H", "map"),
+    0xDF: (">I", "map"),
+}
+# numbers, to their format
+_NUMBERS = {
+    0xCA: ">f",
+    0xCB: ">d",
+    0xCC: ">B",
+    0xCD: ">H",
+    0xCE: ">I",
+    0xCF: ">Q",
+    0xD0: ">b",
+    0xD1: ">h",
+    0xD2: ">i",
+    0xD3: ">q",
+}
+
+
+# pylint: disable-next=too-many-return-statements,too-many-branches
+def _unpack(view: memoryview, pos: int) -> Tuple[Any, int]:
+    """
+    Unpacks the value starting at an offset
+    :param view: packed bytes
+    :param pos: offset of the value
+    :return: tuple of the value and the offset just past it
+    """
+    code = view[pos]
+    pos += 1
+    if code < 0x80:
+        return code, pos
+    if code >= 0xE0:
+        return code - 0x100, pos
+    if code < 0x90:
+        return _unpack_map(view, pos, code & 0x0F)
+    if code < 0xA0:
+        return _unpack_array(view, pos, code & 0x0F)
+    if code < 0xC0:
+        return _unpack_str(view, pos, code & 0x1F)
+    if code == 0xC0:
+        return None, pos
+    if code == 0xC2:
+        return False, pos
+    if code == 0xC3:
+        return True, pos
+    if code in _LENGTHS:
+        fmt, kind = _LENGTHS[code]
+        (length,) = struct.unpack_from(fmt, view, pos)
+        pos += struct.calcsize(fmt)
+        if kind == "bin":
+            if pos + length > len(view):
+                raise ValueError("truncated packed value")
+            return bytes(view[pos:pos + length]), pos + length
+        if kind == "str":
+            return _unpack_str(view, pos, length)
+        if kind == "array":
+            return _unpack_array(view, pos, length)
+        if kind == "map":
+            return _unpack_map(view, pos, length)
+        (ext,) = struct.unpack_from(">b", view, pos)
+        return _unpack_ext(view, pos + 1, ext, length)
+    if code in _NUMBERS:
+        fmt = _NUMBERS[code]
+        (number,) = struct.unpack_from(fmt, view, pos)
+        return number, pos + struct.calcsize(fmt)
+    if 0xD4 <= code <= 0xD8:
+        (ext,) = struct.unpack_from(">b", view, pos)
+        return _unpack_ext(view, pos + 1, ext, 1 << (code - 0xD4))
+    raise ValueError(f"invalid packed type 0x{code:02x}")
+
+
+def _unpack_str(view: memoryview, pos: int, length: int) -> Tuple[str, int]:
+    """
+    Unpacks a string
+    :param view: packed bytes
+    :param pos: offset of the first byte of the string
+    :param length: length of the string in bytes
+    :return: tuple of the string and the offset just past it
+    """
+    end = pos + length
+    if end > len(view):
+        raise ValueError("truncated packed value")
+    return str(view[pos:end], "utf-8"), end
+
+
+def _unpack_array(view: memoryview, pos: int, length: int) -> Tuple[List[Any], int]:
+    """
+    Unpacks an array
+    :param view: packed bytes
+    :param pos: offset of the first element
+    :param length: number of elements
+    :return: tuple of the list of elements and the offset just past it
+    """
+    items = []
+    for _ in range(length):
+        item, pos = _unpack(view, pos)
+        items.append(item)
+    return items, pos
+
+
+def _unpack_map(view: memoryview, pos: int, length: int) -> Tuple[dict, int]:
+    """
+    Unpacks a map
+    :param view: packed bytes
+    :param pos: offset of the first key
+    :param length: number of key value pairs
+    :return: tuple of the dictionary and the offset just past it
+    """
+    items = {}
+    for _ in range(length):
+        key, pos = _unpack(view, pos)
+        items[key], pos = _unpack(view, pos)
+    return items, pos
+
+
+def _unpack_ext(view: memoryview, pos: int, code: int, length: int) -> Tuple[Any, int]:
+    """
+    Unpacks an extension type
+    :param view: packed bytes
+    :param pos: offset of the payload
+    :param code: extension type
+    :param length: length of the payload
+    :return: tuple of the value and the offset just past it
+    """
+    end = pos + length
+    if end > len(view):
+        raise ValueError("truncated packed value")
+    return _ext_value(code, bytes(view[pos:end]), python_unpack), end
+
+
+def _ext_value(code: int, data: bytes, unpack_elements: Callable[[bytes], Any]) -> Any:
+    """
+    Turns an extension type back into its value
+    :param code: extension type
+    :param data: payload of the extension
+    :param unpack_elements: unpacks the elements of a set
+    :return: the value
+    :raises ValueError for unknown extension types
+    """
+    if code == SET_EXT:
+        return set(unpack_elements(data))
+    if code == ERROR_EXT:
+        return Error(data)
+    raise ValueError(f"unknown extension type {code}")
+
+
+def _msgpack_default(data: Any) -> Any:
+    """
+    Converts the values msgpack can not pack by itself
+    :param data: value to convert
+    :return: a value msgpack can pack
+    :raises TypeError if the value can not be packed
+    """
+    if isinstance(data, Error):
+        return msgpack.ExtType(ERROR_EXT, encode(data.message))
+    if isinstance(data, ARRAY_TYPES):
+        return list(data)
+    if isinstance(data, dict):
+        return dict(data)
+    if isinstance(data, (set, frozenset)):
+        return msgpack.ExtType(SET_EXT, msgpack_pack(list(data)))
+    if isinstance(data, datetime.datetime):
+        return str(data)
+    raise TypeError(f"can not pack {type(data).__name__}")
+
+
+def msgpack_pack(data: Any) -> bytes:
+    """
+    Packs a value with msgpack. Types are matched strictly so that Errors, which are tuples, are not packed as arrays
+    :param data: value to pack
+    :return: packed bytes
+    """
+    return msgpack.packb(data, default=_msgpack_default, use_bin_type=True, strict_types=True)
+
+
+def msgpack_unpack(data: bytes) -> Any:
+    """
+    Unpacks a value with msgpack
+    :param data: packed bytes
+    :return: the value
+    """
+    return msgpack.unpackb(
+        data,
+        raw=False,
+        strict_map_key=False,
+        ext_hook=lambda code, payload: _ext_value(code, payload, msgpack_unpack),
+    )
+
+
+# the accelerated codec when it is installed
+ACCELERATED = msgpack is not None
+pack: Callable[[Any], bytes] = msgpack_pack if ACCELERATED else python_pack
+unpack: Callable[[bytes], Any] = msgpack_unpack if ACCELERATED else python_unpack
@@ -1,81 +1,272 @@
 """
-Socket Pool used by the client to manage connections to the server
+Socket Pool used by the client to manage connections to the server. The pool opens at most max_size connections. Once
+they are all in use, callers queue up and get a connection handed over as soon as one is checked in, first come first
+served, or fail once the pool timeout passes. Idle connections are reused most recently used first, so that the ones
+that are not needed age out and are closed by a reaper after max_age seconds. A connection taken from the pool is
+checked for having been closed by the server before it is handed out.
 """
-import heapq
-import time
+from collections import deque
+from dataclasses import dataclass
 from io import BufferedRWPair
-from typing import Dict, List, Tuple, Any, Callable, Union
+from typing import Deque, Dict, Tuple, Any, Callable, Optional, Union
+import select
+import time
+import weakref
+import gevent
 from gevent import socket
+from gevent.event import Event
 from gevent.thread import get_ident
+from .exceptions import PoolTimeout
+
+POOL_MAX_SIZE = 64
+
+
+@dataclass
+class PoolStats:
+    """
+    Contains the statistics of a socket pool
+    :cvar checkouts is the number of connections handed out
+    :cvar waits is the number of checkouts that had to wait for a connection to be checked in
+    :cvar timeouts is the number of checkouts that gave up waiting
+    :cvar creates is the number of connections opened
+    :cvar reaped is the number of idle connections closed as they had not been used for max_age seconds
+    :cvar dead is the number of idle connections found closed by the server on checkout
+    """
+
+    checkouts: int = 0
+    waits: int = 0
+    timeouts: int = 0
+    creates: int = 0
+    reaped: int = 0
+    dead: int = 0
 
 
+# pylint: disable-next=too-few-public-methods
+class Waiter:
+    """
+    Checkout waiting for a connection
+    """
+
+    __slots__ = ("event", "sock")
+
+    def __init__(self):
+        self.event = Event()
+        # the connection handed over, None if the waiter may open a connection of its own instead
+        self.sock: Optional[BufferedRWPair] = None
+
+
+# pylint: disable-next=too-many-instance-attributes
 class SocketPool:
     """
     Manages connections to the kvault server
     """
 
-    # pylint: disable-next=missing-function-docstring
-    def __init__(self, host: str, port, max_age: int = 60):
+    # pylint: disable-next=too-many-arguments
+    def __init__(self, host: str, port, max_age: int = 60, max_size: int = POOL_MAX_SIZE,
+                 timeout: Optional[float] = None):
+        """
+        Creates an empty pool
+        :param host: host of the server
+        :param port: port of the server
+        :param max_age: number of seconds a connection may stay idle before it is closed
+        :param max_size: maximum number of connections open at once
+        :param timeout: number of seconds a checkout waits for a connection once they are all in use, None to wait
+        until one is checked in
+        """
         self.host = host
         self.port = port
         self.max_age = max_age
-        self.free: List[Tuple[float, BufferedRWPair]] = []
+        self.max_size = max_size
+        self.timeout = timeout
+        # called with every new connection before it is used, e.g. to set up the state of the connection on the server
+        self.on_connect: Optional[Callable[[BufferedRWPair], None]] = None
+        # idle connections with the time they were checked in, the most recently used last
+        self.free: Deque[Tuple[float, BufferedRWPair]] = deque()
         self.in_use: Dict[Union[int, BufferedRWPair], BufferedRWPair] = {}
+        self.stats = PoolStats()
         self._tid: Callable[[Any], int] = get_ident
+        # number of open connections, including the ones being opened
+        self._size = 0
+        self._waiters: Deque[Waiter] = deque()
+        self._reaper: Optional[gevent.Greenlet] = None
+        # sockets of the connections, which are only file objects, to check them for data with select
+        self._sockets: "weakref.WeakKeyDictionary[BufferedRWPair, socket.socket]" = weakref.WeakKeyDictionary()
 
-    # pylint: disable-next=missing-function-docstring
-    def checkout(self):
-        """Establishes a socket connection"""
-        now = time.time()
+    def __len__(self) -> int:
+        """Returns the number of open connections"""
+        return self._size
+
+    def checkout(self) -> BufferedRWPair:
+        """
+        Hands out a connection to the calling thread or greenlet, the one it already holds if any
+        :return: the connection
+        :raises PoolTimeout if all the connections stayed in use for longer than the pool timeout
+        """
         tid = self._tid()
-        if tid in self.in_use:
-            sock = self.in_use[tid]
-            if sock.closed:
-                del self.in_use[sock]
-            else:
-                return self.in_use[sock]
+        sock = self.in_use.get(tid)
+        if sock is not None:
+            if not sock.closed:
+                return sock
+            del self.in_use[tid]
+            self._release()
+
+        sock = self._take_free()
+        if sock is None:
+            if self._size >= self.max_size or self._waiters:
+                sock = self._wait()
+            if sock is None:
+                sock = self._create()
+        self.in_use[tid] = sock
+        self.stats.checkouts += 1
+        return sock
 
+    def _take_free(self) -> Optional[BufferedRWPair]:
+        """
+        Takes the most recently used idle connection that is still open
+        :return: the connection, None if there is none
+        """
         while self.free:
-            timestamp, sock = heapq.heappop(self.free)
-            if timestamp < now - self.max_age:
-                try:
-                    sock.close()
-                except OSError:
-                    pass
-            else:
-                self.in_use[tid] = sock
+            _, sock = self.free.pop()
+            if self._idle_alive(sock):
                 return sock
+            self.stats.dead += 1
+            self._discard(sock)
+        return None
 
-        sock = self.create_socket_file()
-        self.in_use[tid] = sock
+    def _wait(self) -> Optional[BufferedRWPair]:
+        """
+        Queues up behind the other waiting checkouts until a connection is handed over or may be opened
+        :return: the connection handed over, None if one may be opened instead
+        :raises PoolTimeout if the pool timeout passed first
+        """
+        waiter = Waiter()
+        self._waiters.append(waiter)
+        self.stats.waits += 1
+        if not waiter.event.wait(self.timeout):
+            self._waiters.remove(waiter)
+            self.stats.timeouts += 1
+            raise PoolTimeout(f"no connection to {self.host}:{self.port} was free within {self.timeout}s")
+        if waiter.sock is None:
+            # handed the room of a connection that was closed
+            self._size -= 1
+        return waiter.sock
+
+    def _create(self) -> BufferedRWPair:
+        """
+        Opens a connection, giving its room in the pool back if it fails
+        :return: the connection
+        """
+        self._size += 1
+        try:
+            sock = self.create_socket_file()
+        except BaseException:
+            self._release()
+            raise
+        self.stats.creates += 1
         return sock
 
-    def checkin(self):
-        """Checks if there is an in use socket connection and adds it to the heap returning a boolean value. True
-        indicates that the socket is in use, false indicates it is not"""
+    def checkin(self) -> bool:
+        """
+        Gives the connection of the calling thread or greenlet back, handing it to the longest waiting checkout if any
+        :return: True if the caller held a connection
+        """
         tid = self._tid()
-        if tid in self.in_use:
-            sock = self.in_use.pop(tid)
-            if not sock.closed:
-                heapq.heappush(self.free, (time.time(), sock))
-            return True
-        return False
+        sock = self.in_use.pop(tid, None)
+        if sock is None:
+            return False
+        if sock.closed:
+            self._release()
+        elif self._waiters:
+            waiter = self._waiters.popleft()
+            waiter.sock = sock
+            waiter.event.set()
+        else:
+            self.free.append((time.time(), sock))
+            if self._reaper is None:
+                self._reaper = gevent.spawn_later(self.max_age, self._reap)
+        return True
 
-    def close(self):
-        """Closes connection of the socket"""
+    def close(self) -> bool:
+        """
+        Closes the connection of the calling thread or greenlet, e.g. once the server went away
+        :return: True if the caller held a connection
+        """
         tid = self._tid()
         sock = self.in_use.pop(tid, None)
-        if sock:
-            try:
-                sock.close()
-            except OSError:
-                pass
-            return True
-        return False
+        if sock is None:
+            return False
+        self._discard(sock)
+        return True
+
+    def close_all(self):
+        """
+        Closes the idle connections and stops the reaper
+        """
+        while self.free:
+            _, sock = self.free.pop()
+            self._discard(sock)
+        if self._reaper is not None:
+            self._reaper.kill(block=False)
+            self._reaper = None
+
+    def _discard(self, sock: BufferedRWPair):
+        """
+        Closes a connection and gives its room in the pool back
+        :param sock: the connection
+        """
+        try:
+            sock.close()
+        except OSError:
+            pass
+        self._release()
+
+    def _release(self):
+        """
+        Gives the room of a closed connection to the longest waiting checkout, or back to the pool
+        """
+        if self._waiters:
+            # the waiter opens a connection in the room, which is still counted until it has
+            self._waiters.popleft().event.set()
+        else:
+            self._size -= 1
+
+    def _reap(self):
+        """
+        Closes the connections that have been idle for max_age seconds, then runs again once the next one would be
+        """
+        deadline = time.time() - self.max_age
+        while self.free and self.free[0][0] <= deadline:
+            _, sock = self.free.popleft()
+            self.stats.reaped += 1
+            self._discard(sock)
+        if self.free:
+            self._reaper = gevent.spawn_later(max(self.free[0][0] - deadline, 0), self._reap)
+        else:
+            self._reaper = None
+
+    def _idle_alive(self, sock: BufferedRWPair) -> bool:
+        """
+        Checks without blocking that an idle connection has not been closed by the server. Nothing is expected on an
+        idle connection, so a connection with anything to read, the end of the stream included, is not reused
+        :param sock: the connection
+        :return: True if the connection can be used
+        """
+        conn = self._sockets.get(sock)
+        if sock.closed or conn is None:
+            return False
+        try:
+            readable, _, _ = select.select([conn], [], [], 0)
+        except (OSError, ValueError):
+            return False
+        return not readable
 
     def create_socket_file(self):
         """Connects to socket on the AF_INET family with the SOCK_STREAM socket kind and returns a BufferedRWPair"""
         conn = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
         conn.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
         conn.connect((self.host, self.port))
-        return conn.makefile("rwb")
+        sock = conn.makefile("rwb")
+        self._sockets[sock] = conn
+        if self.on_connect is not None:
+            self.on_connect(sock)
+        return sock
@@ -1,7 +1,11 @@
 """
 Threaded stream server
 """
+from typing import Callable, List
+import socket
 import socketserver
+import threading
+import time
 
 
 class ThreadedStreamServer:
@@ -13,6 +17,69 @@ class ThreadedStreamServer:
         self.stream_server = None
         self.address = address
         self.handler = handler
+        self._timers: List[Callable[[], float]] = []
+
+    def add_timer(self, callback: Callable[[], float]):
+        """
+        Registers a callback that is called repeatedly on a background thread while the server is serving. The
+        callback returns the number of seconds to wait before it is called again
+        :param callback: callback to run
+        """
+        self._timers.append(callback)
+
+    @staticmethod
+    def _run_timer(callback: Callable[[], float]):
+        """
+        Runs a timer callback forever
+        :param callback: callback to run
+        """
+        while True:
+            time.sleep(callback())
+
+    @staticmethod
+    def cooperate():
+        """
+        Lets other connections run before the current one continues
+        """
+        time.sleep(0)
+
+    @staticmethod
+    def spawn(func: Callable, *args):
+        """
+        Runs a function in the background, on a daemon thread of its own
+        :param func: function to run
+        :param args: arguments of the function
+        """
+        threading.Thread(target=func, args=args, daemon=True).start()
+
+    @staticmethod
+    def call_later(delay: float, callback: Callable[[], None]) -> Callable[[], None]:
+        """
+        Calls a callback once after a delay, on a daemon thread of its own
+        :param delay: number of seconds to wait
+        :param callback: callback to call
+        :return: function cancelling the call
+        """
+        timer = threading.Timer(delay, callback)
+        timer.daemon = True
+        timer.start()
+        return timer.cancel
+
+    @staticmethod
+    def create_connection(address) -> socket.socket:
+        """
+        Connects to another server, e.g. the primary of a replica
+        :param address: host and port of the server
+        :return: socket connection
+        """
+        return socket.create_connection(address)
+
+    @staticmethod
+    def event() -> threading.Event:
+        """
+        Returns an event a connection thread can wait on
+        """
+        return threading.Event()
 
     def serve_forever(self):
         """
@@ -37,8 +104,12 @@ class ThreadedStreamServer:
             Threaded server
             """
 
+            allow_reuse_address = True
             allow_reuse_port = True
+            daemon_threads = True
 
+        for timer in self._timers:
+            threading.Thread(target=self._run_timer, args=(timer,), daemon=True).start()
         self.stream_server = ThreadedServer(self.address, RequestHandler)
         self.stream_server.serve_forever()
 
@@ -0,0 +1,88 @@
+"""
+Tracking of the keys read by clients keeping a near cache, like CLIENT TRACKING in Redis. A connection with tracking
+enabled has the keys it reads remembered, and once one of them changes, expires or is evicted, an invalidation message
+is pushed to the connection its invalidations are redirected to, a connection subscribed to INVALIDATE_CHANNEL. A key
+is forgotten once its invalidation is sent: the client reads it again, and so tracks it again, only if it needs it.
+
+The table of tracked keys is bounded. Past its limit the oldest tracked key is invalidated early, which only costs the
+clients a cache miss.
+"""
+from typing import Any, Callable, Dict, Iterable, Optional
+
+INVALIDATE_CHANNEL = b"__kvault__:invalidate"
+TRACKING_TABLE_MAX_KEYS = 1000000
+
+
+class KeyTracker:
+    """
+    Keys read by the connections with tracking enabled
+    """
+
+    def __init__(self, encode: Callable[[Any], bytes], max_keys: int = TRACKING_TABLE_MAX_KEYS):
+        """
+        Creates an empty table of tracked keys
+        :param encode: serializes a push message
+        :param max_keys: number of tracked keys above which the oldest one is invalidated
+        """
+        self.max_keys = max_keys
+        self._encode = encode
+        # key to the connections that read it, dicts are used as ordered sets and the oldest key comes first
+        self._readers: Dict[Any, Dict[Any, None]] = {}
+        self.invalidations = 0
+
+    def __len__(self) -> int:
+        """Returns the number of tracked keys"""
+        return len(self._readers)
+
+    def track(self, connection, keys: Iterable[Any]):
+        """
+        Remembers that a connection read keys
+        :param connection: state of the connection, with its tracking redirect set
+        :param keys: keys read
+        """
+        for key in keys:
+            readers = self._readers.get(key)
+            if readers is None:
+                if len(self._readers) >= self.max_keys:
+                    self.invalidate((next(iter(self._readers)),))
+                readers = self._readers[key] = {}
+            readers[connection] = None
+
+    def invalidate(self, keys: Iterable[Any]):
+        """
+        Tells the connections that read keys that the keys changed, then forgets the keys. The message of a key is
+        serialized once for all of its readers
+        :param keys: keys that changed
+        """
+        for key in keys:
+            readers = self._readers.pop(key, None)
+            if readers:
+                self._push(readers, self._encode([b"message", INVALIDATE_CHANNEL, [key]]))
+
+    def flush(self):
+        """
+        Tells every connection that read a key that all the keys changed, with an invalidation of no key in
+        particular, then forgets all the keys
+        """
+        readers: Dict[Any, None] = {}
+        for connections in self._readers.values():
+            readers.update(connections)
+        self._readers.clear()
+        if readers:
+            self._push(readers, self._encode([b"message", INVALIDATE_CHANNEL, None]))
+
+    def _push(self, readers: Dict[Any, None], data: bytes):
+        """
+        Pushes an invalidation to the connections the invalidations of readers are redirected to, once per connection.
+        Readers that have since turned tracking off are skipped
+        :param readers: connections that read the keys
+        :param data: serialized invalidation
+        """
+        targets: Dict[Any, None] = {}
+        for connection in readers:
+            target: Optional[Any] = connection.tracking
+            if target is not None:
+                targets[target] = None
+        for target in targets:
+            if target.push is not None and target.push(data):
+                self.invalidations += 1
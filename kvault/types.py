@@ -1,15 +1,84 @@
 """
 Types
 """
-from collections import namedtuple
+from typing import Any, Union
 
 # pylint: disable-next=invalid-name
 unicode = str
 basestring = (bytes, str)
 
-Value = namedtuple("Value", ("data_type", "value"))
-
 KV = 0
 HASH = 1
 QUEUE = 2
 SET = 3
+
+# K/V values of these types are stored in the store as they are, without a Value around them
+INLINE_TYPES = frozenset((str, bytes, int, float))
+
+
+class Value:
+    """
+    Value of a key along with its data type. Values are mutable, so that commands can update them in place instead of
+    allocating a new Value, and have no __dict__ to keep their size down.
+    """
+
+    __slots__ = ("data_type", "value")
+
+    # constructed in __new__ so that Values pickled when Value was a namedtuple can still be loaded
+    def __new__(cls, data_type: int, value: Any):
+        self = super().__new__(cls)
+        self.data_type = data_type
+        self.value = value
+        return self
+
+    def __reduce__(self):
+        return Value, (self.data_type, self.value)
+
+    def __iter__(self):
+        yield self.data_type
+        yield self.value
+
+    def __eq__(self, other):
+        if not isinstance(other, Value):
+            return NotImplemented
+        return self.data_type == other.data_type and self.value == other.value
+
+    __hash__ = None
+
+    def __repr__(self):
+        return f"Value(data_type={self.data_type!r}, value={self.value!r})"
+
+
+# entry stored for a key, a string or number of a K/V key stored inline or a Value
+Entry = Union[Value, str, bytes, int, float]
+
+
+def pack(data_type: int, value: Any) -> Entry:
+    """
+    Returns the entry to store for a value. Strings and numbers of K/V keys are stored inline, every other value is
+    wrapped in a Value holding its data type
+    :param data_type: Data type of the value
+    :param value: the value
+    :return: entry to store
+    """
+    if data_type == KV and type(value) in INLINE_TYPES:
+        return value
+    return Value(data_type, value)
+
+
+def data_type_of(entry: Entry) -> int:
+    """
+    Returns the data type of a stored entry
+    :param entry: entry in the store
+    :return: data type
+    """
+    return entry.data_type if isinstance(entry, Value) else KV
+
+
+def payload_of(entry: Entry) -> Any:
+    """
+    Returns the value of a stored entry
+    :param entry: entry in the store
+    :return: the value
+    """
+    return entry.value if isinstance(entry, Value) else entry
@@ -3,9 +3,10 @@ Mixin classes that provide extra functionality to classes
 """
 from typing import Dict, Any
 import time
-from collections import deque
+from ..chunked_queue import ChunkedQueue
 from ..exceptions import CommandError
-from ..types import Value, QUEUE, HASH, SET, KV
+from ..expiry import ExpiryIndex
+from ..types import QUEUE, HASH, SET, KV, pack, data_type_of, payload_of
 
 
 # pylint: disable-next=too-few-public-methods
@@ -25,9 +26,10 @@ class Guards:
     Contains validity checks for the data types and expiry time of commands
     """
 
-    def __init__(self, kv_store: Dict, expiry_map: Dict[Any, float]):
+    def __init__(self, kv_store: Dict, expiry_map: Dict[Any, float], expiry: ExpiryIndex):
         self._kv = kv_store
         self._expiry_map = expiry_map
+        self._expiry = expiry
 
     def check_expired(self, key, timestamp=None) -> bool:
         """
@@ -39,6 +41,29 @@ class Guards:
         _timestamp = timestamp or time.time()
         return key in self._expiry_map and _timestamp > self._expiry_map[key]
 
+    def expire_key(self, key):
+        """
+        Removes an expired key along with its expiry time, so that a key created again under the same name does not
+        inherit it
+        :param key: Key
+        """
+        self.on_keyspace_change()
+        del self._kv[key]
+        self._expiry.cancel(key, self._expiry_map.pop(key))
+        self.on_key_expired(key)
+
+    def on_keyspace_change(self):
+        """
+        Called before keys are added to or removed from the store by expiry or by reading a missing key. Does nothing by
+        default
+        """
+
+    def on_key_expired(self, key):
+        """
+        Called for every expired key that is removed from the store. Does nothing by default
+        :param key: Key
+        """
+
     def check_datatype(self, data_type, key, set_missing=True, subtype=None):
         """
         Checks the data type of the supplied key
@@ -50,26 +75,27 @@ class Guards:
         :raises CommandError if the operation is against a wrong key type of wrong value
         """
         if key in self._kv and self.check_expired(key):
-            del self._kv[key]
+            self.expire_key(key)
 
         if key in self._kv:
-            value = self._kv[key]
-            if value.data_type != data_type:
+            entry = self._kv[key]
+            if data_type_of(entry) != data_type:
                 raise CommandError(
-                    f"Operation against wrong key type. Key type {value.data_type}. data type: {data_type}"
+                    f"Operation against wrong key type. Key type {data_type_of(entry)}. data type: {data_type}"
                 )
-            if subtype is not None and not isinstance(value.value, subtype):
+            if subtype is not None and not isinstance(payload_of(entry), subtype):
                 raise CommandError(
-                    f"Operation against wrong value type. Value: {value.value}. Subtype: {subtype}"
+                    f"Operation against wrong value type. Value: {payload_of(entry)}. Subtype: {subtype}"
                 )
         elif set_missing:
             value = None
             if data_type == HASH:
                 value = {}
             elif data_type == QUEUE:
-                value = deque()
+                value = ChunkedQueue()
             elif data_type == SET:
                 value = set()
             elif data_type == KV:
                 value = ""
-            self._kv[key] = Value(data_type, value)
+            self.on_keyspace_change()
+            self._kv[key] = pack(data_type, value)
@@ -42,9 +42,32 @@ def run_benchmark(client):
             client.get('k%d' % i)
 
 
+def run_pipeline_benchmark(client, depths=(1, 10, 100, 1000)):
+    number = 10000
+    for depth in depths:
+        with timed('get/set pipeline depth=%d' % depth):
+            for start in range(0, number, depth):
+                with client.pipeline() as pipe:
+                    for i in range(start, min(start + depth, number)):
+                        pipe.set('k%d' % i, 'v%d' % i)
+
+            for start in range(0, number, depth):
+                with client.pipeline() as pipe:
+                    for i in range(start, min(start + depth, number)):
+                        pipe.get('k%d' % i)
+
+
 def main():
     client = Client()
 
+    try:
+        run_benchmark(client)
+        run_pipeline_benchmark(client)
+    finally:
+        client.close()
+
+    print('msgpack serializer')
+    client = Client(serializer='msgpack')
     try:
         run_benchmark(client)
     finally:
@@ -0,0 +1,97 @@
+"""
+Benchmark how a kvault server scales with the number of connections. For every step a number of idle connections is
+opened and kept open while a fixed number of active clients run get/set round trips.
+
+Start the server with enough room for the connections, for example:
+
+    python -m kvault --engine asyncio --max-clients 60000
+
+and run the benchmark against it:
+
+    python tests/connection_scaling.py --steps 1000 10000 50000
+
+Every connection uses a file descriptor in both processes, so the open file limit (ulimit -n) must be raised for the
+larger steps.
+"""
+import argparse
+import asyncio
+import resource
+import time
+
+from kvault.protocol_handler import ProtocolHandler
+from kvault.resp_parser import RespParser, INCOMPLETE
+
+protocol = ProtocolHandler()
+
+
+def raise_open_file_limit():
+    soft, hard = resource.getrlimit(resource.RLIMIT_NOFILE)
+    if soft < hard:
+        resource.setrlimit(resource.RLIMIT_NOFILE, (hard, hard))
+    return resource.getrlimit(resource.RLIMIT_NOFILE)[0]
+
+
+async def request(reader, writer, parser, *args):
+    writer.write(protocol.encode(args))
+    response = parser.gets()
+    while response is INCOMPLETE:
+        parser.feed(await reader.read(65536))
+        response = parser.gets()
+    return response
+
+
+async def open_idle(host, port, count, concurrency=500):
+    semaphore = asyncio.Semaphore(concurrency)
+
+    async def connect():
+        async with semaphore:
+            return await asyncio.open_connection(host, port)
+
+    return await asyncio.gather(*(connect() for _ in range(count)))
+
+
+async def active_client(host, port, client_id, requests):
+    reader, writer = await asyncio.open_connection(host, port)
+    parser = RespParser()
+    for i in range(requests):
+        key = 'k%d-%d' % (client_id, i)
+        await request(reader, writer, parser, b'SET', key, 'v%d' % i)
+        await request(reader, writer, parser, b'GET', key)
+    writer.close()
+
+
+async def run_step(host, port, idle, active, requests):
+    start = time.time()
+    connections = await open_idle(host, port, idle)
+    connect_duration = time.time() - start
+
+    start = time.time()
+    await asyncio.gather(*(active_client(host, port, i, requests) for i in range(active)))
+    duration = time.time() - start
+    ops = active * requests * 2
+
+    for _, writer in connections:
+        writer.close()
+    print('idle=%d: connect %.2fs, %d active clients %.0f ops/s' % (idle, connect_duration, active, ops / duration))
+
+
+def main():
+    parser = argparse.ArgumentParser(description='kvault connection scaling benchmark')
+    parser.add_argument('-H', '--host', default='127.0.0.1')
+    parser.add_argument('-p', '--port', default=31337, type=int)
+    parser.add_argument('-s', '--steps', default=[1000, 10000, 50000], nargs='+', type=int,
+                        help='Number of idle connections for each step.')
+    parser.add_argument('-a', '--active', default=100, type=int, help='Number of active clients.')
+    parser.add_argument('-r', '--requests', default=100, type=int, help='get/set round trips per active client.')
+    args = parser.parse_args()
+
+    limit = raise_open_file_limit()
+    for idle in args.steps:
+        if idle + args.active >= limit:
+            print('idle=%d: skipped, open file limit is %d' % (idle, limit))
+            continue
+        asyncio.run(run_step(args.host, args.port, idle, args.active, args.requests))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,75 @@
+"""
+Benchmark the memory used per key by the store. Every size is measured in a forked process, which fills a store with
+small integers and short strings through kv_set and reports the growth of its resident memory divided by the number of
+keys. The same keys stored as (data type, value) namedtuples, the representation used before values were stored
+inline, are measured for comparison.
+
+    python tests/memory_benchmark.py --sizes 1000000 10000000
+"""
+import argparse
+import gc
+import os
+from collections import namedtuple
+
+from kvault.commands import Commands
+from kvault.eviction import used_memory_rss
+from kvault.expiry import ExpiryIndex
+from kvault.schedule import Schedule
+from kvault.types import KV
+
+LegacyValue = namedtuple('LegacyValue', ('data_type', 'value'))
+
+
+def fill_commands(count):
+    commands = Commands(kv_store={}, expiry_map={}, expiry=ExpiryIndex(), schedule=Schedule())
+    for i in range(count):
+        commands.kv_set('key:%d' % i, i if i % 2 else 'value:%d' % i)
+    return commands
+
+
+def fill_legacy(count):
+    store = {}
+    for i in range(count):
+        store['key:%d' % i] = LegacyValue(KV, i if i % 2 else 'value:%d' % i)
+    return store
+
+
+def rss_holding(_):
+    # the filled store is an argument, so that it is still alive while the memory is measured
+    gc.collect()
+    return used_memory_rss()
+
+
+def measure(fill, count):
+    read_fd, write_fd = os.pipe()
+    pid = os.fork()
+    if pid == 0:
+        os.close(read_fd)
+        gc.collect()
+        before = used_memory_rss()
+        after = rss_holding(fill(count))
+        os.write(write_fd, b'%d' % (after - before))
+        os._exit(0)
+
+    os.close(write_fd)
+    with os.fdopen(read_fd, 'rb') as reader:
+        used = int(reader.read() or 0)
+    os.waitpid(pid, 0)
+    return used
+
+
+def main():
+    parser = argparse.ArgumentParser(description='kvault memory per key benchmark')
+    parser.add_argument('-s', '--sizes', default=[1000000, 10000000], nargs='+', type=int,
+                        help='Number of keys for every measurement.')
+    args = parser.parse_args()
+
+    for count in args.sizes:
+        compact = measure(fill_commands, count)
+        legacy = measure(fill_legacy, count)
+        print('%d keys: %.1f bytes/key, %.1f bytes/key as namedtuples (%.0f%% less)' % (
+            count, compact / count, legacy / count, 100.0 * (legacy - compact) / legacy if legacy else 0))
+
+
+if __name__ == '__main__':
+    main()
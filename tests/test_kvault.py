@@ -1,11 +1,32 @@
+import asyncio
+import datetime
 import functools
+import os
+import pickle
+import socket
 import sys
 import threading
+import time
 import unittest
+from collections import deque
 import gevent
+import gevent.socket
 
-from client import Client
-from kvault.queue_server import QueueServer
+from client import AsyncClient, Client, ShardedClient
+from kvault.chunked_queue import ChunkedQueue
+from kvault.cluster import cluster_nodes, key_slot
+from kvault.commandstats import LatencyHistogram, bucket_index, bucket_upper_bound
+from kvault.exceptions import CommandError, Error, PoolTimeout, ProtocolError, ServerError, WatchError
+from kvault.expiry import ExpiryIndex
+from kvault.hash_ring import HashRing
+from kvault.persistence import save_snapshot
+from kvault.protocol_handler import ProtocolHandler
+from kvault.queue_server import QueueServer, ServerConfig
+from kvault.resp_parser import RespParser, INCOMPLETE
+from kvault.scan import ScanCursors
+from kvault.serialization import python_pack, python_unpack
+from kvault.types import HASH
+from kvault.utils import decode
 
 TEST_HOST = '127.0.0.1'
 TEST_PORT = 31339
@@ -31,7 +52,7 @@ class KvaultMiniDatabaseTestCases(unittest.TestCase):
 
     @classmethod
     def setUpClass(cls) -> None:
-        run_queue_server()
+        _, cls.server = run_queue_server()
 
     @classmethod
     def tearDownClass(cls) -> None:
@@ -70,6 +91,124 @@ class KvaultMiniDatabaseTestCases(unittest.TestCase):
         self.assertEqual(key_partial.lrange(0), ['a3', 'x', 'a1'])
         self.assertEqual(key_partial.lflush(), 3)
 
+    def test_blocking_pop(self):
+        self.assertEqual(self.c.rpush('q1', 'a'), 1)
+        self.assertEqual(self.c.blpop('q0', 'q1', 1), ['q1', 'a'])
+        self.assertIsNone(self.c.brpop('q1', 0.2))
+
+        # Blocked clients are served in the order they blocked, straight from the pushed values.
+        waiting = [gevent.spawn(Client(host=TEST_HOST, port=TEST_PORT).blpop, 'q1', 0) for _ in range(2)]
+        tail = gevent.spawn(Client(host=TEST_HOST, port=TEST_PORT).brpoplpush, 'q1', 'q2', 0)
+        gevent.sleep(0.05)
+        self.assertEqual(self.c.info()['blocked_clients'], 3)
+        self.c.rpush('q1', 'x', 'y', 'z', 'w')
+        gevent.joinall(waiting + [tail], timeout=1)
+        self.assertEqual([greenlet.value for greenlet in waiting], [['q1', 'x'], ['q1', 'y']])
+        self.assertEqual(tail.value, 'w')
+        self.assertEqual(self.c.lrange('q1', 0), ['z'])
+        self.assertEqual(self.c.lrange('q2', 0), ['w'])
+        self.assertEqual(self.c.info()['blocked_clients'], 0)
+
+    def test_pubsub(self):
+        pubsub = self.c.pubsub()
+        pubsub.subscribe('news', 'sport')
+        pubsub.psubscribe('news.*')
+        self.assertEqual([pubsub.get_message(1)['data'] for _ in range(3)], [1, 2, 3])
+        self.assertEqual(self.c.publish('news', 'hello'), 1)
+        self.assertEqual(self.c.publish('news.tech', 'hi'), 1)
+        self.assertEqual(self.c.publish('weather', 'rain'), 0)
+        self.assertEqual(pubsub.get_message(1),
+                         {'type': 'message', 'pattern': None, 'channel': 'news', 'data': 'hello'})
+        self.assertEqual(pubsub.get_message(1),
+                         {'type': 'pmessage', 'pattern': 'news.*', 'channel': 'news.tech', 'data': 'hi'})
+        self.assertIsNone(pubsub.get_message(0.05))
+
+        # A subscribed connection only accepts subscription commands.
+        pubsub.execute(b'GET', 'news')
+        self.assertRaises(CommandError, pubsub.get_message, 1)
+        pubsub.unsubscribe('sport')
+        self.assertEqual(pubsub.get_message(1), {'type': 'unsubscribe', 'pattern': None, 'channel': 'sport', 'data': 2})
+        self.assertEqual(self.c.info()['pubsub_channels'], 1)
+        pubsub.close()
+        gevent.sleep(0.05)
+        self.assertEqual(self.c.publish('news', 'hello'), 0)
+        self.assertEqual(self.c.info()['pubsub_patterns'], 0)
+
+    def test_near_cache(self):
+        cached = Client(host=TEST_HOST, port=TEST_PORT, near_cache_size=2)
+        self.c.set('k1', 'v1')
+        self.assertEqual(cached.get('k1'), 'v1')
+        self.assertEqual(cached.get('k1'), 'v1')
+        self.assertEqual(cached.near_cache.hits, 1)
+
+        # Writes of other clients reach the cache as invalidations, writes of the client itself right away.
+        self.c.set('k1', 'v2')
+        gevent.sleep(0.05)
+        self.assertEqual(cached.get('k1'), 'v2')
+        cached.set('k1', 'v3')
+        self.assertEqual(cached.get('k1'), 'v3')
+        self.c.hset('h1', 'f1', 'a')
+        self.assertEqual(cached.hget('h1', 'f1'), 'a')
+        self.c.hset('h1', 'f1', 'b')
+        gevent.sleep(0.05)
+        self.assertEqual(cached.hget('h1', 'f1'), 'b')
+
+        # Expired keys are invalidated too.
+        self.c.set('k2', 'v1')
+        self.c.pexpireat('k2', int((time.time() + 0.1) * 1000))
+        self.assertEqual(cached.get('k2'), 'v1')
+        gevent.sleep(0.3)
+        self.assertIsNone(cached.get('k2'))
+        self.assertEqual(len(cached.near_cache), 2)
+        self.assertGreaterEqual(self.c.info()['tracking_invalidations'], 3)
+
+        self.c.flush()
+        gevent.sleep(0.05)
+        self.assertEqual(len(cached.near_cache), 0)
+        cached.close()
+
+    def test_schedule(self):
+        now = time.time()
+        # Items due at the same time are read in the order they were added, their data is never compared.
+        for i in range(5):
+            self.c.add(now - 10, {'n': i})
+        self.c.add(now + 100, 'later')
+        self.assertEqual(self.c.read(limit=2), [{'n': 0}, {'n': 1}])
+        self.assertEqual(self.c.read(), [{'n': 2}, {'n': 3}, {'n': 4}])
+        self.assertEqual(self.c.read(datetime.datetime.fromtimestamp(now + 200)), ['later'])
+        self.c.add('2020-01-01 00:00:00', 'dated')
+        self.assertEqual(self.c.read(), ['dated'])
+
+        # A blocking read wakes up once the next item is due.
+        reader = gevent.spawn(Client(host=TEST_HOST, port=TEST_PORT).read, block=0)
+        gevent.sleep(0.05)
+        self.c.add(now + 10, 'late')
+        self.c.add(time.time() + 0.2, 'soon')
+        start = time.time()
+        self.assertEqual(reader.get(timeout=1), ['soon'])
+        self.assertGreater(time.time() - start, 0.15)
+        self.assertIsNone(self.c.read(block=0.1))
+        self.assertEqual(self.c.flush_schedule(), 1)
+
+    def test_slow_subscriber(self):
+        queue_server = QueueServer(host=TEST_HOST, port=TEST_PORT + 6,
+                                   config=ServerConfig(output_buffer_limit=16 * 1024))
+        gevent.spawn(queue_server.run)
+        gevent.sleep()
+        client = Client(host=TEST_HOST, port=TEST_PORT + 6)
+        slow = client.pubsub()
+        slow.subscribe('c')
+        gevent.sleep(0.05)
+
+        # The subscriber never reads, so its buffer fills up and it is disconnected rather than holding publishers up.
+        published = 0
+        while client.publish('c', 'x' * 4096):
+            published += 1
+            self.assertLess(published, 10000)
+        gevent.sleep(0.05)
+        self.assertEqual(client.info()['pubsub_channels'], 0)
+        queue_server._server.stop()
+
     def test_kv(self):
         kp = KeyPartial(self.c, 'k1')
         kp.set(['alpha', 'beta', 'gamma'])
@@ -115,6 +254,36 @@ class KvaultMiniDatabaseTestCases(unittest.TestCase):
         self.assertEqual(self.c.hget('h1', 'k1'), 'v1')
         self.assertEqual(self.c.scard('s1'), 2)
 
+        # A save that fails does not leave its temporary file behind.
+        with self.assertRaises(KeyError):
+            save_snapshot('/tmp/simpledb-failed.state', {'kv': {}})
+        self.assertFalse([name for name in os.listdir('/tmp') if name.startswith('simpledb-failed.state.tmp')])
+
+    def test_bgsave(self):
+        self.c.mset({'k%d' % i: 'v%d' % i for i in range(100)})
+        self.c.hset('h1', 'k1', 'v1')
+        self.c.set('tmp', 'v1')
+        self.c.expire('tmp', 60)
+        self.assertEqual(self.c.bgsave('/tmp/simpledb-bg.state'), 1)
+        self.c.set('k1', 'changed')
+
+        for _ in range(100):
+            info = self.c.info()
+            if not info['bgsave_in_progress']:
+                break
+            gevent.sleep(0.05)
+        self.assertEqual(info['last_bgsave_status'], 'ok')
+        self.assertEqual(info['bgsave_keys_written'], 102)
+        self.assertTrue(info['last_save_time'] > 0)
+
+        self.c.flushall()
+        self.assertTrue(self.c.restore('/tmp/simpledb-bg.state'))
+        self.assertEqual(self.c.length(), 102)
+        self.assertEqual(self.c.get('k1'), 'v1')
+        self.assertEqual(self.c.hget('h1', 'k1'), 'v1')
+        self.c.expire('tmp', -1)
+        self.assertTrue(self.c.get('tmp') is None)
+
     def test_expiry(self):
         self.c.mset({'k1': 'v1', 'k2': 'v2', 'k3': 'v3'})
 
@@ -123,6 +292,790 @@ class KvaultMiniDatabaseTestCases(unittest.TestCase):
         self.c.expire('k3', 3)
         self.assertEqual(self.c.mget('k1', 'k2', 'k3'), ['v1', None, 'v3'])
 
+    def test_active_expiry(self):
+        self.c.mset({'k1': 'v1', 'k2': 'v2'})
+        self.c.expire('k1', 0.01)
+        expired_keys = self.c.info()['expired_keys']
+
+        # The background sweeper evicts the key without it being read.
+        gevent.sleep(0.3)
+        self.assertEqual(self.c.length(), 1)
+        self.assertEqual(self.c.info()['expired_keys'], expired_keys + 1)
+
+    def test_expiry_rearm(self):
+        self.c.set('k1', 'v1')
+        for _ in range(100):
+            self.c.expire('k1', 0.01)
+        self.c.expire('k1', 60)
+
+        # Re-arming moves the key, so the sweeper does not evict it for its earlier expiry times.
+        gevent.sleep(0.3)
+        self.assertEqual(self.c.get('k1'), 'v1')
+
+        # A key deleted and created again does not inherit the expiry time.
+        self.c.setex('k2', 'v2', 0.01)
+        self.c.delete('k2')
+        self.c.set('k2', 'v2')
+        gevent.sleep(0.3)
+        self.assertEqual(self.c.get('k2'), 'v2')
+
+    def test_scan(self):
+        self.c.mset({'user:%d' % i: i for i in range(25)})
+        self.c.set('other', 1)
+        cursor, keys = self.c.scan(0, 'COUNT', 10)
+        self.assertTrue(cursor)
+        self.assertEqual(len(keys), 10)
+
+        # Keys removed during the iteration are skipped, keys added may be returned.
+        self.c.delete('user:24')
+        self.c.set('user:99', 99)
+        while cursor:
+            cursor, batch = self.c.scan(cursor, 'COUNT', 10)
+            keys.extend(batch)
+        self.assertEqual(sorted(set(keys) - {'user:99'}), sorted(['other'] + ['user:%d' % i for i in range(24)]))
+        self.assertEqual(len(keys), len(set(keys)))
+        self.assertEqual(sorted(self.c.scan_iter(match='user:*', count=7)),
+                         sorted('user:%d' % i for i in range(24)) + ['user:99'])
+        self.assertRaises(CommandError, self.c.scan, 12345)
+
+        self.c.hmset('h', {'f%d' % i: i for i in range(30)})
+        self.assertEqual(dict(self.c.hscan_iter('h', count=4)), {'f%d' % i: i for i in range(30)})
+        self.assertEqual(dict(self.c.hscan_iter('h', match='f2?')), {'f2%d' % i: 20 + i for i in range(10)})
+
+        self.c.sadd('s', *range(30))
+        self.assertEqual(sorted(self.c.sscan_iter('s', count=8)), list(range(30)))
+
+        # Iterations walk the containers until they change, then resume after the last elements they walked.
+        cursor, fields = self.c.hscan('h', 0, 'COUNT', 10)
+        self.assertIsNotNone(self.server._cursors.live[(HASH, 'h')][cursor].remaining)
+        self.c.hmset('h', {'g%d' % i: i for i in range(30)})
+        self.assertIsNone(self.server._cursors._cursors[cursor].remaining)
+        while cursor:
+            cursor, batch = self.c.hscan('h', cursor, 'COUNT', 10)
+            self.assertFalse(set(batch) & set(fields))
+            fields.update(batch)
+        self.assertEqual({field: fields[field] for field in fields if field.startswith('f')},
+                         {'f%d' % i: i for i in range(30)})
+        self.assertEqual(self.server._cursors.live, {})
+
+        cursor, members = self.c.sscan('s', 0, 'COUNT', 10)
+        self.c.srem('s', *members[:5])
+        self.c.sadd('s', *range(100, 130))
+        while cursor:
+            cursor, batch = self.c.sscan('s', cursor, 'COUNT', 10)
+            members.extend(batch)
+        self.assertTrue(set(members[5:]) >= set(range(30)) - set(members[:5]))
+
+        # Returned keys can be removed as the iteration goes.
+        self.c.mset({'tmp:%d' % i: i for i in range(40)})
+        cursor, removed = 0, []
+        while True:
+            cursor, batch = self.c.scan(cursor, 'MATCH', 'tmp:*', 'COUNT', 7)
+            if batch:
+                self.c.mpop(*batch)
+            removed.extend(batch)
+            if not cursor:
+                break
+        self.assertEqual(sorted(removed), sorted('tmp:%d' % i for i in range(40)))
+
+    def test_scan_cursors(self):
+        cursors = ScanCursors(max_cursors=1)
+        container = dict.fromkeys(range(10))
+        cursor, batch = cursors.advance(0, 'c', container, container.__contains__, 3)
+        self.assertEqual(batch, [0, 1, 2])
+        # The last key walked moved to the end, the iteration resumes after the one before it.
+        cursors.invalidate('c')
+        del container[2]
+        container[2] = None
+        cursor, batch = cursors.advance(cursor, 'c', container, container.__contains__, 10)
+        self.assertEqual((cursor, batch), (0, [3, 4, 5, 6, 7, 8, 9, 2]))
+
+        # An iteration whose cursor was released starts over.
+        first, _ = cursors.advance(0, 'c', container, container.__contains__, 3)
+        cursors.advance(0, 'c', container, container.__contains__, 3)
+        self.assertEqual(len(cursors), 1)
+        self.assertEqual(cursors.advance(first, 'c', container, container.__contains__, 20), (0, list(container)))
+        self.assertRaises(CommandError, cursors.advance, 100, 'c', container, container.__contains__, 3)
+
+        self.c.rpush('q', *['v%d' % i for i in range(30)])
+        self.assertEqual(list(self.c.lscan_iter('q', count=8)), ['v%d' % i for i in range(30)])
+        self.assertEqual(self.c.lscan('q', 25, 'MATCH', 'v2*'), [0, ['v25', 'v26', 'v27', 'v28', 'v29']])
+
+    def test_pipeline(self):
+        with self.c.pipeline() as pipe:
+            pipe.set('k1', 'v1').incr('i')
+            pipe.get('k1')
+            self.assertEqual(len(pipe), 3)
+        self.assertEqual(pipe.results, [1, 1, 'v1'])
+
+        pipe = self.c.pipeline(raise_on_error=False)
+        pipe.hset('k1', 'f1', 'v1')
+        pipe.incrby('i', 2)
+        error, value = pipe.commit()
+        self.assertTrue(isinstance(error, Error))
+        self.assertEqual(value, 3)
+
+    def test_pipeline_transaction(self):
+        with self.c.pipeline(transaction=True) as pipe:
+            pipe.set('k1', 'v1')
+            pipe.lpush('q1', 'i1', 'i2')
+            pipe.mget('k1', 'k2')
+        self.assertEqual(pipe.results, [1, 2, ['v1', None]])
+
+        pipe = self.c.pipeline(transaction=True)
+        pipe.set('k1', 'v2')
+        pipe.execute(b'UNKNOWN')
+        self.assertRaises(CommandError, pipe.commit)
+        self.assertEqual(self.c.get('k1'), 'v1')
+
+    def test_watch(self):
+        self.c.set('balance', 100)
+        pipe = self.c.pipeline()
+        pipe.watch('balance')
+        balance = pipe.get('balance')
+        pipe.multi()
+        pipe.set('balance', balance - 10)
+        self.assertEqual(pipe.commit(), [1])
+        self.assertEqual(self.c.get('balance'), 90)
+
+        # A write of another client between WATCH and EXEC aborts the transaction.
+        pipe.watch('balance')
+        balance = pipe.get('balance')
+        self.c.incr('balance')
+        pipe.multi()
+        pipe.set('balance', balance - 10)
+        self.assertRaises(WatchError, pipe.commit)
+        self.assertEqual(self.c.get('balance'), 91)
+
+    def test_script(self):
+        def check_and_set(call, key, expected, value):
+            if call('GET', key) != expected:
+                return 0
+            return call('SET', key, value)
+
+        self.server.add_script('CAS', check_and_set)
+        self.c.set('k1', 'v1')
+        self.assertEqual(self.c.execute(b'CAS', 'k1', 'v0', 'v2'), 0)
+        self.assertEqual(self.c.execute(b'CAS', 'k1', 'v1', 'v2'), 1)
+        self.assertEqual(self.c.get('k1'), 'v2')
+
+    def test_response_cache(self):
+        hits = self.c.info()['response_cache_hits']
+        self.c.set('k1', ['v1', {'f1': 1}])
+        self.assertEqual(self.c.get('k1'), ['v1', {'f1': 1}])
+        self.assertEqual(self.c.get('k1'), ['v1', {'f1': 1}])
+        self.assertEqual(self.c.info()['response_cache_hits'], hits + 1)
+
+        # Values updated in place are serialized again once written.
+        self.c.hset('h1', 'f1', 'v1')
+        self.assertEqual(self.c.get('h1'), {'f1': 'v1'})
+        self.c.hset('h1', 'f2', 'v2')
+        self.assertEqual(self.c.get('h1'), {'f1': 'v1', 'f2': 'v2'})
+        self.c.set('k1', 'v2')
+        self.assertEqual(self.c.get('k1'), 'v2')
+        self.c.flushall()
+        self.assertIsNone(self.c.get('k1'))
+
+    def test_command_stats(self):
+        self.assertEqual(self.c.config('RESETSTAT'), 1)
+        for i in range(10):
+            self.c.set('k%d' % i, i)
+            self.c.get('k%d' % i)
+        with self.assertRaises(CommandError):
+            self.c.incr('k1', 'x')
+        stats = self.c.info('commandstats')
+        self.assertEqual(stats['cmdstat_set']['calls'], 10)
+        self.assertEqual(stats['cmdstat_get']['calls'], 10)
+        self.assertEqual(stats['cmdstat_incr']['failed_calls'], 1)
+        self.assertTrue(0 <= stats['cmdstat_get']['p50'] <= stats['cmdstat_get']['p99'] <= stats['cmdstat_get']['p999'])
+        # The writes and reads, along with CONFIG RESETSTAT and INFO themselves.
+        self.assertEqual(self.c.info()['commands_processed'], 22)
+
+        histograms = self.c.latency('HISTOGRAM', 'get', 'missing')
+        self.assertEqual(list(histograms), ['get'])
+        self.assertEqual(sum(histograms['get']['histogram_usec'].values()), 10)
+        self.assertEqual(self.c.latency('RESET', 'GET'), 1)
+        self.assertNotIn('cmdstat_get', self.c.info('commandstats'))
+        with self.assertRaises(CommandError):
+            self.c.config('SET', 'maxmemory', 0)
+
+    def test_protocol_error(self):
+        conn = gevent.socket.create_connection((TEST_HOST, TEST_PORT))
+        conn.sendall(b'*abc\r\n*1\r\n$4\r\nPING\r\n')
+        # The connection is closed after the error, the requests following the invalid one are dropped.
+        reply = b''.join(iter(lambda: conn.recv(1024), b''))
+        self.assertTrue(reply.startswith(b'-ERR Protocol error'))
+        conn.close()
+        self.assertEqual(self.c.set('k1', 'v1'), 1)
+
+    def test_socket_pool(self):
+        client = Client(host=TEST_HOST, port=TEST_PORT, pool_max_size=2, pool_max_age=0.2)
+        # More greenlets than connections queue up for them instead of opening more.
+        start = time.time()
+        gevent.joinall([gevent.spawn(client.blpop, 'empty', 0.1) for _ in range(6)], raise_error=True)
+        self.assertGreaterEqual(time.time() - start, 0.3)
+        stats = client.pool_stats
+        self.assertEqual((stats.creates, stats.waits, stats.checkouts), (2, 4, 6))
+
+        client._socket_pool.timeout = 0.05
+        pops = [gevent.spawn(client.blpop, 'empty', 0.2) for _ in range(3)]
+        gevent.joinall(pops)
+        self.assertTrue(isinstance(pops[-1].exception, PoolTimeout))
+        self.assertEqual(stats.timeouts, 1)
+
+        # Idle connections closed by the server are not handed out, the others are closed once idle for too long.
+        conn = client._socket_pool.free[-1][1]
+        client._socket_pool._sockets[conn].shutdown(socket.SHUT_RD)
+        self.assertEqual(client.get('k1'), None)
+        self.assertEqual(stats.dead, 1)
+        gevent.sleep(0.5)
+        self.assertEqual((len(client._socket_pool), stats.reaped), (0, 1))
+        client.close()
+
+    def test_packed_serializer(self):
+        packed = Client(host=TEST_HOST, port=TEST_PORT, serializer='msgpack')
+        nested = [1, 2.5, -3, [b'raw', 'caf\u00e9', None, True], {'k': {'v': [2 ** 40]}}]
+        self.assertEqual(packed.set('k1', nested), 1)
+        self.assertEqual(packed.get('k1'), nested)
+        self.assertEqual(self.c.get('k1')[:3], [1, 2, -3])
+        self.assertEqual(packed.sadd('s1', 'a', 'b'), 2)
+        self.assertEqual(packed.smembers('s1'), {'a', 'b'})
+        self.assertEqual(packed.execute(b'HELLO')['serializer'], 'msgpack')
+
+        # Errors inside a packed reply are unpacked as errors.
+        pipe = packed.pipeline(transaction=True, raise_on_error=False)
+        pipe.set('k2', 'v2')
+        pipe.hget('k2', 'f1')
+        value, error = pipe.commit()
+        self.assertEqual(value, 1)
+        self.assertTrue(isinstance(error, Error))
+        self.assertRaises(CommandError, packed.execute, b'HELLO', b'XML')
+        packed.close()
+
+    def test_deep_pipeline(self):
+        # More requests than fit in a single batch on the server.
+        with self.c.pipeline() as pipe:
+            for i in range(1000):
+                pipe.set('k%d' % i, 'v%d' % i)
+            for i in range(1000):
+                pipe.get('k%d' % i)
+        self.assertEqual(pipe.results[:1000], [1] * 1000)
+        self.assertEqual(pipe.results[1000:], ['v%d' % i for i in range(1000)])
+
+
+class EnginesTestCases(unittest.TestCase):
+
+    def run_engine(self, engine, port):
+        queue_server = QueueServer(host=TEST_HOST, port=port, config=ServerConfig(engine=engine))
+        threading.Thread(target=queue_server.run, daemon=True).start()
+        client = Client(host=TEST_HOST, port=port)
+        for _ in range(50):
+            try:
+                client.length()
+                break
+            except (ConnectionError, ServerError):
+                gevent.sleep(0.05)
+        return queue_server, client
+
+    def check_engine(self, client):
+        self.assertEqual(client.set('k1', 'v1'), 1)
+        self.assertEqual(client.get('k1'), 'v1')
+        self.assertRaises(CommandError, client.hget, 'k1', 'f1')
+        with client.pipeline() as pipe:
+            for i in range(600):
+                pipe.incr('i')
+        self.assertEqual(pipe.results[-1], 600)
+        client.expire('k1', 0.01)
+        gevent.sleep(0.3)
+        self.assertEqual(client.length(), 1)
+
+        waiting = gevent.spawn(Client(host=TEST_HOST, port=client._port).blpop, 'q', 0)
+        gevent.sleep(0.05)
+        client.rpush('q', 'a')
+        self.assertEqual(waiting.get(timeout=1), ['q', 'a'])
+        with client.pipeline() as pipe:
+            pipe.brpop('q', 0.2)
+            pipe.incr('i')
+        self.assertEqual(pipe.results, [None, 601])
+        client.add(time.time() + 0.1, 'due')
+        self.assertEqual(client.read(block=1), ['due'])
+
+        pubsub = client.pubsub()
+        pubsub.subscribe('c')
+        self.assertEqual(pubsub.get_message(1)['type'], 'subscribe')
+        self.assertEqual(client.publish('c', 'm'), 1)
+        self.assertEqual(pubsub.get_message(1)['data'], 'm')
+        pubsub.close()
+
+    def test_threads(self):
+        queue_server, client = self.run_engine('threads', TEST_PORT + 1)
+        self.check_engine(client)
+        queue_server._server.stop()
+
+    def test_asyncio(self):
+        queue_server, client = self.run_engine('asyncio', TEST_PORT + 2)
+        self.check_engine(client)
+        queue_server._server.stop()
+
+    def test_async_client(self):
+        queue_server, _ = self.run_engine('threads', TEST_PORT + 7)
+
+        async def run():
+            async with AsyncClient(host=TEST_HOST, port=TEST_PORT + 7, serializer='msgpack') as client:
+                self.assertEqual(await client.set('k1', [1, {'a': 'b'}]), 1)
+                replies = await asyncio.gather(*(client.incr('i') for _ in range(200)), client.get('k1'))
+                self.assertEqual(replies[:-1], list(range(1, 201)))
+                self.assertEqual(replies[-1], [1, {'a': 'b'}])
+                with self.assertRaises(CommandError):
+                    await client.hget('k1', 'f1')
+                # A caller that stops waiting does not get the reply of another caller.
+                with self.assertRaises(asyncio.TimeoutError):
+                    await asyncio.wait_for(client.blpop('q1', 0.2), 0.05)
+                self.assertEqual(await client.get('i'), 200)
+
+        asyncio.run(run())
+        queue_server._server.stop()
+
+
+class ClusterTestCases(unittest.TestCase):
+
+    @classmethod
+    def setUpClass(cls) -> None:
+        cls.nodes = cluster_nodes(TEST_HOST, TEST_PORT + 3, 2)
+        cls.servers = [QueueServer(host=node.host, port=node.port, config=ServerConfig(cluster=cls.nodes))
+                       for node in cls.nodes]
+        for queue_server in cls.servers:
+            gevent.spawn(queue_server.run)
+        gevent.sleep()
+
+    def setUp(self):
+        self.c = Client(host=TEST_HOST, port=TEST_PORT + 3, cluster=True)
+
+    def tearDown(self) -> None:
+        self.c.flush()
+
+    def test_routing(self):
+        data = {'k%d' % i: 'v%d' % i for i in range(100)}
+        self.assertEqual(self.c.mset(data), 100)
+        self.assertEqual(self.c.length(), 100)
+        # Every worker only holds the keys of its own slots.
+        for node, queue_server in zip(self.nodes, self.servers):
+            self.assertTrue(0 < queue_server.kv_len() < 100)
+            for key in queue_server._kv:
+                self.assertTrue(node.start <= key_slot(key) <= node.end)
+
+        self.assertEqual(self.c.mget('k1', 'missing', 'k99', 'k42'), ['v1', None, 'v99', 'v42'])
+        self.assertEqual(self.c.get('k7'), 'v7')
+        self.assertEqual(self.c.mdelete('k1', 'k99', 'k42'), 3)
+        with self.c.pipeline() as pipe:
+            for i in range(10):
+                pipe.get('k%d' % i)
+        self.assertEqual(pipe.results, [None if i == 1 else 'v%d' % i for i in range(10)])
+
+    def test_moved(self):
+        client = Client(host=TEST_HOST, port=TEST_PORT + 3)
+        key = next('k%d' % i for i in range(100) if key_slot('k%d' % i) > self.nodes[0].end)
+        with self.assertRaises(CommandError) as context:
+            client.set(key, 'v1')
+        self.assertEqual(context.exception.message,
+                         b'MOVED %d %s:%d' % (key_slot(key), TEST_HOST.encode(), TEST_PORT + 4))
+        self.assertEqual(self.c.set(key, 'v1'), 1)
+
+
+class ShardedClientTestCases(unittest.TestCase):
+
+    @classmethod
+    def setUpClass(cls) -> None:
+        cls.servers = [QueueServer(host=TEST_HOST, port=TEST_PORT + 8 + i) for i in range(3)]
+        for queue_server in cls.servers:
+            gevent.spawn(queue_server.run)
+        gevent.sleep()
+
+    def setUp(self):
+        self.c = ShardedClient([(TEST_HOST, TEST_PORT + 8 + i) for i in range(3)])
+
+    def tearDown(self) -> None:
+        self.c.flush()
+        self.c.close()
+
+    def test_routing(self):
+        data = {'k%d' % i: 'v%d' % i for i in range(100)}
+        self.assertEqual(self.c.mset(data), 100)
+        self.assertEqual(self.c.length(), 100)
+        # Every server only holds the keys the ring assigns to it.
+        for i, queue_server in enumerate(self.servers):
+            self.assertTrue(0 < queue_server.kv_len() < 100)
+            for key in queue_server._kv:
+                self.assertEqual(self.c.node_for(key), (TEST_HOST, TEST_PORT + 8 + i))
+
+        self.assertEqual(self.c.mget('k1', 'missing', 'k99', 'k42'), ['v1', None, 'v99', 'v42'])
+        self.assertEqual(self.c['k7'], 'v7')
+        self.assertEqual(self.c.mdelete('k1', 'k99', 'k42'), 3)
+        self.assertEqual(self.c.mpop('k2', 'k3', 'k1'), ['v2', 'v3', None])
+        self.assertEqual(len(self.c), 95)
+
+        self.assertEqual(self.c.rpush('{q}.a', 'x'), 1)
+        self.c.rpoplpush('{q}.a', '{q}.b')
+        self.assertEqual(self.c.lpop('{q}.b'), 'x')
+        with self.assertRaises(CommandError):
+            self.c.execute(b'INFO')
+        self.assertEqual(len(self.c.execute_all(b'INFO')), 3)
+
+    def test_hash_ring(self):
+        nodes = ['node%d' % i for i in range(4)]
+        ring = HashRing(nodes)
+        keys = ['k%d' % i for i in range(4000)]
+        owners = {key: ring.get(key) for key in keys}
+        # Virtual nodes spread the keys about evenly.
+        for node in nodes:
+            self.assertTrue(600 < list(owners.values()).count(node) < 1400)
+        self.assertEqual(ring.get('{user1}.name'), ring.get('{user1}.email'))
+
+        ring.add('node4')
+        moved = [key for key in keys if ring.get(key) != owners[key]]
+        # Only about 1/N of the keys move, all of them to the new node.
+        self.assertTrue(500 < len(moved) < 1300)
+        self.assertTrue(all(ring.get(key) == 'node4' for key in moved))
+        ring.remove('node4')
+        self.assertEqual({key: ring.get(key) for key in keys}, owners)
+
+
+class ReplicationTestCases(unittest.TestCase):
+
+    def setUp(self):
+        self.primary_server = QueueServer(host=TEST_HOST, port=TEST_PORT + 11)
+        self.replica_server = QueueServer(host=TEST_HOST, port=TEST_PORT + 12)
+        for queue_server in (self.primary_server, self.replica_server):
+            gevent.spawn(queue_server.run)
+        gevent.sleep()
+        self.primary = Client(host=TEST_HOST, port=TEST_PORT + 11)
+        self.replica = Client(host=TEST_HOST, port=TEST_PORT + 12)
+
+    def tearDown(self):
+        self.replica.execute(b'REPLICAOF', 'NO', 'ONE')
+        for queue_server in (self.primary_server, self.replica_server):
+            queue_server._server.stop()
+
+    def wait_for(self, condition):
+        deadline = time.time() + 5
+        while not condition():
+            self.assertLess(time.time(), deadline)
+            gevent.sleep(0.01)
+
+    def test_replication(self):
+        self.primary.mset({'k1': 'v1', 'k2': 'v2'})
+        self.primary.rpush('q1', 'a', 'b')
+        self.assertEqual(self.replica.execute(b'REPLICAOF', TEST_HOST, TEST_PORT + 11), 1)
+        # The replica loads a snapshot saved in the background, then applies the writes streamed after it.
+        link_up = lambda: self.replica.info()['primary_link_status'] == 'up'
+        self.wait_for(lambda: self.primary_server._primary._full_sync is not None or link_up())
+        self.primary.set('k0', 'v0')
+        self.wait_for(link_up)
+        self.assertEqual(self.replica.mget('k0', 'k1', 'k2'), ['v0', 'v1', 'v2'])
+        # The snapshot is not held against the output buffer limit of the replica.
+        outbox = next(c.outbox for c in self.primary_server._clients.values() if c.outbox is not None)
+        self.assertEqual(outbox.limit, self.primary_server.output_buffer_limit)
+        self.primary.set('k3', 'v3')
+        self.primary.lpop('q1')
+        self.wait_for(lambda: self.replica.get('k3') == 'v3')
+        self.assertEqual(self.replica.lrange('q1', 0, 10), ['b'])
+        self.assertEqual(self.replica.info()['role'], 'replica')
+        self.assertEqual(self.primary.info()['connected_replicas'], 1)
+        with self.assertRaises(CommandError) as context:
+            self.replica.set('k4', 'v4')
+        self.assertTrue(decode(context.exception.message).startswith('READONLY'))
+
+        # Writes made while the link is down are taken from the backlog once the replica is back.
+        self.replica_server._replica.link.conn.shutdown(socket.SHUT_RDWR)
+        self.wait_for(lambda: self.replica.info()['primary_link_status'] == 'down')
+        self.primary.set('k4', 'v4')
+        self.primary.setex('k5', 'v5', 60)
+        self.wait_for(lambda: self.replica.get('k5') == 'v5')
+        info = self.replica.info()
+        self.assertEqual((info['replica_full_syncs'], info['replica_partial_syncs']), (1, 1))
+        self.assertEqual(info['replica_repl_offset'], self.primary.info()['repl_offset'])
+        self.assertEqual(self.replica.get('k4'), 'v4')
+
+        self.assertEqual(self.replica.execute(b'REPLICAOF', 'NO', 'ONE'), 1)
+        self.assertEqual(self.replica.set('k4', 'v6'), 1)
+        self.assertEqual(self.replica.info()['role'], 'primary')
+
+
+class AppendOnlyLogTestCases(unittest.TestCase):
+
+    def setUp(self):
+        self.filename = '/tmp/kvault-test.aof'
+        if os.path.exists(self.filename):
+            os.remove(self.filename)
+        self.queue_server = QueueServer(host=TEST_HOST, port=TEST_PORT + 5,
+                                        config=ServerConfig(append_only_file=self.filename, fsync='always'))
+        gevent.spawn(self.queue_server.run)
+        gevent.sleep()
+        self.c = Client(host=TEST_HOST, port=TEST_PORT + 5)
+
+    def tearDown(self):
+        self.c.close()
+        self.queue_server._server.stop()
+
+    def reload(self):
+        queue_server = QueueServer(config=ServerConfig(append_only_file=self.filename))
+        queue_server.load_log()
+        return queue_server
+
+    def test_replay(self):
+        self.c.mset({'k1': 'v1', 'k2': 'v2'})
+        self.c.setex('k3', 'v3', 60)
+        self.c.sadd('s1', 'm1', 'm2', 'm3')
+        popped = self.c.spop('s1')
+        self.c.lpush('q1', 'i1', 'i2')
+        self.c.incr('i')
+        self.c.delete('k2')
+        self.assertRaises(CommandError, self.c.hset, 'k1', 'f1', 'v1')
+        for i in range(3):
+            self.c.add(time.time() - 1, i)
+        self.c.add(time.time() + 0.1, 3)
+        self.c.add(time.time() + 60, 4)
+        self.assertEqual(self.c.read(limit=2), [0, 1])
+        self.assertEqual(self.c.read(limit=1, block=1), [2])
+        self.assertEqual(self.c.read(block=1), [3])
+
+        queue_server = self.reload()
+        self.assertEqual(queue_server.schedule_read('inf'), [4])
+        self.assertEqual(queue_server.kv_get('k1'), 'v1')
+        self.assertIsNone(queue_server.kv_get('k2'))
+        self.assertEqual(queue_server.kv_get('k3'), 'v3')
+        self.assertAlmostEqual(queue_server._expiry_map['k3'], self.queue_server._expiry_map['k3'], places=2)
+        self.assertEqual(queue_server.smembers('s1'), {'m1', 'm2', 'm3'} - set(popped))
+        self.assertEqual(queue_server.lrange('q1', 0), ['i2', 'i1'])
+        self.assertEqual(queue_server.kv_get('i'), 1)
+
+        # A request that was cut off while being written is dropped.
+        size = os.path.getsize(self.filename)
+        with open(self.filename, 'ab') as file_handle:
+            file_handle.write(b'*3\r\n$3\r\nSET\r\n')
+        self.assertEqual(self.reload().kv_get('k1'), 'v1')
+        self.assertEqual(os.path.getsize(self.filename), size)
+
+        # A request that fails in any way is skipped, and replayed requests are not counted as calls.
+        with open(self.filename, 'ab') as file_handle:
+            file_handle.write(b'*1\r\n$3\r\nSET\r\n')
+        queue_server = self.reload()
+        self.assertEqual(queue_server.kv_get('k1'), 'v1')
+        self.assertEqual(queue_server.command_stats(), {})
+
+    def test_rewrite(self):
+        for i in range(100):
+            self.c.set('k%d' % i, 'v%d' % i)
+        self.c.mdelete(*['k%d' % i for i in range(50)])
+        size = self.c.info()['aof_size']
+        self.assertEqual(self.c.bgrewriteaof(), 1)
+        self.c.set('k1', 'changed')
+
+        for _ in range(100):
+            info = self.c.info()
+            if not info['aof_rewrite_in_progress']:
+                break
+            gevent.sleep(0.05)
+        self.assertEqual(info['aof_rewrites'], 1)
+        self.assertTrue(info['aof_size'] < size)
+
+        self.c.set('k2', 'v2')
+        queue_server = self.reload()
+        self.assertEqual(queue_server.kv_len(), 52)
+        self.assertEqual(queue_server.kv_get('k1'), 'changed')
+        self.assertEqual(queue_server.kv_get('k2'), 'v2')
+        self.assertEqual(queue_server.kv_get('k99'), 'v99')
+
+
+class EvictionTestCases(unittest.TestCase):
+
+    def create_server(self, policy, maxmemory=20000):
+        return QueueServer(config=ServerConfig(maxmemory=maxmemory, maxmemory_policy=policy, maxmemory_samples=10))
+
+    def fill(self, queue_server, count=200, prefix='k'):
+        for i in range(count):
+            queue_server.respond([b'SET', '%s%d' % (prefix, i), 'v' * 20])
+
+    def test_memory_limit(self):
+        queue_server = self.create_server('allkeys-lru')
+        self.fill(queue_server)
+        info = queue_server.info()
+        # keys are evicted before a write, so the last write may exceed the limit by a key
+        self.assertTrue(0 < info['used_memory'] <= 20200)
+        self.assertTrue(info['evicted_keys'] > 0)
+        self.assertEqual(info['keys'] + info['evicted_keys'], 200)
+
+        queue_server.respond([b'DELETE', 'k199'])
+        queue_server.respond([b'FLUSH'])
+        self.assertEqual(queue_server.info()['used_memory'], 0)
+
+    def test_lru(self):
+        queue_server = self.create_server('allkeys-lru')
+        self.fill(queue_server, 50)
+        # A key that keeps being read survives while older keys are evicted.
+        for i in range(50):
+            queue_server.respond([b'GET', 'k0'])
+            self.fill(queue_server, 10, prefix='x%d-' % i)
+        self.assertEqual(queue_server.kv_get('k0'), 'v' * 20)
+
+    def test_volatile(self):
+        for policy in ('volatile-lru', 'volatile-ttl'):
+            queue_server = self.create_server(policy)
+            self.fill(queue_server, 50)
+            for i in range(150):
+                queue_server.respond([b'SETEX', 'tmp%d' % i, 'v' * 20, 60 + i])
+            self.assertEqual(sum(queue_server.kv_exists('k%d' % i) for i in range(50)), 50)
+            self.assertTrue(queue_server.info()['evicted_keys'] > 0)
+
+    def test_noeviction(self):
+        queue_server = self.create_server('noeviction')
+        with self.assertRaises(CommandError):
+            self.fill(queue_server)
+        self.assertEqual(queue_server.info()['evicted_keys'], 0)
+        self.assertEqual(queue_server.respond([b'DELETE', 'k0']), 1)
+
+
+class ExpiryIndexTestCases(unittest.TestCase):
+    def test_index(self):
+        index = ExpiryIndex(resolution=1)
+        for i in range(10):
+            index.arm('k%d' % i, 100 + i)
+        index.arm('k0', 200, 100)
+        index.cancel('k1', 101)
+        self.assertEqual(len(index), 9)
+        self.assertEqual(index.earliest(2), ['k2', 'k3'])
+
+        self.assertFalse(index.has_due(102.5))
+        self.assertTrue(index.has_due(103.5))
+        self.assertEqual(index.pop_due(105.5, limit=2), ['k2', 'k3'])
+        self.assertEqual(sorted(index.pop_due(105.5)), ['k4'])
+        self.assertEqual(len(index), 6)
+
+        index.clear()
+        self.assertEqual(len(index), 0)
+        self.assertFalse(index.has_due(1000))
+
+
+class LatencyHistogramTestCases(unittest.TestCase):
+    def test_percentiles(self):
+        histogram = LatencyHistogram()
+        self.assertEqual(histogram.percentile(99), 0)
+        for usec in range(1, 10001):
+            histogram.record(usec)
+        # Buckets are at most about 3% wide, whatever the latency.
+        for percentile, expected in ((50, 5000), (99, 9900), (99.9, 9990)):
+            self.assertTrue(expected <= histogram.percentile(percentile) <= expected * 1.032)
+        self.assertEqual(histogram.percentile(100), max(bound for bound, _ in histogram.buckets()))
+        self.assertEqual(sum(count for _, count in histogram.buckets()), 10000)
+        self.assertEqual(list(LatencyHistogram().buckets()), [])
+        for usec in (0, 63, 64, 65, 1000, 123456):
+            self.assertTrue(usec <= bucket_upper_bound(bucket_index(usec)) <= usec * 1.032 + 1)
+
+
+class ChunkedQueueTestCases(unittest.TestCase):
+    def test_queue(self):
+        queue, expected = ChunkedQueue(range(100)), deque(range(100))
+        queue.extendleft(range(100, 300))
+        expected.extendleft(range(100, 300))
+        for _ in range(100):
+            self.assertEqual(queue.pop(), expected.pop())
+            self.assertEqual(queue.popleft(), expected.popleft())
+        queue.append('x')
+        expected.append('x')
+        value = expected[20]
+        queue.remove(value)
+        expected.remove(value)
+        queue[-2] = 'y'
+        expected[-2] = 'y'
+        self.assertEqual(list(queue), list(expected))
+        self.assertEqual(queue[10], expected[10])
+        self.assertEqual(queue[5:-5], list(expected)[5:-5])
+
+        queue = ChunkedQueue(range(1000))
+        queue.trim(200, 210)
+        self.assertEqual(list(queue), list(range(200, 210)))
+        self.assertEqual(pickle.loads(pickle.dumps(queue)), queue)
+        while queue:
+            queue.popleft()
+        self.assertRaises(IndexError, queue.pop)
+
+
+class RespParserTestCases(unittest.TestCase):
+
+    def setUp(self):
+        self.protocol = ProtocolHandler()
+        self.parser = RespParser()
+
+    def test_partial_messages(self):
+        message = [b'MSET', {b'k1': b'v1', 'k2': [1, 2, None]}, {b'm1'}, 'caf\u00e9']
+        encoded = self.protocol.encode(message)
+
+        # Feed one byte at a time, nothing is parsed until the message is complete.
+        for i in range(len(encoded) - 1):
+            self.parser.feed(encoded[i:i + 1])
+            self.assertIs(self.parser.gets(), INCOMPLETE)
+        self.parser.feed(encoded[-1:])
+        self.assertEqual(self.parser.gets(), message)
+        self.assertIs(self.parser.gets(), INCOMPLETE)
+        self.assertEqual(len(self.parser), 0)
+
+    def test_buffered_messages(self):
+        self.parser.feed(b'$3\r\nfoo\r\n$-1\r\n:12\r\n-oops\r\n@7\r\n{"a":1}\r\n$3\r\nb')
+        self.assertEqual(self.parser.gets(), b'foo')
+        self.assertIsNone(self.parser.gets())
+        self.assertEqual(self.parser.gets(), 12)
+        self.assertEqual(self.parser.gets().message, b'oops')
+        self.assertEqual(self.parser.gets(), {'a': 1})
+        self.assertIs(self.parser.gets(), INCOMPLETE)
+        self.parser.feed(b'ar\r\n')
+        self.assertEqual(self.parser.gets(), b'bar')
+
+    def test_invalid_messages(self):
+        for data in (b'*abc\r\n', b'$-5\r\n', b'%1\r\n*0\r\n:1\r\n', b'@2\r\n{]\r\n',
+                     b'%-1\r\n', b'&-1\r\n', b'~-1\r\n'):
+            self.parser.feed(b'$3\r\nfoo\r\n' + data + b'$3\r\nbar\r\n')
+            self.assertEqual(self.parser.gets(), b'foo')
+            self.assertRaises(ProtocolError, self.parser.gets)
+            # The invalid message and everything buffered after it are dropped.
+            self.assertEqual(len(self.parser), 0)
+            self.assertIs(self.parser.gets(), INCOMPLETE)
+
+    def test_null_array(self):
+        self.parser.feed(b'*-1\r\n*2\r\n*-1\r\n$-1\r\n')
+        self.assertIsNone(self.parser.gets())
+        self.assertEqual(self.parser.gets(), [None, None])
+        self.assertIs(self.parser.gets(), INCOMPLETE)
+
+    def test_resumed_messages(self):
+        message = [b'%d' % i for i in range(1000)]
+        encoded = self.protocol.encode(message)
+        self.parser.feed(encoded[:len(encoded) // 2])
+        self.assertIs(self.parser.gets(), INCOMPLETE)
+        # The elements parsed so far are kept, while the partial message still counts as unparsed.
+        self.assertEqual(len(self.parser), len(encoded) // 2)
+        self.parser.feed(encoded[len(encoded) // 2:])
+        self.assertEqual(self.parser.gets(), message)
+        self.assertEqual(len(self.parser), 0)
+
+    def test_packed_messages(self):
+        message = [b'k1', {'k2': [1, -1, 2 ** 33, 1.5, None, False]}, {b'm1'}, Error(b'oops'), 'caf\u00e9' * 10]
+        encoded = self.protocol.encode(message, packed=True)
+        self.assertTrue(encoded.startswith(b'~'))
+
+        for i in range(len(encoded) - 1):
+            self.parser.feed(encoded[i:i + 1])
+            self.assertIs(self.parser.gets(), INCOMPLETE)
+        self.parser.feed(encoded[-1:])
+        self.assertEqual(self.parser.gets(), message)
+
+        # The pure Python codec writes and reads the same bytes as msgpack.
+        self.assertEqual(python_pack({'a': [1, b'b', None]}), b'\x81\xa1a\x93\x01\xc4\x01b\xc0')
+        self.assertEqual(python_unpack(b'\x92\xcd\x01\x00\xd4\x02x'), [256, Error(b'x')])
+        self.assertRaises(ValueError, python_unpack, b'\x92\x01')
+
+        # Integers that do not fit in 64 bits are written element by element.
+        self.assertEqual(self.protocol.encode([2 ** 70], packed=True), b'*1\r\n:%d\r\n' % 2 ** 70)
+
 
 if __name__ == '__main__':
     server_t, server = run_queue_server()